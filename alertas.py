@@ -0,0 +1,152 @@
+import json
+import logging
+import threading
+import urllib.request
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+
+from recursos import opcion
+
+# Alertas de servicio: un índice de los coches ordenado por litrosServi que se
+# mantiene al día con cada escritura (estado_coches avisa qué coche cambió) y se
+# rearma solo cuando se reconstruye el estado. Cada vez que un coche pasa de un
+# nivel a otro se genera un evento y se avisa a los suscriptores. Los coches que
+# necesitan servicio salen del principio del índice con una búsqueda binaria, sin
+# recorrer la flota ni el historial.
+
+# Niveles de menor a mayor: un coche está en el primero cuyo límite no supera
+NIVELES = [('rojo', 100), ('amarillo', 500)]
+SIN_ALERTA = 'verde'
+
+# Límite del último nivel con alerta: desde ahí un coche necesita servicio
+LIMITE_SERVICIO = NIVELES[-1][1]
+
+# Si está configurado, cada evento se manda también por POST (JSON) a esta URL
+WEBHOOK = opcion('alertas_webhook')
+
+# Cuántos eventos recientes se guardan para mostrarlos
+EVENTOS_RECORDADOS = 200
+
+_lock = threading.Lock()
+_indice = []
+_litros = {}
+_eventos = deque(maxlen=EVENTOS_RECORDADOS)
+_suscriptores = []
+
+def nivel(litros_servi):
+    for nombre, limite in NIVELES:
+        if litros_servi <= limite:
+            return nombre
+    return SIN_ALERTA
+
+# Nivel de cada valor de una columna de una sola vez
+def niveles(valores):
+    return np.select([valores <= limite for _, limite in NIVELES], [nombre for nombre, _ in NIVELES], default=SIN_ALERTA)
+
+# "funcion" recibe cada evento (dict) en el hilo que hizo la escritura
+def suscribir(funcion):
+    with _lock:
+        if funcion not in _suscriptores:
+            _suscriptores.append(funcion)
+
+def _quitar(coche):
+    litros = _litros.pop(coche, None)
+    if litros is not None:
+        del _indice[bisect_left(_indice, (litros, coche))]
+    return litros
+
+def _poner(coche, litros):
+    _litros[coche] = litros
+    insort(_indice, (litros, coche))
+
+def _evento(coche, anterior, litros):
+    return {
+        'momento': datetime.now().isoformat(timespec='seconds'),
+        'coche': coche,
+        'nivel': nivel(litros),
+        'nivelAnterior': nivel(anterior),
+        'litrosServi': litros,
+    }
+
+def _avisar(eventos):
+    if not eventos:
+        return
+    with _lock:
+        _eventos.extend(eventos)
+        suscriptores = list(_suscriptores)
+    for evento in eventos:
+        for funcion in suscriptores:
+            try:
+                funcion(evento)
+            except Exception:
+                logging.exception("Falló un aviso de alerta de servicio")
+
+# Un coche cambió de litrosServi: se mueve en el índice en O(log n) y, si cruzó un
+# límite, se genera el evento. Un coche que no estaba no genera evento.
+def actualizar(coche, litros_servi):
+    coche, litros_servi = int(coche), int(litros_servi)
+    with _lock:
+        anterior = _quitar(coche)
+        _poner(coche, litros_servi)
+    if anterior is not None and nivel(anterior) != nivel(litros_servi):
+        _avisar([_evento(coche, anterior, litros_servi)])
+
+# Rearma el índice con una tabla de estado. "coches" son los coches que cubre la
+# tabla (los de los depósitos de su vista; None, toda la flota): solo esos se
+# reemplazan, así el estado de un depósito no saca del índice a los de los demás.
+# Los coches que ya estaban y cambiaron de nivel (por escrituras de otros
+# procesos) generan su evento.
+def reconstruir(estado, coches=None):
+    nuevos = dict(zip(estado.index.astype(int).tolist(), estado['litrosServi'].astype(int).tolist()))
+    with _lock:
+        eventos = [
+            _evento(coche, _litros[coche], litros) for coche, litros in nuevos.items()
+            if coche in _litros and nivel(_litros[coche]) != nivel(litros)
+        ]
+        if coches is None:
+            _litros.clear()
+        else:
+            for coche in coches:
+                _litros.pop(int(coche), None)
+        _litros.update(nuevos)
+        _indice[:] = sorted((litros, coche) for coche, litros in _litros.items())
+    _avisar(eventos)
+
+# [(litrosServi, coche)] de los coches con litrosServi <= limite, de menor a mayor
+def vencidos(limite=LIMITE_SERVICIO, coches=None):
+    with _lock:
+        hasta = bisect_right(_indice, (limite, float('inf')))
+        encontrados = _indice[:hasta]
+    if coches is not None:
+        encontrados = [(litros, coche) for litros, coche in encontrados if coche in coches]
+    return encontrados
+
+def eventos_recientes():
+    with _lock:
+        return list(_eventos)[::-1]
+
+def _registrar_en_log(evento):
+    if evento['nivel'] != SIN_ALERTA:
+        logging.warning("Coche %s en %s: quedan %s litros para el servicio",
+                        evento['coche'], evento['nivel'], evento['litrosServi'])
+
+def _enviar_webhook(evento):
+    pedido = urllib.request.Request(
+        WEBHOOK, data=json.dumps(evento).encode('utf-8'), headers={'Content-Type': 'application/json'}
+    )
+
+    def enviar():
+        try:
+            urllib.request.urlopen(pedido, timeout=10).close()
+        except Exception:
+            logging.exception("No se pudo enviar la alerta de servicio a %s", WEBHOOK)
+
+    # En otro hilo, para que un webhook lento no demore la escritura que generó el evento
+    threading.Thread(target=enviar, name='alertas-webhook', daemon=True).start()
+
+suscribir(_registrar_en_log)
+if WEBHOOK:
+    suscribir(_enviar_webhook)
@@ -0,0 +1,121 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from estado_coches import obtener_litros_servi
+from flota import deposito_de, intervalos_servicio
+from metricas import medido
+
+# Análisis de consumo de toda la flota: litros por día de cada coche y depósito,
+# ventanas móviles, cargas fuera de lo normal y fecha estimada del próximo servicio.
+# Todo sale de unas pocas pasadas de groupby/rolling sobre el historial completo y
+# se guarda por versión de los datos (como el estado por coche), así que mientras
+# nadie escriba los reruns no recalculan nada.
+
+# Columnas del historial de cargas que usa el análisis
+COLUMNAS_CARGAS = ['idCarga', 'fecha', 'hora', 'coche', 'litros']
+
+# Ventanas móviles (en días) sobre los litros diarios de cada coche
+VENTANA_CORTA = 7
+VENTANA_LARGA = 30
+
+# Una carga es anómala si supera la mediana del coche en más de UMBRAL_ANOMALIA
+# desvíos robustos (MAD escalado); con pocas cargas no hay norma confiable
+UMBRAL_ANOMALIA = 3.5
+MINIMO_CARGAS_NORMA = 10
+
+_analisis = {'clave': None, 'resultado': None}
+_analisis_lock = threading.Lock()
+
+# Litros por día de cada coche en cada fecha con cargas, y sumas móviles por tiempo
+def _ventanas(cargas):
+    diario = cargas.groupby(['coche', 'fecha'], observed=True, sort=True)['litros'].sum().reset_index()
+    por_coche = diario.set_index('fecha').groupby('coche', observed=True)['litros']
+    diario[f'litros{VENTANA_CORTA}d'] = por_coche.rolling(f'{VENTANA_CORTA}D').sum().to_numpy()
+    diario[f'litros{VENTANA_LARGA}d'] = por_coche.rolling(f'{VENTANA_LARGA}D').sum().to_numpy()
+    return diario
+
+# Cargas que superan la norma de su coche (mediana + UMBRAL_ANOMALIA * MAD escalado)
+def _anomalias(cargas):
+    por_coche = cargas.groupby('coche', observed=True)['litros']
+    mediana = por_coche.transform('median')
+    desvio = (cargas['litros'] - mediana).abs().groupby(cargas['coche'], observed=True).transform('median') * 1.4826
+    cantidad = por_coche.transform('size')
+
+    limite = mediana + UMBRAL_ANOMALIA * desvio.where(desvio > 0, np.nan)
+    anomalas = (cantidad >= MINIMO_CARGAS_NORMA) & (cargas['litros'] > limite)
+    return cargas[anomalas].assign(mediana=mediana[anomalas], limite=limite[anomalas].round())
+
+def _por_coche(cargas, diario, service_data, desde_servicio, hoy):
+    por_coche = cargas.groupby('coche', observed=True).agg(
+        primera=('fecha', 'min'),
+        ultima=('fecha', 'max'),
+        litrosTotales=('litros', 'sum'),
+    )
+    litros = desde_servicio.reindex(por_coche.index).fillna(0).astype(int).to_numpy()
+    por_coche['litrosServi'] = intervalos_servicio(por_coche.index) - litros
+    dias = (por_coche['ultima'] - por_coche['primera']).dt.days + 1
+    por_coche['litrosPorDia'] = (por_coche['litrosTotales'] / dias).round(1)
+
+    # Consumo reciente: litros de los últimos VENTANA_LARGA días hasta hoy
+    recientes = diario[diario['fecha'] > hoy - pd.Timedelta(days=VENTANA_LARGA)]
+    recientes = recientes.groupby('coche', observed=True)['litros'].sum()
+    por_coche[f'litrosPorDia{VENTANA_LARGA}d'] = (recientes.reindex(por_coche.index).fillna(0) / VENTANA_LARGA).round(1)
+
+    # Al ritmo reciente (o al histórico si no cargó en la ventana), cuándo llega a 0 litrosServi
+    ritmo = por_coche[f'litrosPorDia{VENTANA_LARGA}d'].where(lambda r: r > 0, por_coche['litrosPorDia'])
+    dias_restantes = (por_coche['litrosServi'].clip(lower=0) / ritmo.where(ritmo > 0)).round()
+    por_coche['diasParaServicio'] = dias_restantes
+    por_coche['proximoServicio'] = hoy + pd.to_timedelta(dias_restantes, unit='D')
+
+    if not service_data.empty:
+        ultimos = service_data.groupby('coche', observed=True)['fecha'].max()
+        por_coche['ultimoServicio'] = ultimos.reindex(por_coche.index)
+    else:
+        por_coche['ultimoServicio'] = pd.NaT
+
+    por_coche.insert(0, 'deposito', deposito_de(por_coche.index.to_series()).to_numpy())
+    return por_coche.drop(columns=['primera'])
+
+def _por_deposito(por_coche):
+    return por_coche.groupby('deposito', observed=True).agg(
+        coches=('litrosTotales', 'size'),
+        litrosTotales=('litrosTotales', 'sum'),
+        litrosPorDia=('litrosPorDia', 'sum'),
+        **{f'litrosPorDia{VENTANA_LARGA}d': (f'litrosPorDia{VENTANA_LARGA}d', 'sum')},
+        proximoServicio=('proximoServicio', 'min'),
+    ).round(1)
+
+@medido('analitica', 'calculo')
+def calcular(diesel_data, service_data, hoy=None, depositos=None):
+    hoy = pd.Timestamp.today().normalize() if hoy is None else pd.Timestamp(hoy)
+    cargas = diesel_data[COLUMNAS_CARGAS].dropna(subset=['fecha', 'coche', 'litros'])
+    if cargas.empty:
+        return None
+
+    diario = _ventanas(cargas)
+    desde_servicio = obtener_litros_servi(diesel_data, service_data, depositos)[1]
+    por_coche = _por_coche(cargas, diario, service_data, desde_servicio, hoy)
+    return {
+        'por_coche': por_coche,
+        'por_deposito': _por_deposito(por_coche),
+        'diario': diario,
+        'anomalias': _anomalias(cargas),
+    }
+
+# Igual que obtener_estado: se recalcula solo cuando cambia la versión de alguno de
+# los historiales (o el día, porque las ventanas y proyecciones cuentan desde hoy)
+def obtener(diesel_data, service_data, depositos=None):
+    hoy = pd.Timestamp.today().normalize()
+    versiones = (diesel_data.attrs.get('version'), service_data.attrs.get('version'))
+    clave = (versiones, hoy)
+    with _analisis_lock:
+        if None not in versiones and _analisis['clave'] == clave:
+            return _analisis['resultado']
+
+    resultado = calcular(diesel_data, service_data, hoy, depositos)
+    with _analisis_lock:
+        _analisis['clave'] = clave
+        _analisis['resultado'] = resultado
+    return resultado
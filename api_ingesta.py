@@ -0,0 +1,282 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import recursos
+
+# La API corre al lado de la app con los mismos secrets, pero su cola de escritura
+# tiene que tener su propio journal: con uno compartido, el proceso que vacía su
+# cola primero lo trunca (perdiendo lo que el otro no confirmó) y al reiniciar cada
+# uno reaplica operaciones del otro. Se fija antes de importar cola_escritura.
+recursos.fijar_opcion('cola_escritura_journal', recursos.opcion('api_journal', 'api_ingesta.jsonl'))
+
+import cola_escritura
+from cola_escritura import agregar, cargar_con_pendientes, encolar, version_esperada
+from estado_coches import (
+    COLUMNAS_CARGAS, desactualizado, obtener_estado, registrar_lote_de_cargas, registrar_servicio
+)
+from importacion import (
+    COLUMNAS_REQUERIDAS as REQUERIDAS_CARGAS, preparar_lote, preparar_servicios, validar_cargas, validar_servicios
+)
+from recursos import opcion
+from storage import reservar_ids
+
+# Servicio HTTP de ingesta, sin Streamlit, para los surtidores y el sistema de
+# despacho (python api_ingesta.py --puerto 8502):
+#   POST /cargas      filas con coche, litros, fecha y hora (opcional)
+#   POST /servicios   filas con coche, fecha (opcional) y hora (opcional)
+#   GET  /estado      escrituras pendientes de la cola
+# El cuerpo es JSON (un objeto o una lista) o NDJSON (un objeto por línea).
+#
+# Las filas de todos los pedidos que llegan juntos se agrupan en un lote por
+# archivo: una sola validación con las mismas reglas que la app (importacion),
+# una sola reserva de IDs, un solo cálculo de litrosServi sobre el estado y una
+# sola operación en la cola de escritura, que las guarda en S3 como un delta. Los
+# hilos del servidor solo leen el JSON; el pedido vuelve cuando su lote ya está
+# en el journal de la cola, con los IDs asignados y las filas rechazadas.
+#
+# El estado por coche se lee de S3 al arrancar y cada INTERVALO_ESTADO segundos
+# (para ver lo que escribió la app); entre lecturas se actualiza con cada lote.
+# Para probarlo localmente alcanza con "s3_local_dir" en los secrets.
+
+ARCHIVOS = {'cargas': 'cargas_diesel.csv', 'servicios': 'servicios_realizados.csv'}
+COLUMNAS_REQUERIDAS = {'cargas': REQUERIDAS_CARGAS, 'servicios': ['coche']}
+
+# Tiempo que se espera para juntar pedidos en un lote, y máximo de filas por lote
+VENTANA_LOTE = 0.02
+MAXIMO_FILAS_LOTE = 5000
+
+# Tamaño máximo del cuerpo de un pedido
+MAXIMO_BYTES = 10 * 1024 * 1024
+
+INTERVALO_ESTADO = 10
+
+# Si está configurado, los pedidos tienen que traer "Authorization: Bearer <token>"
+TOKEN = opcion('api_token')
+
+_lock = threading.Lock()
+_hay_pedidos = threading.Condition(_lock)
+_esperando = []
+_estado = {'tabla': None, 'leido': 0}
+_hilo = {'hilo': None}
+
+class PedidoInvalido(Exception):
+    pass
+
+# Filas del cuerpo: JSON (objeto o lista de objetos) o NDJSON
+def leer_filas(cuerpo):
+    try:
+        texto = cuerpo.decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise PedidoInvalido(f"El cuerpo no es UTF-8: {e}") from e
+    try:
+        datos = json.loads(texto)
+    except json.JSONDecodeError:
+        try:
+            datos = [json.loads(linea) for linea in texto.splitlines() if linea.strip()]
+        except json.JSONDecodeError as e:
+            raise PedidoInvalido(f"JSON inválido: {e}") from e
+    if isinstance(datos, dict):
+        datos = [datos]
+    if not isinstance(datos, list) or not all(isinstance(fila, dict) for fila in datos):
+        raise PedidoInvalido("Se espera un objeto o una lista de objetos")
+    if not datos:
+        raise PedidoInvalido("No hay filas")
+    # Un valor anidado haría fallar la validación de todo el lote, no solo la de este pedido
+    if any(isinstance(valor, (list, dict)) for fila in datos for valor in fila.values()):
+        raise PedidoInvalido("Los valores de cada fila tienen que ser simples (número, texto o null)")
+    return pd.DataFrame(datos)
+
+def _columnas_faltantes(tipo, filas):
+    faltantes = [c for c in COLUMNAS_REQUERIDAS[tipo] if c not in filas.columns]
+    if faltantes:
+        raise PedidoInvalido(f"Faltan las columnas: {', '.join(faltantes)}")
+
+# Valida de una vez las filas de todos los pedidos del lote. Devuelve las válidas
+# (con la columna "pedido") y los rechazos de cada pedido.
+def _validar(tipo, pedidos):
+    crudas = pd.concat([p['filas'] for p in pedidos], ignore_index=True)
+    pedido = np.repeat(np.arange(len(pedidos)), [len(p['filas']) for p in pedidos])
+    fila = np.concatenate([np.arange(len(p['filas'])) for p in pedidos])
+
+    validas, rechazadas = (validar_cargas if tipo == 'cargas' else validar_servicios)(crudas)
+    validas['pedido'] = pedido[validas.index]
+    # Sin hora se usa la de llegada, como en los formularios
+    validas['hora'] = validas['hora'].fillna(datetime.now().strftime('%H:%M'))
+
+    rechazos = [[] for _ in pedidos]
+    for i, motivo in zip(rechazadas.index, rechazadas['motivo']):
+        rechazos[pedido[i]].append({'fila': int(fila[i]), 'motivo': motivo})
+    return validas.reset_index(drop=True), rechazos
+
+def _estado_actual():
+    # También cuando un servicio con fecha anterior dejó el estado para reconstruir
+    if _estado['tabla'] is None or time.monotonic() - _estado['leido'] > INTERVALO_ESTADO or desactualizado():
+        diesel_data = cargar_con_pendientes(ARCHIVOS['cargas'], columnas=COLUMNAS_CARGAS)
+        service_data = cargar_con_pendientes(ARCHIVOS['servicios'])
+        _estado['tabla'] = obtener_estado(diesel_data, service_data)
+        _estado['leido'] = time.monotonic()
+    return _estado['tabla']
+
+# Guarda un lote de un archivo y devuelve las filas guardadas (con la columna "pedido")
+def _guardar(tipo, lote):
+    filename = ARCHIVOS[tipo]
+    estado = _estado_actual()
+    ids = reservar_ids(filename, len(lote))
+    if tipo == 'cargas':
+        filas = preparar_lote(lote, estado, ids)
+    else:
+        filas = preparar_servicios(lote, estado, ids)
+
+    operacion = encolar([agregar(filename, filas.drop(columns=['pedido']))])[0]
+    version = version_esperada(filename)
+    if tipo == 'cargas':
+        registrar_lote_de_cargas(filas, version)
+    else:
+        for fila in filas.itertuples():
+            registrar_servicio(fila.coche, fila.fecha, fila.hora, fila.litrosTotales, version)
+    return filas, operacion
+
+def _procesar(pedidos):
+    for tipo in ARCHIVOS:
+        del_tipo = [p for p in pedidos if p['tipo'] == tipo]
+        if not del_tipo:
+            continue
+        try:
+            lote, rechazos = _validar(tipo, del_tipo)
+            filas, operacion = _guardar(tipo, lote) if not lote.empty else (lote, None)
+        except Exception as e:
+            logging.exception("No se pudo guardar un lote de %s", tipo)
+            for pedido in del_tipo:
+                pedido['error'] = str(e)
+            continue
+
+        columna_id = 'idCarga' if tipo == 'cargas' else 'idServis'
+        ids_por_pedido = filas.groupby('pedido')[columna_id].apply(list) if not filas.empty else {}
+        for i, pedido in enumerate(del_tipo):
+            pedido['ids'] = [int(x) for x in ids_por_pedido.get(i, [])]
+            pedido['rechazadas'] = rechazos[i]
+            pedido['operacion'] = operacion
+
+def _agrupar():
+    while True:
+        with _hay_pedidos:
+            while not _esperando:
+                _hay_pedidos.wait()
+        time.sleep(VENTANA_LOTE)
+
+        with _lock:
+            pedidos, filas = [], 0
+            while _esperando and (not pedidos or filas + len(_esperando[0]['filas']) <= MAXIMO_FILAS_LOTE):
+                pedido = _esperando.pop(0)
+                pedidos.append(pedido)
+                filas += len(pedido['filas'])
+        try:
+            _procesar(pedidos)
+        finally:
+            for pedido in pedidos:
+                pedido['listo'].set()
+
+def _iniciar_hilo():
+    with _lock:
+        if _hilo['hilo'] is None:
+            _hilo['hilo'] = threading.Thread(target=_agrupar, name='api-ingesta', daemon=True)
+            _hilo['hilo'].start()
+
+# Deja las filas en el próximo lote y espera a que se validen y queden encoladas.
+# Devuelve (código HTTP, respuesta).
+def ingresar(tipo, filas, timeout=30):
+    _columnas_faltantes(tipo, filas)
+    pedido = {'tipo': tipo, 'filas': filas, 'listo': threading.Event()}
+    _iniciar_hilo()
+    with _hay_pedidos:
+        _esperando.append(pedido)
+        _hay_pedidos.notify()
+
+    if not pedido['listo'].wait(timeout):
+        return 503, {'error': 'Tiempo de espera agotado'}
+    if 'error' in pedido:
+        return 503, {'error': pedido['error']}
+    if not pedido['ids']:
+        return 422, {'aceptadas': 0, 'ids': [], 'rechazadas': pedido['rechazadas']}
+    return 202, {
+        'aceptadas': len(pedido['ids']), 'ids': pedido['ids'], 'rechazadas': pedido['rechazadas'],
+        'operacion': pedido['operacion']
+    }
+
+class Manejador(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _responder(self, codigo, cuerpo):
+        contenido = json.dumps(cuerpo, ensure_ascii=False).encode('utf-8')
+        self.send_response(codigo)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(contenido)))
+        self.end_headers()
+        self.wfile.write(contenido)
+
+    def _autorizado(self):
+        return not TOKEN or self.headers.get('Authorization') == f"Bearer {TOKEN}"
+
+    def do_GET(self):
+        if not self._autorizado():
+            return self._responder(401, {'error': 'No autorizado'})
+        if self.path.rstrip('/') != '/estado':
+            return self._responder(404, {'error': 'No existe'})
+        self._responder(200, cola_escritura.resumen())
+
+    def do_POST(self):
+        try:
+            largo = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            largo = -1
+        if largo < 0:
+            # Sin un largo válido no se sabe dónde termina el cuerpo: se cierra la conexión
+            self.close_connection = True
+            return self._responder(400, {'error': 'Content-Length inválido'})
+        if largo > MAXIMO_BYTES:
+            self.close_connection = True
+            return self._responder(413, {'error': f"El cuerpo supera {MAXIMO_BYTES} bytes"})
+        cuerpo = self.rfile.read(largo)
+
+        if not self._autorizado():
+            return self._responder(401, {'error': 'No autorizado'})
+        tipo = self.path.strip('/')
+        if tipo not in ARCHIVOS:
+            return self._responder(404, {'error': 'No existe'})
+
+        try:
+            self._responder(*ingresar(tipo, leer_filas(cuerpo)))
+        except PedidoInvalido as e:
+            self._responder(400, {'error': str(e)})
+
+    # Sin una línea de log por pedido
+    def log_message(self, formato, *args):
+        pass
+
+# Con muchos clientes a la vez la cola de conexiones por defecto (5) se llena
+class Servidor(ThreadingHTTPServer):
+    request_queue_size = 512
+    daemon_threads = True
+
+def servidor(host='0.0.0.0', puerto=8502):
+    return Servidor((host, puerto), Manejador)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API de ingesta de cargas y servicios")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--puerto', type=int, default=8502)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    _estado_actual()
+    with servidor(args.host, args.puerto) as http:
+        logging.info("API de ingesta en %s:%s", args.host, args.puerto)
+        http.serve_forever()
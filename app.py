@@ -1,208 +1,338 @@
 import streamlit as st
-import boto3
 import pandas as pd
-from io import StringIO
 from datetime import datetime
-from config import cargar_configuracion
-import time
-
-# Lista de números de colectivos válidos
-numeros_colectivos = [
-    1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 18, 52,
-    101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114, 115, 116, 117, 118, 119, 120
-]
-
-numeros_tigre = [
-    1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 18, 52
-]
-
-numeros_alderete = [
-    101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114, 115, 116, 117, 118, 119, 120
-]
-
-# Cargar configuración
-aws_access_key, aws_secret_key, region_name, bucket_name, valid_user, valid_password = cargar_configuracion()
-
-# Configuración de AWS S3
-s3 = boto3.client(
-    's3',
-    aws_access_key_id=aws_access_key,
-    aws_secret_access_key=aws_secret_key,
-    region_name=region_name
+from storage import BACKEND, COLUMNAS_ID, reservar_ids, cache_stats, filas_por_id, quitar_repetidas
+from estado_coches import (
+    COLUMNAS_CARGAS, obtener_estado, estado_de_coche, registrar_carga, registrar_servicio,
+    recalcular_cargas_de_coche, recalcular_servicios_de_coche, registrar_lote_de_cargas, obtener_litros_servi
 )
-
-# Funciones para cargar y actualizar datos desde y en S3
-def load_csv_from_s3(filename):
-    try:
-        obj = s3.get_object(Bucket=bucket_name, Key=filename)
-        data = pd.read_csv(obj['Body'])
-        return data
-    except Exception as e:
-        st.error(f"Error al cargar {filename}: {e}")
-        return pd.DataFrame()
-
-def update_csv_in_s3(data, filename):
-    csv_buffer = StringIO()
-    data.to_csv(csv_buffer, index=False)
-    s3.put_object(Bucket=bucket_name, Key=filename, Body=csv_buffer.getvalue())
-
-# Formulario de Carga de Diésel
-def diesel_form(diesel_data):
-    # Crear las tres columnas
-    col1, col2, col3 = st.columns([2, 1, 1])  # La primera columna es el doble de ancha
-
-    # Formulario en las dos primeras columnas
+from esquema import aplicar, columnas_guardadas, concatenar
+from importacion import leer_archivo, validar_cargas, preparar_lote
+import metricas
+from metricas import medido
+import alertas
+import analitica
+import reportes
+import cola_escritura
+import espejo_sqlite
+from cola_escritura import encolar, agregar, borrar, corregir, cargar_con_pendientes, version_esperada
+
+from flota import capacidades, coches as coches_de_la_flota, depositos, es_coche_valido, intervalo_servicio, registro
+
+# Filas por página en los historiales
+TAMANOS_PAGINA = [25, 50, 100, 500]
+
+# Las fechas (datetime64 desde la lectura) se muestran sin la hora
+COLUMNAS_FECHA = {
+    'fecha': st.column_config.DateColumn(format="YYYY-MM-DD"),
+    'fechaAnterior': st.column_config.DateColumn(format="YYYY-MM-DD"),
+}
+
+COLUMNAS_FECHA_ANALISIS = {
+    columna: st.column_config.DateColumn(format="YYYY-MM-DD")
+    for columna in ['ultima', 'proximoServicio', 'ultimoServicio']
+}
+
+# Color de cada nivel de alerta de litrosServi
+COLORES_NIVEL = {'rojo': 'color: red', 'amarillo': 'color: yellow', alertas.SIN_ALERTA: 'color: green'}
+
+# Color de litrosServi para toda la columna de una vez (se usa con Styler.apply)
+def colores_litros_servi(valores):
+    return [COLORES_NIVEL[n] for n in alertas.niveles(valores)]
+
+# Con el almacenamiento por depósito cada operador elige en la barra lateral qué
+# depósitos ve, y solo se leen los fragmentos de esos depósitos. None es toda la flota.
+def depositos_de_la_vista():
+    if BACKEND != 'depositos':
+        return None
+    elegidos = st.session_state.get('vista')
+    if not elegidos or len(elegidos) == len(depositos()):
+        return None
+    return [d for d in depositos() if d in elegidos]
+
+def coche_en_vista(coche):
+    vista = depositos_de_la_vista()
+    return es_coche_valido(coche) and (vista is None or registro()['deposito'].get(coche) in vista)
+
+# Con el espejo SQLite habilitado se lee de la base local; si no, de S3 con lo
+# pendiente de la cola aplicado encima
+def cargar_datos(filename, columnas=None, meses=None, depositos=None):
+    if espejo_sqlite.habilitado():
+        return espejo_sqlite.cargar(filename, columnas, meses, depositos)
+    return cargar_con_pendientes(filename, columnas, meses, depositos)
+
+# Versión que van a tener los datos de la vista en la próxima lectura, después de encolar
+def version_siguiente(filename):
+    if espejo_sqlite.habilitado():
+        return espejo_sqlite.version(filename, depositos_de_la_vista())
+    return version_esperada(filename, depositos_de_la_vista())
+
+# Lista de meses 'YYYY-MM' entre dos fechas, para leer solo esas particiones
+def meses_entre(desde, hasta):
+    return [str(p) for p in pd.period_range(desde, hasta, freq='M')]
+
+# Filtros comunes de los historiales; "clave" distingue los widgets de cada uno
+def filtros_historial(clave):
+    col1, col2, col3 = st.columns(3)
     with col1:
-        st.header("Registrar Carga de Diésel")
-        coche = st.number_input("Número de Coche", min_value=0)
-
-        if coche not in numeros_colectivos:
-            st.info("Ingrese un número de coche válido")
-        else:
-            fecha = st.date_input("Fecha", value=datetime.now().date())
-            litros = st.number_input("Litros Cargados", min_value=0)
-            hora = datetime.now().strftime('%H:%M')
-
-            if st.button("Registrar Carga"):
-                # Obtener el valor actual de litrosServi del coche
-                if not diesel_data[diesel_data['coche'] == coche].empty:
-                    ultimo_servis = diesel_data[diesel_data['coche'] == coche].iloc[-1]['litrosServi']
-                else:
-                    ultimo_servis = 5000  # Valor inicial si no hay registros previos
-
-                # Calcular los litros restantes después de la nueva carga
-                litros_servi_restantes = ultimo_servis - litros
-
-                # Crear una nueva entrada
-                new_entry = pd.DataFrame([{
-                    'idCarga': len(diesel_data) + 1,
-                    'fecha': fecha,
-                    'hora': hora,
-                    'coche': coche,
-                    'litros': litros,
-                    'litrosServi': litros_servi_restantes
-                }])
-
-                # Agregar la nueva entrada al DataFrame
-                diesel_data = pd.concat([diesel_data, new_entry], ignore_index=True)
-
-                # Actualizar el archivo CSV en S3
-                update_csv_in_s3(diesel_data, 'cargas_diesel.csv')
-
-                st.success("Carga de diésel registrada correctamente.")
-
-    # Mostrar las tablas de Alderete y Tigre en la tercera columna
-    show_custom_tables(diesel_data, col2, col3)
-
-    # Mostrar historial actualizado
-    show_diesel_history(diesel_data)
-
-def show_custom_tables(diesel_data, col2, col3):
-    # Filtrar datos para Alderete y Tigre
-    alderete_data = diesel_data[diesel_data['coche'].isin(numeros_alderete)]
-    tigre_data = diesel_data[diesel_data['coche'].isin(numeros_tigre)]
-
-    # Asegurarse de que estamos tomando el último valor de litrosServi para cada coche
-    alderete_data = alderete_data.groupby('coche').agg({
-        'litrosServi': 'last'  # Obtener el último valor de litrosServi para cada coche
-    }).reset_index()
-
-    tigre_data = tigre_data.groupby('coche').agg({
-        'litrosServi': 'last'  # Obtener el último valor de litrosServi para cada coche
-    }).reset_index()
-
-    # Calcular la columna 'litros' como la diferencia entre 5000 y 'litrosServi'
-    alderete_data['litros'] = 5000 - alderete_data['litrosServi']
-    tigre_data['litros'] = 5000 - tigre_data['litrosServi']
-
-    # Reordenar las columnas
-    alderete_data = alderete_data[['coche', 'litros', 'litrosServi']]
-    tigre_data = tigre_data[['coche', 'litros', 'litrosServi']]
+        coches = st.multiselect("Coches", coches_de_la_flota(), key=f"coches{clave}")
+    with col2:
+        deposito = st.selectbox("Depósito", ["Todos"] + (depositos_de_la_vista() or depositos()), key=f"deposito{clave}")
+    with col3:
+        hoy = datetime.now().date()
+        rango = st.date_input("Fechas", value=(hoy.replace(day=1), hoy), key=f"fechas{clave}")
+
+    # Mientras se elige el rango el widget devuelve una sola fecha
+    desde, hasta = (rango[0], rango[-1]) if rango else (hoy, hoy)
+    return coches, deposito, desde, hasta
+
+def filtrar_historial(data, coches, deposito, desde, hasta):
+    # La fecha ya viene como datetime64 y el depósito como categoría desde la lectura
+    fechas = data['fecha']
+    mascara = (fechas >= pd.Timestamp(desde)) & (fechas <= pd.Timestamp(hasta))
+    if coches:
+        mascara &= data['coche'].isin(coches)
+    if deposito != "Todos":
+        mascara &= data['deposito'] == deposito
+    return data[mascara]
+
+# Devuelve solo la página pedida ordenada por "columna" de mayor a menor, sin ordenar
+# todo el historial: si ya está en orden ascendente (lo normal, porque se agrega al
+# final) se recorta desde el final, y si no se usa nlargest
+def pagina_descendente(data, columna, tamano, pagina):
+    if data[columna].is_monotonic_increasing:
+        fin = len(data) - (pagina - 1) * tamano
+        return data.iloc[max(fin - tamano, 0):fin].iloc[::-1]
+    return data.nlargest(pagina * tamano, columna).iloc[(pagina - 1) * tamano:]
+
+# Controles de paginación para "total" filas; devuelve el tamaño y la página elegida
+def controles_pagina(total, clave):
+    col1, col2, col3 = st.columns([1, 1, 2])
+    with col1:
+        tamano = st.selectbox("Filas por página", TAMANOS_PAGINA, key=f"tamano{clave}")
+    total_paginas = max((total - 1) // tamano + 1, 1)
+    with col2:
+        pagina = st.number_input("Página", min_value=1, max_value=total_paginas, value=1, key=f"pagina{clave}")
+    with col3:
+        st.caption(f"{total} registros, {total_paginas} páginas")
+    return tamano, pagina
+
+def paginar(data, columna, clave):
+    tamano, pagina = controles_pagina(len(data), clave)
+    return pagina_descendente(data, columna, tamano, pagina)
+
+# Con el espejo, la cantidad y la página salen de consultas con índice sin leer el
+# período completo; el depósito se traduce a sus coches
+def pagina_del_espejo(filename, coches, deposito, desde, hasta, clave):
+    elegidos = [deposito] if deposito != "Todos" else depositos_de_la_vista()
+    if elegidos is not None:
+        de_los_depositos = registro().index[registro()['deposito'].isin(elegidos)]
+        coches = [c for c in coches if c in de_los_depositos] if coches else de_los_depositos.tolist()
+    filtros = {'coches': coches or None, 'desde': desde, 'hasta': hasta}
+    total = espejo_sqlite.contar(filename, **filtros)
+    if total == 0:
+        return None
+    tamano, pagina = controles_pagina(total, clave)
+    return espejo_sqlite.pagina(filename, tamano, pagina, **filtros)
+
+# Escrituras encoladas por esta sesión, para mostrar si ya llegaron a S3
+def seguir_escrituras(ids):
+    st.session_state.escrituras = st.session_state.get('escrituras', []) + ids
+
+def mostrar_estado_escrituras():
+    ids = st.session_state.get('escrituras', [])
+    if not ids:
+        return
+    estados = cola_escritura.estado_de(ids)
+    pendientes = [i for i in ids if estados[i] != 'confirmada']
+    st.session_state.escrituras = pendientes
+
+    if not pendientes:
+        st.caption("Todos los cambios están guardados.")
+    elif 'error' in estados.values():
+        st.warning(f"{len(pendientes)} cambios sin guardar, se reintenta automáticamente: "
+                   f"{cola_escritura.resumen()['error']}")
+    else:
+        st.caption(f"Guardando {len(pendientes)} cambios...")
+
+# Cada sección de la página es un fragmento: al tocar uno de sus widgets se vuelve
+# a ejecutar solo esa sección, con los datos de la última ejecución completa. Las
+# secciones que escriben datos piden una ejecución completa (st.rerun) al terminar,
+# así todas las demás se actualizan con la versión nueva.
 
-    # Función para determinar el color del texto basado en los valores de litrosServi
-    def colorize_litros_servi(value):
-        if value <= 100:
-            return 'color: red'
-        elif value <= 500:
-            return 'color: yellow'
-        else:
-            return 'color: green'
+# Formulario de Carga de Diésel
+@st.fragment
+@medido('diesel_form')
+def diesel_form(estado):
+    st.header("Registrar Carga de Diésel")
+    coche = st.number_input("Número de Coche", min_value=0)
+
+    if not coche_en_vista(coche):
+        st.info("Ingrese un número de coche válido")
+    else:
+        fecha = st.date_input("Fecha", value=datetime.now().date())
+        # Como en la importación, hasta la capacidad del coche si el registro de la flota la indica
+        capacidad = capacidades([coche])[0]
+        litros = st.number_input("Litros Cargados", min_value=0, max_value=None if pd.isna(capacidad) else int(capacidad))
+        hora = datetime.now().strftime('%H:%M')
+
+        if st.button("Registrar Carga"):
+            # Obtener el valor actual de litrosServi del coche
+            fila = estado_de_coche(estado, coche)
+            if fila is not None and fila['cargas'] > 0:
+                ultimo_servis = fila['litrosServi']
+            else:
+                ultimo_servis = intervalo_servicio(coche)  # Valor inicial si no hay registros previos
+
+            # Calcular los litros restantes después de la nueva carga
+            litros_servi_restantes = ultimo_servis - litros
+
+            # Crear una nueva entrada
+            new_entry = pd.DataFrame([{
+                'idCarga': reservar_ids('cargas_diesel.csv')[0],
+                'fecha': fecha,
+                'hora': hora,
+                'coche': coche,
+                'litros': litros,
+                'litrosServi': litros_servi_restantes
+            }])
+
+            # Se guarda en S3 en segundo plano; el estado se actualiza ya
+            seguir_escrituras(encolar([agregar('cargas_diesel.csv', new_entry)]))
+            registrar_carga(coche, fecha, hora, litros, version_siguiente('cargas_diesel.csv'), depositos_de_la_vista())
+
+            st.session_state.mensaje = "Carga de diésel registrada correctamente."
+            st.rerun()
+
+# Tablas por depósito
+@st.fragment
+def tablero(estado):
+    show_custom_tables(estado, depositos_de_la_vista())
+
+# Importación de muchas cargas desde la exportación del surtidor
+@st.fragment
+@medido('bulk_import_form')
+def bulk_import_form(estado):
+    with st.expander("Importar Cargas desde Archivo"):
+        archivo = st.file_uploader("Archivo de cargas (CSV o Excel con columnas coche, litros, fecha y hora)", type=['csv', 'xlsx'])
+        if archivo is None:
+            return
+
+        try:
+            validas, rechazadas = validar_cargas(leer_archivo(archivo))
+        except Exception as e:
+            st.error(f"No se pudo leer el archivo: {e}")
+            return
+
+        # El estado solo tiene los coches de la vista: el resto no se puede importar desde acá
+        vista = depositos_de_la_vista()
+        if vista is not None:
+            en_vista = registro()['deposito'].reindex(validas['coche']).isin(vista).to_numpy()
+            if not en_vista.all():
+                st.warning(f"{(~en_vista).sum()} cargas son de coches de otros depósitos y no se van a importar.")
+            validas = validas[en_vista]
+
+        st.write(f"Cargas válidas: {len(validas)}. Filas rechazadas: {len(rechazadas)}.")
+        if not rechazadas.empty:
+            st.warning("Las siguientes filas no se van a importar:")
+            st.dataframe(rechazadas, hide_index=True)
+
+        if not validas.empty and st.button("Importar Cargas"):
+            # Todo el lote se guarda en una sola escritura
+            lote = preparar_lote(validas, estado, reservar_ids('cargas_diesel.csv', len(validas)))
+            seguir_escrituras(encolar([agregar('cargas_diesel.csv', lote)]))
+            registrar_lote_de_cargas(lote, version_siguiente('cargas_diesel.csv'), depositos_de_la_vista())
+
+            st.session_state.mensaje = f"Se importaron {len(lote)} cargas correctamente."
+            st.rerun()
+
+# Color del título de cada depósito; los depósitos nuevos usan el color por defecto
+COLORES_DEPOSITO = {'Alderete': 'yellow', 'Tigre': 'red'}
+
+@medido('show_custom_tables')
+def show_custom_tables(estado, mostrados=None):
+    # El estado ya tiene el último litrosServi y los litros desde el servicio de cada
+    # coche; una sola pasada agrupada reparte los coches con cargas por depósito
+    con_cargas = estado.loc[estado['cargas'] > 0, ['litros', 'litrosServi']].sort_index()
+    por_deposito = dict(list(con_cargas.groupby(registro()['deposito'].reindex(con_cargas.index).to_numpy(), sort=False)))
+
+    mostrados = mostrados or depositos()
+    for columna, deposito in zip(st.columns(max(len(mostrados), 1)), mostrados):
+        with columna:
+            color = COLORES_DEPOSITO.get(deposito, 'inherit')
+            st.markdown(f'<h3 style="color: {color};">{deposito}</h3>', unsafe_allow_html=True)
+            tabla = por_deposito.get(deposito)
+            if tabla is not None and not tabla.empty:
+                tabla = tabla.reset_index()[['coche', 'litros', 'litrosServi']]
+                st.dataframe(tabla.style.apply(colores_litros_servi, subset=['litrosServi']), hide_index=True)
+            else:
+                st.write(f"No hay datos para {deposito}.")
 
-    # Mostrar la tabla Alderete en la columna col2
-    with col2:
-        st.markdown('<h3 style="color: yellow;">Alderete</h3>', unsafe_allow_html=True)
-        if not alderete_data.empty:
-            sorted_alderete_data = alderete_data.sort_values(by='coche', ascending=True)
-            styled_alderete_df = sorted_alderete_data.style.applymap(colorize_litros_servi, subset=['litrosServi'])
-            st.dataframe(styled_alderete_df, hide_index=True)
-        else:
-            st.write("No hay datos para Alderete.")
+@st.fragment
+@medido('show_diesel_history')
+def show_diesel_history(litros_servi):
+    with st.expander("Historial de Cargas"):
+        coches, deposito, desde, hasta = filtros_historial("Cargas")
 
-    # Mostrar la tabla Tigre en la columna col3
-    with col3:
-        st.markdown('<h3 style="color: red;">Tigre</h3>', unsafe_allow_html=True)
-        if not tigre_data.empty:
-            sorted_tigre_data = tigre_data.sort_values(by='coche', ascending=True)
-            styled_tigre_df = sorted_tigre_data.style.applymap(colorize_litros_servi, subset=['litrosServi'])
-            st.dataframe(styled_tigre_df, hide_index=True)
+        if espejo_sqlite.habilitado():
+            pagina = pagina_del_espejo('cargas_diesel.csv', coches, deposito, desde, hasta, "Cargas")
         else:
-            st.write("No hay datos para Tigre.")
+            # Leer solo los meses del rango elegido (y con fragmentos por depósito, solo los del depósito)
+            elegidos = [deposito] if deposito != "Todos" else depositos_de_la_vista()
+            diesel_data = cargar_con_pendientes('cargas_diesel.csv', meses=meses_entre(desde, hasta), depositos=elegidos)
+            if not diesel_data.empty:
+                diesel_data = filtrar_historial(diesel_data, coches, deposito, desde, hasta)
+
+            # Ordenar por idCarga de mayor a menor y quedarse solo con la página visible
+            pagina = paginar(diesel_data, 'idCarga', "Cargas") if not diesel_data.empty else None
+        if pagina is None or pagina.empty:
+            st.write("No hay cargas para los filtros elegidos.")
+            return
+
+        # litrosServi derivado (el guardado puede ser anterior a un servicio); las
+        # cargas que no están en lo derivado, recién encoladas, muestran lo guardado
+        derivado = pagina['idCarga'].map(litros_servi).fillna(pagina['litrosServi'])
+        pagina = pagina.assign(litrosServi=pd.to_numeric(derivado, downcast='integer'))
 
-def show_diesel_history(diesel_data):
-    with st.expander("Historial de Cargas"):
-        # Ordenar el DataFrame por la columna idCarga de mayor a menor
-        sorted_diesel_data = diesel_data.sort_values(by='idCarga', ascending=False)
-        
-        # Función para determinar el color del texto basado en los valores de litrosServi
-        def colorize_litros_servi(value):
-            if value <= 100:
-                return 'color: red'
-            elif value <= 500:
-                return 'color: yellow'
-            else:
-                return 'color: green'
-        
         # Aplicar el estilo a la columna litrosServi sin mostrar la columna color
-        styled_df = sorted_diesel_data.style.applymap(colorize_litros_servi, subset=['litrosServi'])
-        st.dataframe(styled_df, hide_index=True)
+        styled_df = pagina.style.apply(colores_litros_servi, subset=['litrosServi'])
+        st.dataframe(styled_df, hide_index=True, column_config=COLUMNAS_FECHA)
 
-def service_form(diesel_data, service_data):
+@st.fragment
+@medido('service_form')
+def service_form(estado):
     with st.expander("Registrar Servicio"):
         coche = st.number_input("Número de Coche Servi", min_value=0)
         
-        if coche not in numeros_colectivos:
+        if not coche_en_vista(coche):
             st.info("Ingrese un número de coche válido")
         else:
             fecha = st.date_input("Fecha del Servicio", value=datetime.now().date())
             hora = datetime.now().strftime('%H:%M')
 
-            # Asegúrate de que 'fecha' es una fecha válida y en formato correcto
-            service_data['fecha'] = pd.to_datetime(service_data['fecha'], errors='coerce').dt.strftime('%Y-%m-%d')
-            
-            # Obtener el último servicio del coche basado en idServis
-            last_service = service_data[service_data['coche'] == coche]
+            # Obtener el último servicio y los litros totales del coche desde el estado
+            fila = estado_de_coche(estado, coche)
             
             # Inicializar variables por defecto
             last_service_date = None
             last_service_litros = 0
             
-            if not last_service.empty:
-                last_service = last_service.sort_values(by='idServis', ascending=False).iloc[0]
-                last_service_date = last_service['fecha'] if pd.notna(last_service['fecha']) else 'No disponible'
-                last_service_litros = last_service['litrosTotales'] if pd.notna(last_service['litrosTotales']) else 0
+            if fila is not None and fila['servicios'] > 0:
+                last_service_date = fila['fechaUltimoServi'] if pd.notna(fila['fechaUltimoServi']) else 'No disponible'
+                last_service_litros = fila['litrosUltimoServi'] if pd.notna(fila['litrosUltimoServi']) else 0
                 st.write(f"Último servicio: {last_service_date}, Litros en el último servicio: {last_service_litros}")
             else:
                 st.write("No hay registros de servicio previos para este coche.")
             
-            # Sumar los litros totales del coche
-            litros_cargados = diesel_data[diesel_data['coche'] == coche]['litros'].sum()
+            # Litros totales del coche
+            litros_cargados = fila['litrosTotales'] if fila is not None else 0
 
             service_done = st.checkbox("Servicio Realizado")
 
             if service_done and st.button("Registrar Servicio"):
                 # Crear nueva entrada de servicio
                 new_entry = pd.DataFrame([{
-                    'idServis': len(service_data) + 1,
+                    'idServis': reservar_ids('servicios_realizados.csv')[0],
                     'fecha': fecha.strftime('%Y-%m-%d'),  # Guardamos la fecha en el formato deseado
                     'hora': hora,
                     'coche': coche,
@@ -210,87 +340,309 @@ def service_form(diesel_data, service_data):
                     'litrosUltimoServi': last_service_litros,  # Usamos el valor de litros en el momento del último servicio
                     'fechaAnterior': last_service_date
                 }])
-                service_data = pd.concat([service_data, new_entry], ignore_index=True)
-                update_csv_in_s3(service_data, 'servicios_realizados.csv')
-                
-                # Actualizar litrosServi solo para el coche que se realizó el servicio
-                diesel_data.loc[diesel_data['coche'] == coche, 'litrosServi'] = 5000
-                update_csv_in_s3(diesel_data, 'cargas_diesel.csv')
-
-                st.success("Servicio registrado correctamente")
-
-                # Esperar para recargar la aplicación
-                time.sleep(3)
-                    
+
+                # Solo se agrega el servicio: litrosServi se deriva de los servicios, así
+                # que las cargas del coche no se tocan. Se guarda en segundo plano y la
+                # tabla se actualiza ya
+                seguir_escrituras(encolar([agregar('servicios_realizados.csv', new_entry)]))
+                registrar_servicio(
+                    coche, fecha.strftime('%Y-%m-%d'), hora, litros_cargados,
+                    version_siguiente('servicios_realizados.csv'), depositos_de_la_vista()
+                )
+
+                st.session_state.mensaje = "Servicio registrado correctamente"
+
                 # Recargar la aplicación
                 st.rerun()
 
 # Mostrar tabla de Servicios
+@st.fragment
+@medido('show_service_history')
 def show_service_history(service_data):
     with st.expander("Historial de Servicios"):
-        # Convertir las columnas a enteros
-        service_data['litrosTotales'] = service_data['litrosTotales'].astype(int)
-        service_data['litrosUltimoServi'] = service_data['litrosUltimoServi'].astype(int)
+        coches, deposito, desde, hasta = filtros_historial("Servicios")
+        if not service_data.empty:
+            service_data = filtrar_historial(service_data, coches, deposito, desde, hasta)
+        if service_data.empty:
+            st.write("No hay servicios para los filtros elegidos.")
+            return
+
+        # Ordenar la tabla por 'idServis' y quedarse solo con la página visible
+        pagina = paginar(service_data, 'idServis', "Servicios")
 
-        # Ordenar la tabla por 'idServis'
-        sorted_service_data = service_data.sort_values(by='idServis', ascending=False)
+        # Convertir las columnas a enteros (solo las filas que se muestran)
+        pagina = pagina.astype({'litrosTotales': int, 'litrosUltimoServi': int})
 
         # Aplicar formato a las columnas para mostrar sin comas
-        styled_df = sorted_service_data.style.format({
+        styled_df = pagina.style.format({
             'litrosTotales': '{:.0f}',
             'litrosUltimoServi': '{:.0f}'
         })
 
         # Mostrar la tabla con el estilo aplicado
-        st.dataframe(styled_df, hide_index=True)
+        st.dataframe(styled_df, hide_index=True, column_config=COLUMNAS_FECHA)
+
+# Análisis de consumo por coche y depósito. Se calcula solo con el interruptor
+# prendido y una vez por versión de los datos.
+@st.fragment
+@medido('show_analytics')
+def show_analytics(service_data):
+    with st.expander("Análisis de Consumo"):
+        if not st.toggle("Calcular análisis", key="analisis"):
+            return
+
+        diesel_data = cargar_datos('cargas_diesel.csv', columnas=analitica.COLUMNAS_CARGAS, depositos=depositos_de_la_vista())
+        resultado = analitica.obtener(diesel_data, service_data, depositos_de_la_vista()) if not diesel_data.empty else None
+        if resultado is None:
+            st.write("No hay cargas para analizar.")
+            return
+
+        st.subheader("Por depósito")
+        st.dataframe(resultado['por_deposito'], column_config=COLUMNAS_FECHA_ANALISIS)
+
+        st.subheader("Por coche")
+        st.caption(f"Litros por día en toda la historia y en los últimos {analitica.VENTANA_LARGA} días; "
+                   "el próximo servicio se estima al ritmo reciente.")
+        st.dataframe(resultado['por_coche'].reset_index(), hide_index=True, column_config=COLUMNAS_FECHA_ANALISIS)
+
+        coches = st.multiselect("Consumo móvil de los coches", resultado['por_coche'].index.tolist(), key="cochesAnalisis")
+        if coches:
+            diario = resultado['diario']
+            elegidos = diario[diario['coche'].isin(coches)]
+            columna = f'litros{analitica.VENTANA_LARGA}d'
+            st.line_chart(elegidos.pivot(index='fecha', columns='coche', values=columna))
+
+        anomalias = resultado['anomalias']
+        st.subheader(f"Cargas fuera de lo normal ({len(anomalias)})")
+        if not anomalias.empty:
+            st.dataframe(pagina_descendente(anomalias, 'idCarga', 100, 1), hide_index=True, column_config=COLUMNAS_FECHA)
+
+# Coches que necesitan servicio, tomados del índice de alertas (se mantiene al día
+# con cada escritura, así que no hace falta recorrer el estado ni el historial)
+@st.fragment
+@medido('show_service_due')
+def show_service_due():
+    with st.expander("Coches para Servicio"):
+        vista = depositos_de_la_vista()
+        de_la_vista = set(registro().index[registro()['deposito'].isin(vista)]) if vista is not None else None
+        vencidos = alertas.vencidos(coches=de_la_vista)
+        if not vencidos:
+            st.write("Ningún coche necesita servicio.")
+        else:
+            tabla = pd.DataFrame(vencidos, columns=['litrosServi', 'coche'])[['coche', 'litrosServi']]
+            tabla.insert(1, 'deposito', registro()['deposito'].reindex(tabla['coche']).to_numpy())
+            st.dataframe(tabla.style.apply(colores_litros_servi, subset=['litrosServi']), hide_index=True)
+
+        eventos = pd.DataFrame(alertas.eventos_recientes())
+        if not eventos.empty:
+            st.caption("Últimos cambios de nivel")
+            st.dataframe(eventos, hide_index=True)
+
+# Reportes mensuales o anuales de toda la flota. Se generan recorriendo el historial
+# por bloques (no usan los datos ya cargados, que pueden estar filtrados por depósito).
+# El resultado (una fila por mes o año y coche) queda en memoria en la sesión para
+# descargarlo, sin dejar archivos en el servidor.
+FORMATOS_REPORTE = {'CSV': ('csv', 'text/csv'),
+                    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+
+@st.fragment
+@medido('show_reports')
+def show_reports():
+    with st.expander("Reportes"):
+        col1, col2 = st.columns(2)
+        periodo = col1.radio("Período", ['Mensual', 'Anual'], horizontal=True, key="periodoReporte").lower()
+        formato = col2.radio("Formato", list(FORMATOS_REPORTE), horizontal=True, key="formatoReporte")
+        extension, mime = FORMATOS_REPORTE[formato]
 
-def delete_record(diesel_data, service_data):
-    with st.expander("Eliminar Registros"):
         col1, col2 = st.columns(2)
+        if col1.button("Generar reporte"):
+            with st.spinner("Recorriendo el historial..."):
+                contenido = b''.join(reportes.partes(periodo, extension))
+            st.session_state['reporte'] = (f"reporte-{periodo}-{datetime.now():%Y%m%d}.{extension}", contenido, mime)
+
+        if col2.button("Guardar en S3"):
+            with st.spinner("Subiendo el reporte..."):
+                key = reportes.subir_a_s3(reportes.partes(periodo, extension), reportes.clave_en_s3(periodo, extension))
+            st.success(f"Reporte guardado en {key}")
+
+        reporte = st.session_state.get('reporte')
+        if reporte is not None:
+            nombre, contenido, tipo = reporte
+            st.download_button(f"Descargar {nombre}", contenido, file_name=nombre, mime=tipo)
+
+# Cantidad máxima de IDs que se pueden borrar o corregir de una vez
+MAXIMO_IDS_POR_LOTE = 5000
+
+# IDs escritos como "10, 15-20"
+def parsear_ids(texto):
+    ids = set()
+    for parte in texto.replace(';', ',').split(','):
+        parte = parte.strip()
+        if not parte:
+            continue
+        desde, _, hasta = parte.partition('-')
+        desde = int(desde)
+        hasta = int(hasta) if hasta.strip() else desde
+        if hasta < desde:
+            raise ValueError(f"el rango {parte} está al revés")
+        if len(ids) + hasta - desde + 1 > MAXIMO_IDS_POR_LOTE:
+            raise ValueError(f"se pueden elegir hasta {MAXIMO_IDS_POR_LOTE} IDs por vez")
+        ids.update(range(desde, hasta + 1))
+    return sorted(ids)
+
+# Encola las bajas y correcciones de un archivo y actualiza el estado solo de los
+# coches afectados (con el otro historial, porque litrosServi depende de los dos)
+def guardar_cambios(filename, data, ids_borrados, corregidas=None):
+    columna_id = COLUMNAS_ID[filename]
+    borradas = data[columna_id].isin(ids_borrados)
+    nueva = data[~borradas]
+    afectados = set(data.loc[borradas, 'coche'])
+    if corregidas is not None:
+        # Se valida antes de encolar: una fila que no se puede guardar quedaría reintentándose
+        corregidas = aplicar(corregidas.copy(), filename)
+        if filename == 'cargas_diesel.csv':
+            litros = corregidas['litros']
+            if litros.isna().any() or ((litros <= 0) | (litros > capacidades(corregidas['coche']))).any():
+                raise ValueError("Litros fuera de rango (1 a la capacidad del coche)")
+        afectados |= set(data.loc[data[columna_id].isin(corregidas[columna_id]), 'coche']) | set(corregidas['coche'])
+        nueva = quitar_repetidas(concatenar([nueva, corregidas], filename), filename)
+    nueva = nueva.reset_index(drop=True)
+
+    operaciones = [borrar(filename, ids_borrados)] if len(ids_borrados) else []
+    if corregidas is not None and not corregidas.empty:
+        operaciones.append(corregir(filename, corregidas))
+    if not operaciones:
+        return
+    seguir_escrituras(encolar(operaciones))
+
+    version = version_siguiente(filename)
+    vista = depositos_de_la_vista()
+    if filename == 'cargas_diesel.csv':
+        service_data = cargar_datos('servicios_realizados.csv')
+        for coche in afectados:
+            recalcular_cargas_de_coche(coche, nueva, service_data, version, vista)
+    else:
+        diesel_data = cargar_datos('cargas_diesel.csv', columnas=COLUMNAS_CARGAS)
+        for coche in afectados:
+            recalcular_servicios_de_coche(coche, diesel_data, nueva, version, vista)
+
+# Bajas y correcciones en lote de un historial: se eligen IDs o rangos, se pueden
+# editar las filas encontradas y se guardan todas juntas
+def editar_registros(filename, titulo, no_editables):
+    st.subheader(titulo)
+    columna_id = COLUMNAS_ID[filename]
+    texto = st.text_input("IDs (por ejemplo 10, 15-20)", key=f"ids{columna_id}")
+    if not texto.strip():
+        return
 
-        # Columna para eliminar registros de carga
-        with col1:
-            st.subheader("Eliminar Registro de Carga")
-            id_carga = st.number_input("Ingrese el ID de Carga", min_value=0, key="idCarga")
-            
-            if id_carga > 0:
-                carga_info = diesel_data[diesel_data['idCarga'] == id_carga]
-                if not carga_info.empty:
-                    st.write(carga_info)
-                    if st.button("Eliminar Carga", key="deleteCarga"):
-                        diesel_data = diesel_data[diesel_data['idCarga'] != id_carga]  # Eliminar la carga
-                        update_csv_in_s3(diesel_data, 'cargas_diesel.csv')
-                        st.success(f"Registro de carga con ID {id_carga} eliminado correctamente.")
-                else:
-                    st.warning("No se encontró un registro de carga con ese ID.")
-
-        # Columna para eliminar registros de servicio
-        with col2:
-            st.subheader("Eliminar Registro de Servicio")
-            id_servis = st.number_input("Ingrese el ID de Servicio", min_value=0, key="idServis")
-
-            if id_servis > 0:
-                servis_info = service_data[service_data['idServis'] == id_servis]
-                if not servis_info.empty:
-                    st.write(servis_info)
-                    if st.button("Eliminar Servicio", key="deleteServicio"):
-                        service_data = service_data[service_data['idServis'] != id_servis]  # Eliminar el servicio
-                        update_csv_in_s3(service_data, 'servicios_realizados.csv')
-                        st.success(f"Registro de servicio con ID {id_servis} eliminado correctamente.")
-                else:
-                    st.warning("No se encontró un registro de servicio con ese ID.")
+    try:
+        ids = parsear_ids(texto)
+    except ValueError as e:
+        st.error(f"IDs inválidos: {e}")
+        return
+
+    # Se lee toda la flota: una corrección puede pasar la fila a un coche de otro depósito
+    data = cargar_datos(filename)
+    encontradas = filas_por_id(data, filename, ids) if not data.empty else data
+    if encontradas.empty:
+        st.warning("No se encontraron registros con esos IDs.")
+        return
+
+    st.caption(f"{len(encontradas)} registros encontrados de {len(ids)} IDs pedidos")
+    editables = encontradas[columnas_guardadas(encontradas)].astype({'hora': object})
+    editadas = st.data_editor(
+        editables, hide_index=True, disabled=[columna_id] + no_editables,
+        column_config=COLUMNAS_FECHA, key=f"editor{columna_id}{texto}"
+    )
+
+    col1, col2 = st.columns(2)
+    if col1.button(f"Eliminar {len(encontradas)} registros", key=f"borrar{columna_id}"):
+        guardar_cambios(filename, data, encontradas[columna_id].tolist())
+        st.session_state.mensaje = f"Se eliminaron {len(encontradas)} registros."
+        st.rerun()
+    if col2.button("Guardar correcciones", key=f"corregir{columna_id}"):
+        try:
+            guardar_cambios(filename, data, [], editadas)
+        except ValueError as e:
+            st.error(f"No se pudieron guardar las correcciones: {e}")
+            return
+        st.session_state.mensaje = f"Se corrigieron {len(editadas)} registros."
+        st.rerun()
+
+@st.fragment
+@medido('delete_record')
+def delete_record():
+    with st.expander("Eliminar o Corregir Registros"):
+        # litrosServi se deriva de los litros de cada carga y de los servicios
+        editar_registros('cargas_diesel.csv', "Registros de Carga", ['litrosServi'])
+        editar_registros('servicios_realizados.csv', "Registros de Servicio", [])
+
+# Panel de rendimiento: tiempos del rerun actual, percentiles acumulados y caché
+def mostrar_panel_metricas():
+    with st.expander("Rendimiento"):
+        registros = pd.DataFrame(metricas.registros_del_rerun())
+        st.write(f"Este rerun: {metricas.duracion_del_rerun() * 1000:.0f} ms")
+        if not registros.empty:
+            por_operacion = registros.groupby(['tipo', 'nombre'], as_index=False).agg(
+                llamadas=('ms', 'size'), ms=('ms', 'sum'), bytes=('bytes', 'sum')
+            )
+            st.dataframe(por_operacion.sort_values('ms', ascending=False).round(1), hide_index=True)
+
+        resumen = pd.DataFrame(metricas.resumen())
+        if not resumen.empty:
+            st.write(f"Últimas mediciones del proceso (hasta {metricas.VENTANA} por operación), "
+                     f"{resumen['bytes'].sum() / 1_000_000:.1f} MB transferidos")
+            st.dataframe(resumen, hide_index=True)
+
+        estadisticas = cache_stats()
+        st.write(f"Caché de S3: {estadisticas['hits']} aciertos, {estadisticas['misses']} descargas completas, "
+                 f"{estadisticas['incrementales']} lecturas de solo lo agregado")
+
+        st.download_button("Exportar mediciones", metricas.exportar_jsonl(),
+                           file_name="metricas.jsonl", mime="application/jsonl")
 
 # Función Principal
 def main():
-    # Cargar los datos
-    diesel_data = load_csv_from_s3('cargas_diesel.csv')
-    service_data = load_csv_from_s3('servicios_realizados.csv')
+    metricas.iniciar_rerun()
+
+    if 'mensaje' in st.session_state:
+        st.success(st.session_state.pop('mensaje'))
+
+    # Mientras haya escrituras de esta sesión sin confirmar, el aviso se refresca solo
+    if st.session_state.get('escrituras'):
+        st.fragment(mostrar_estado_escrituras, run_every=2)()
+
+    if BACKEND == 'depositos':
+        st.sidebar.multiselect("Depósitos", depositos(), default=depositos(), key="vista")
+    vista = depositos_de_la_vista()
+
+    # Con el espejo SQLite, la primera vez se crea la base y arranca la sincronización
+    espejo_sqlite.iniciar()
+
+    # Cargar los datos (del historial de cargas alcanzan las columnas que usa el estado)
+    diesel_data = cargar_datos('cargas_diesel.csv', columnas=COLUMNAS_CARGAS, depositos=vista)
+    service_data = cargar_datos('servicios_realizados.csv', depositos=vista)
+
+    # Estado por coche y litrosServi de cada carga, armados una vez por versión de los datos de la vista
+    estado = obtener_estado(diesel_data, service_data, vista)
+    litros_servi = obtener_litros_servi(diesel_data, service_data, vista)[0]
+
+    # Formulario de cargas y, a la derecha, las tablas de cada depósito
+    col1, col2 = st.columns(2)
+    with col1:
+        diesel_form(estado)
+    with col2:
+        tablero(estado)
 
-    # Llamar a las funciones que gestionan el formulario, la eliminación, y la visualización
-    diesel_form(diesel_data)
-    service_form(diesel_data, service_data)
+    # Llamar a las funciones que gestionan el historial, la importación, los servicios y la eliminación
+    show_diesel_history(litros_servi)
+    bulk_import_form(estado)
+    service_form(estado)
     show_service_history(service_data)
-    delete_record(diesel_data, service_data)
+    show_service_due()
+    show_analytics(service_data)
+    show_reports()
+    delete_record()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,262 @@
+# benchmark.py
+#
+# Mide las operaciones principales de la app sobre historiales sintéticos servidos
+# desde el reemplazo local de S3 (s3_local.py), sin tocar AWS ni los secrets.
+#
+#   python benchmark.py --tamanos 10000 100000 --salida bench.json
+#   python benchmark.py --tamanos 10000 100000 --comparar bench.json
+#
+# Con --comparar se informa la relación contra un reporte anterior y el proceso
+# termina con código 1 si alguna operación empeoró más que la tolerancia.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+import recursos
+
+BUCKET = 'benchmark'
+
+# Generador de historiales: cargas repartidas en el tiempo entre los coches de la
+# flota, con un servicio cada vez que un coche consume LITROS_SERVICIO
+def generar_historial(cantidad_cargas, flota, semilla=0, desde=date(2020, 1, 1)):
+    from flota import LITROS_SERVICIO
+
+    rng = np.random.default_rng(semilla)
+    flota = np.asarray(flota)
+
+    # Fechas ordenadas a lo largo de varios años, aproximadamente una carga por coche por día
+    dias = max(cantidad_cargas // len(flota), 1)
+    segundos = np.sort(rng.integers(0, dias * 86400, cantidad_cargas))
+    momentos = pd.Timestamp(desde) + pd.to_timedelta(segundos, unit='s')
+
+    cargas = pd.DataFrame({
+        'idCarga': np.arange(1, cantidad_cargas + 1),
+        'fecha': momentos.strftime('%Y-%m-%d'),
+        'hora': momentos.strftime('%H:%M'),
+        'coche': rng.choice(flota, cantidad_cargas),
+        'litros': rng.integers(80, 300, cantidad_cargas),
+    })
+
+    # Tramo de servicio de cada carga y litros restantes dentro del tramo
+    acumulado = cargas.groupby('coche')['litros'].cumsum()
+    tramo = (acumulado - 1) // LITROS_SERVICIO
+    cargas['litrosServi'] = LITROS_SERVICIO * (tramo + 1) - acumulado
+
+    # Un servicio en la última carga de cada tramo completo
+    ultima_del_tramo = ~cargas.assign(tramo=tramo).duplicated(subset=['coche', 'tramo'], keep='last')
+    con_servicio = cargas[ultima_del_tramo & (cargas['litrosServi'] < 300)]
+    servicios = pd.DataFrame({
+        'idServis': np.arange(1, len(con_servicio) + 1),
+        'fecha': con_servicio['fecha'].values,
+        'hora': con_servicio['hora'].values,
+        'coche': con_servicio['coche'].values,
+        'litrosTotales': acumulado[con_servicio.index].values,
+    })
+    anteriores = servicios.groupby('coche')
+    servicios['litrosUltimoServi'] = anteriores['litrosTotales'].shift(fill_value=0).values
+    servicios['fechaAnterior'] = anteriores['fecha'].shift().values
+    return cargas, servicios
+
+# En lugar de los secrets se inyecta una configuración que usa una carpeta
+# temporal como S3 (antes de importar storage, que lee el backend al importarse).
+# La cola de escritura usa un journal propio en esa carpeta.
+def preparar_entorno(carpeta, backend):
+    recursos.inyectar(
+        configuracion=('', '', 'us-east-1', BUCKET, 'benchmark', 'benchmark'),
+        opciones={
+            's3_local_dir': carpeta, 'storage_backend': backend,
+            'cola_escritura_journal': os.path.join(carpeta, 'cola_escritura.jsonl'),
+        }
+    )
+
+    import cola_escritura
+    import storage
+    from streamlit import logger
+
+    # Se mide la escritura, no la espera para juntar operaciones en un lote
+    cola_escritura.VENTANA_LOTE = 0
+
+    # Fuera de "streamlit run" cada elemento avisa que no hay ScriptRunContext
+    logger.set_log_level('error')
+    return storage
+
+def subir_historial(storage, cargas, servicios):
+    s3 = recursos.cliente_s3()
+    s3.put_object(Bucket=BUCKET, Key='cargas_diesel.csv', Body=cargas.to_csv(index=False))
+    s3.put_object(Bucket=BUCKET, Key='servicios_realizados.csv', Body=servicios.to_csv(index=False))
+    if storage.BACKEND == 'parquet':
+        import storage_parquet
+        for archivo in ['cargas_diesel.csv', 'servicios_realizados.csv']:
+            storage_parquet.migrar_desde_csv(archivo)
+    if storage.BACKEND == 'depositos':
+        import storage_depositos
+        for archivo in ['cargas_diesel.csv', 'servicios_realizados.csv']:
+            storage_depositos.migrar_desde_csv(archivo)
+
+def limpiar_cache(storage):
+    with storage._cache_lock:
+        storage._cache.clear()
+        storage._cache_combinado.clear()
+        storage._colas.clear()
+
+def medir(funcion, repeticiones, antes=None):
+    tiempos = []
+    for _ in range(repeticiones):
+        if antes is not None:
+            antes()
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return {'mediana': statistics.median(tiempos), 'minimo': min(tiempos), 'repeticiones': repeticiones}
+
+def correr(tamano, flota, repeticiones, storage):
+    import app
+    import cola_escritura
+    import estado_coches
+    from flota import depositos
+
+    cargas, servicios = generar_historial(tamano, flota)
+    subir_historial(storage, cargas, servicios)
+    limpiar_cache(storage)
+
+    diesel = storage.load_csv_from_s3('cargas_diesel.csv', columnas=estado_coches.COLUMNAS_CARGAS)
+    service = storage.load_csv_from_s3('servicios_realizados.csv')
+    estado = estado_coches.obtener_estado(diesel, service)
+    coche = int(flota[0])
+    siguiente_id = [tamano + 1]
+
+    def nueva_carga():
+        fila = pd.DataFrame([{
+            'idCarga': siguiente_id[0], 'fecha': datetime.now().strftime('%Y-%m-%d'),
+            'hora': datetime.now().strftime('%H:%M'), 'coche': coche, 'litros': 100, 'litrosServi': 4900
+        }])
+        siguiente_id[0] += 1
+        return fila
+
+    def registrar_servicio():
+        fila = estado_coches.estado_de_coche(estado, coche)
+        storage.append_csv_to_s3(pd.DataFrame([{
+            'idServis': len(servicios) + siguiente_id[0], 'fecha': datetime.now().strftime('%Y-%m-%d'),
+            'hora': datetime.now().strftime('%H:%M'), 'coche': coche,
+            'litrosTotales': fila['litrosTotales'], 'litrosUltimoServi': fila['litrosUltimoServi'],
+            'fechaAnterior': fila['fechaUltimoServi']
+        }]), 'servicios_realizados.csv')
+
+    # Como delete_record: se encola una lápida, se recalcula el coche de la carga y se
+    # espera a que la cola la guarde en S3 (delete_rows_in_s3). Cada vez, otra carga.
+    borrables = iter(cargas['idCarga'].iloc[len(cargas) // 2:].tolist())
+
+    def eliminar():
+        id_carga = next(borrables)
+        borradas = diesel['idCarga'] == id_carga
+        cola_escritura.encolar([cola_escritura.borrar('cargas_diesel.csv', [id_carga])])
+        version = cola_escritura.version_esperada('cargas_diesel.csv')
+        for coche_de_la_carga in set(diesel.loc[borradas, 'coche']):
+            estado_coches.recalcular_cargas_de_coche(coche_de_la_carga, diesel[~borradas], service, version)
+        cola_escritura.vaciar()
+
+    completo = storage.load_csv_from_s3('cargas_diesel.csv')
+    operaciones = {
+        'load_csv_from_s3 (sin caché)': (lambda: storage.load_csv_from_s3('cargas_diesel.csv'), lambda: limpiar_cache(storage)),
+        'load_csv_from_s3 (con caché)': (lambda: storage.load_csv_from_s3('cargas_diesel.csv'), None),
+        'load_csv_from_s3 (columnas del estado)': (
+            lambda: storage.load_csv_from_s3('cargas_diesel.csv', columnas=estado_coches.COLUMNAS_CARGAS), None
+        ),
+        'load_csv_from_s3 (un depósito)': (
+            lambda: storage.load_csv_from_s3('cargas_diesel.csv', depositos=depositos()[:1]), lambda: limpiar_cache(storage)
+        ),
+        'append_csv_to_s3 (una carga)': (lambda: storage.append_csv_to_s3(nueva_carga(), 'cargas_diesel.csv'), None),
+        'update_csv_in_s3 (archivo completo)': (
+            lambda: storage.update_csv_in_s3(storage.load_csv_from_s3('cargas_diesel.csv'), 'cargas_diesel.csv'), None
+        ),
+        'compact_csv_in_s3': (lambda: storage.compact_csv_in_s3('cargas_diesel.csv'), None),
+        'construir_estado': (lambda: estado_coches.construir_estado(diesel, service), None),
+        'derivar_litros_servi': (lambda: estado_coches.derivar_litros_servi(diesel, service), None),
+        'show_custom_tables': (lambda: app.show_custom_tables(estado), None),
+        'service_form (registrar servicio)': (registrar_servicio, None),
+        'delete_record (eliminar carga)': (eliminar, None),
+        'historial (filtro + página)': (
+            lambda: app.pagina_descendente(
+                app.filtrar_historial(completo, [], 'Todos', date(2000, 1, 1), date.today()), 'idCarga', 50, 1
+            ), None
+        ),
+    }
+
+    resultados = {}
+    for nombre, (funcion, antes) in operaciones.items():
+        resultados[nombre] = medir(funcion, repeticiones, antes)
+        print(f"  {nombre:<42} {resultados[nombre]['mediana'] * 1000:10.1f} ms")
+    return resultados
+
+def comparar(reporte, anterior, tolerancia):
+    regresiones = []
+    print("\nComparación contra el reporte anterior (actual / anterior):")
+    if anterior.get('backend') != reporte['backend'] or anterior.get('flota') != reporte['flota']:
+        print(f"  Atención: el reporte anterior usó backend {anterior.get('backend')} y {anterior.get('flota')} coches")
+    for tamano, operaciones in reporte['resultados'].items():
+        for nombre, medida in operaciones.items():
+            previa = anterior.get('resultados', {}).get(tamano, {}).get(nombre)
+            if previa is None or previa['mediana'] == 0:
+                continue
+            relacion = medida['mediana'] / previa['mediana']
+            marca = '  REGRESIÓN' if relacion > tolerancia else ''
+            print(f"  {tamano:>8} {nombre:<42} {relacion:6.2f}x{marca}")
+            if marca:
+                regresiones.append((tamano, nombre, relacion))
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la app de cargas de diésel")
+    parser.add_argument('--tamanos', type=int, nargs='+', default=[10_000, 100_000],
+                        help="cantidades de cargas a generar")
+    parser.add_argument('--flota', type=int, default=None,
+                        help="cantidad de coches (por defecto, la del registro de la flota)")
+    parser.add_argument('--backend', choices=['csv', 'parquet', 'depositos'], default='csv')
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--salida', help="archivo JSON donde guardar el reporte")
+    parser.add_argument('--comparar', help="reporte JSON anterior contra el cual comparar")
+    parser.add_argument('--tolerancia', type=float, default=1.25,
+                        help="relación actual/anterior a partir de la cual se marca una regresión")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        storage = preparar_entorno(carpeta, args.backend)
+
+        from flota import coches
+        flota = list(range(1, args.flota + 1)) if args.flota else coches()
+
+        reporte = {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'backend': args.backend,
+            'flota': len(flota),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'resultados': {},
+        }
+        for tamano in args.tamanos:
+            print(f"\n{tamano} cargas, {len(flota)} coches, backend {args.backend}:")
+            reporte['resultados'][str(tamano)] = correr(tamano, flota, args.repeticiones, storage)
+        reporte['cache'] = storage.cache_stats()
+
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+
+    if args.comparar:
+        with open(args.comparar) as f:
+            anterior = json.load(f)
+        if comparar(reporte, anterior, args.tolerancia):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
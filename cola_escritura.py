@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from esquema import aplicar, columnas_guardadas, concatenar, vacio
+from recursos import opcion
+from storage import (
+    COLUMNAS_ID, load_csv_from_s3, append_csv_to_s3, delete_rows_in_s3, correct_rows_in_s3,
+    filtrar, quitar_repetidas
+)
+
+# Escritura diferida (write-behind): los formularios encolan sus cambios y siguen,
+# y un hilo en segundo plano los guarda en S3.
+#
+# - Cada operación se anota primero en un journal local (JSON lines), así si el
+#   proceso se reinicia antes de guardarla se vuelve a encolar al arrancar.
+# - El hilo junta todo lo pendiente en un lote: las altas, correcciones y bajas
+#   seguidas de un mismo archivo se guardan cada una en una sola escritura,
+#   respetando el orden.
+# - Los archivos se escriben en paralelo. Si una escritura falla, sus operaciones
+#   quedan pendientes y se reintentan con espera creciente.
+# - Mientras tanto, las lecturas de la app (cargar_con_pendientes) aplican encima
+#   lo que todavía no llegó a S3, así el operador ve sus cambios enseguida.
+
+JOURNAL = opcion('cola_escritura_journal', 'cola_escritura.jsonl')
+
+# Tiempo que espera el hilo para juntar operaciones que llegan casi juntas
+VENTANA_LOTE = 0.3
+
+ESPERA_MAXIMA_REINTENTO = 60
+
+# Cuántos estados de operaciones ya terminadas se recuerdan para mostrarlos
+ESTADOS_RECORDADOS = 1000
+
+# Tipos de operación (ver agregar, corregir y borrar)
+TIPOS = ('agregar', 'corregir', 'borrar')
+
+_pendientes = []
+_estados = OrderedDict()
+_ultimo_error = {'mensaje': None}
+_versiones_leidas = {}
+_lock = threading.Lock()
+_cambio = threading.Condition(_lock)
+_journal_lock = threading.Lock()
+_hilo = {'hilo': None}
+_suscriptores = []
+
+# Valores de pandas/numpy a tipos que se pueden guardar en JSON
+def _a_json(valor):
+    if isinstance(valor, np.generic):
+        valor = valor.item()
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if valor is not None and not isinstance(valor, (list, dict)) and pd.isna(valor):
+        return None
+    return valor
+
+def agregar(filename, filas):
+    return {
+        'archivo': filename,
+        'tipo': 'agregar',
+        'filas': [{k: _a_json(v) for k, v in fila.items()} for fila in filas[columnas_guardadas(filas)].to_dict('records')],
+    }
+
+# Reemplaza por ID filas que ya existen
+def corregir(filename, filas):
+    operacion = agregar(filename, filas)
+    operacion['tipo'] = 'corregir'
+    return operacion
+
+def borrar(filename, ids):
+    return {'archivo': filename, 'tipo': 'borrar', 'ids': [_a_json(i) for i in ids]}
+
+def _anotar(registros):
+    with _journal_lock, open(JOURNAL, 'a', encoding='utf-8') as f:
+        f.writelines(json.dumps(r, ensure_ascii=False) + '\n' for r in registros)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _recordar_estado(id_operacion, estado):
+    _estados[id_operacion] = estado
+    _estados.move_to_end(id_operacion)
+    while len(_estados) > ESTADOS_RECORDADOS:
+        _estados.popitem(last=False)
+
+# "funcion" recibe cada grupo de operaciones encoladas, en el mismo hilo y antes
+# de que encolar devuelva (por ejemplo, para aplicarlas en un espejo local)
+def suscribir(funcion):
+    with _lock:
+        if funcion not in _suscriptores:
+            _suscriptores.append(funcion)
+
+# Encola las operaciones (en orden) y devuelve sus IDs para seguir su estado
+def encolar(operaciones):
+    for operacion in operaciones:
+        operacion['id'] = uuid.uuid4().hex
+
+    # Con el lock tomado, para que el journal no se limpie entre la anotación y la cola
+    with _cambio:
+        _anotar([{'operacion': operacion} for operacion in operaciones])
+        _pendientes.extend(operaciones)
+        for operacion in operaciones:
+            _recordar_estado(operacion['id'], 'pendiente')
+        _cambio.notify_all()
+        suscriptores = list(_suscriptores)
+    for funcion in suscriptores:
+        funcion(operaciones)
+    _iniciar_hilo()
+    return [operacion['id'] for operacion in operaciones]
+
+def estado_de(ids):
+    with _lock:
+        return {i: _estados.get(i, 'confirmada') for i in ids}
+
+def resumen():
+    with _lock:
+        return {'pendientes': len(_pendientes), 'error': _ultimo_error['mensaje']}
+
+# Espera a que no quede nada pendiente; devuelve False si se venció el tiempo
+def vaciar(timeout=30):
+    limite = time.monotonic() + timeout
+    with _cambio:
+        while _pendientes:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return False
+            _cambio.wait(restante)
+    return True
+
+# Aplica las operaciones sobre un DataFrame, en orden
+def _aplicar(data, filename, operaciones):
+    columna_id = COLUMNAS_ID.get(filename)
+    for operacion in operaciones:
+        if operacion['tipo'] in ('agregar', 'corregir'):
+            filas = aplicar(pd.DataFrame(operacion['filas']), filename)
+            if not data.columns.empty:
+                filas = filas[[c for c in data.columns if c in filas.columns]]
+            data = concatenar([data, filas], filename) if not data.empty else filas
+        elif columna_id in data.columns:
+            data = data[~data[columna_id].isin(operacion['ids'])]
+
+    # Una operación reaplicada sobre datos que ya la incluían no duplica filas, y
+    # una corrección queda en el lugar de la fila que corrige
+    return quitar_repetidas(data.reset_index(drop=True), filename)
+
+def _guardar_archivo(filename, operaciones):
+    # Cada tramo de operaciones seguidas del mismo tipo se guarda en una sola escritura
+    tramos = []
+    for operacion in operaciones:
+        if tramos and tramos[-1][0] == operacion['tipo']:
+            tramos[-1][1].append(operacion)
+        else:
+            tramos.append((operacion['tipo'], [operacion]))
+    for tipo, tramo in tramos:
+        if tipo == 'borrar':
+            delete_rows_in_s3(filename, [i for operacion in tramo for i in operacion['ids']])
+            continue
+        filas = pd.concat([pd.DataFrame(operacion['filas']) for operacion in tramo], ignore_index=True)
+        if tipo == 'agregar':
+            append_csv_to_s3(filas, filename)
+        else:
+            correct_rows_in_s3(filas, filename)
+
+def _guardar_lote(lote):
+    por_archivo = {}
+    for operacion in lote:
+        por_archivo.setdefault(operacion['archivo'], []).append(operacion)
+
+    confirmadas, errores = [], []
+    with ThreadPoolExecutor(max_workers=len(por_archivo)) as executor:
+        futuros = {executor.submit(_guardar_archivo, f, ops): ops for f, ops in por_archivo.items()}
+        for futuro, operaciones in futuros.items():
+            try:
+                futuro.result()
+                confirmadas.extend(operaciones)
+            except Exception as e:
+                logging.exception("No se pudo guardar en %s", operaciones[0]['archivo'])
+                errores.append(f"{operaciones[0]['archivo']}: {e}")
+
+    if confirmadas:
+        _anotar([{'confirmada': operacion['id']} for operacion in confirmadas])
+    return confirmadas, errores
+
+def _trabajar():
+    intento = 0
+    while True:
+        with _cambio:
+            while not _pendientes:
+                _cambio.wait()
+        time.sleep(VENTANA_LOTE)
+
+        with _lock:
+            lote = list(_pendientes)
+        confirmadas, errores = _guardar_lote(lote)
+
+        ids = {operacion['id'] for operacion in confirmadas}
+        with _cambio:
+            _pendientes[:] = [operacion for operacion in _pendientes if operacion['id'] not in ids]
+            for id_operacion in ids:
+                _recordar_estado(id_operacion, 'confirmada')
+            _ultimo_error['mensaje'] = '; '.join(errores) or None
+            for operacion in lote:
+                if operacion['id'] not in ids:
+                    _recordar_estado(operacion['id'], 'error' if errores else 'pendiente')
+            vacia = not _pendientes
+            _cambio.notify_all()
+
+        if vacia:
+            _limpiar_journal()
+        if errores:
+            intento += 1
+            time.sleep(min(2 ** intento, ESPERA_MAXIMA_REINTENTO))
+        else:
+            intento = 0
+
+# Cuando todo está confirmado el journal ya no hace falta
+def _limpiar_journal():
+    with _lock, _journal_lock:
+        if not _pendientes:
+            open(JOURNAL, 'w').close()
+
+def _iniciar_hilo():
+    with _lock:
+        if _hilo['hilo'] is None:
+            _hilo['hilo'] = threading.Thread(target=_trabajar, name='cola-escritura', daemon=True)
+            _hilo['hilo'].start()
+
+# Al arrancar, las operaciones del journal sin confirmar vuelven a la cola
+def _recuperar():
+    if not os.path.exists(JOURNAL):
+        return
+    operaciones, confirmadas = [], set()
+    with open(JOURNAL, encoding='utf-8') as f:
+        for linea in f:
+            try:
+                registro = json.loads(linea)
+            except json.JSONDecodeError:
+                continue  # Última línea cortada por una caída
+            if 'operacion' in registro:
+                operaciones.append(registro['operacion'])
+            else:
+                confirmadas.add(registro['confirmada'])
+
+    pendientes = [operacion for operacion in operaciones if operacion['id'] not in confirmadas]
+    # Las asignaciones de litrosServi de versiones anteriores ya no hacen falta:
+    # ahora se deriva de las cargas y los servicios
+    descartadas = [operacion for operacion in pendientes if operacion['tipo'] not in TIPOS]
+    if descartadas:
+        logging.warning("Se descartan %s operaciones del journal de un tipo que ya no se usa", len(descartadas))
+        pendientes = [operacion for operacion in pendientes if operacion['tipo'] in TIPOS]
+    if pendientes:
+        with _cambio:
+            _pendientes.extend(pendientes)
+            for operacion in pendientes:
+                _recordar_estado(operacion['id'], 'pendiente')
+            # Por si el hilo ya estaba esperando operaciones
+            _cambio.notify_all()
+        _iniciar_hilo()
+
+# Lee desde S3 y aplica encima lo que todavía está en la cola. La versión incluye
+# las operaciones pendientes, así el estado por coche se rearma cuando cambian.
+def cargar_con_pendientes(filename, columnas=None, meses=None, depositos=None):
+    # Se toma la cola antes de leer: si algo se guarda en el medio, reaplicarlo no cambia nada
+    with _lock:
+        operaciones = [operacion for operacion in _pendientes if operacion['archivo'] == filename]
+
+    data = load_csv_from_s3(filename, columnas, meses, depositos)
+    version = data.attrs.get('version')
+    # La de S3 sola, sin lo pendiente (el espejo SQLite la usa para ver si escribió otro proceso)
+    data.attrs['version_s3'] = version
+    with _lock:
+        _versiones_leidas[(filename, _clave_depositos(depositos))] = version
+    if not operaciones:
+        return data
+
+    atributos = dict(data.attrs)
+    # Sin filas (ningún mes leído, o un error al leer) puede venir sin columnas
+    if data.empty:
+        data = vacio(filename, columnas)
+    data = _aplicar(data.copy(), filename, operaciones)
+    if meses is not None or depositos is not None:
+        data = filtrar(data, meses=meses, depositos=depositos)
+    data.attrs.update(atributos)
+    data.attrs['version'] = (version, tuple(operacion['id'] for operacion in operaciones))
+    return data
+
+def _clave_depositos(depositos):
+    return tuple(depositos) if depositos is not None else None
+
+# Versión que va a tener "filename" (leído con esos depósitos) en la próxima lectura
+# si nadie más escribe
+def version_esperada(filename, depositos=None):
+    clave = (filename, _clave_depositos(depositos))
+    with _lock:
+        if clave not in _versiones_leidas:
+            return None
+        ids = tuple(operacion['id'] for operacion in _pendientes if operacion['archivo'] == filename)
+        return (_versiones_leidas[clave], ids) if ids else _versiones_leidas[clave]
+
+_recuperar()
@@ -25,4 +25,8 @@ def cargar_configuracion():
     users = st.secrets["users"]
     passwords = st.secrets["passwords"]
 
-    return aws_access_key, aws_secret_key, region_name, bucket_name, users, passwords
\ No newline at end of file
+    return aws_access_key, aws_secret_key, region_name, bucket_name, users, passwords
+
+# Opciones que no son obligatorias en los secrets
+def cargar_opcion(nombre, defecto=None):
+    return st.secrets.get(nombre, defecto)
@@ -0,0 +1,35 @@
+import pytest
+
+import recursos
+
+# Las pruebas usan una carpeta temporal como S3 (ver s3_local.py) en lugar de AWS
+# y los secrets. Los módulos que leen opciones al importarse se importan después
+# de inyectarlas, y los cachés de todo el proceso se vacían en cada prueba.
+
+BUCKET = 'pruebas'
+
+@pytest.fixture
+def entorno(tmp_path):
+    recursos.inyectar(
+        configuracion=('', '', 'us-east-1', BUCKET, 'pruebas', 'pruebas'),
+        opciones={
+            's3_local_dir': str(tmp_path / 's3'),
+            'storage_backend': 'csv',
+            'cola_escritura_journal': str(tmp_path / 'cola_escritura.jsonl'),
+        }
+    )
+    import flota
+    import storage
+    import alertas
+    import estado_coches
+
+    storage.BACKEND = 'csv'
+    flota._flota.clear()
+    for estado in (storage._cache, storage._cache_combinado, storage._colas, storage._bloques_ids):
+        estado.clear()
+    estado_coches._estados.clear()
+    estado_coches._derivados.clear()
+    alertas._litros.clear()
+    alertas._indice.clear()
+    alertas._eventos.clear()
+    return tmp_path
@@ -0,0 +1,283 @@
+import logging
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+import cola_escritura
+from esquema import ESQUEMAS, aplicar
+from metricas import medir
+from recursos import opcion
+from storage import COLUMNAS_ID, filtrar, quitar_repetidas
+
+# Espejo local (opcional): con la opción "espejo_sqlite" (ruta del archivo) las
+# cargas y los servicios se guardan también en una base SQLite con índices por ID,
+# coche y fecha, y la app lee de ahí en lugar de S3.
+#
+# - Las escrituras de la cola (cola_escritura) se aplican en el espejo en el mismo
+#   momento en que se encolan; el envío a S3 sigue siendo el de la cola (journal
+#   local y reintentos), así que si S3 está lento o no responde se sigue trabajando.
+# - Un hilo trae cada INTERVALO_SINCRONIZACION segundos lo que escribieron otros
+#   procesos: solo si la versión en S3 cambió, compara con la tabla y aplica las
+#   filas que difieren (las escrituras propias ya estaban, así que no cambian nada).
+# - Las lecturas completas se guardan en memoria por versión local, así que los
+#   reruns sin cambios no consultan la base.
+
+RUTA = opcion('espejo_sqlite')
+
+INTERVALO_SINCRONIZACION = 10
+
+ARCHIVOS = ['cargas_diesel.csv', 'servicios_realizados.csv']
+
+_local = threading.local()
+_lock = threading.Lock()
+_versiones = {}
+_cache = {}
+_encolado_durante_sincronizacion = {}
+_hilo = {'hilo': None}
+
+def habilitado():
+    return bool(RUTA)
+
+def _tabla(filename):
+    return filename.rsplit('.', 1)[0]
+
+def _columnas(filename):
+    return list(ESQUEMAS[filename])
+
+# Una conexión por hilo (sqlite3 no comparte conexiones entre hilos)
+def _conexion():
+    conexion = getattr(_local, 'conexion', None)
+    if conexion is None:
+        conexion = sqlite3.connect(RUTA, timeout=30)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=NORMAL")
+        _local.conexion = conexion
+    return conexion
+
+def _crear_tablas():
+    tipos = {'fecha': 'TEXT', 'category': 'TEXT'}
+    with _conexion() as conexion:
+        for filename, esquema in ESQUEMAS.items():
+            tabla, columna_id = _tabla(filename), COLUMNAS_ID[filename]
+            columnas = ', '.join(
+                f"{c} {tipos.get(t, 'INTEGER')}{' PRIMARY KEY' if c == columna_id else ''}" for c, t in esquema.items()
+            )
+            # "orden" conserva el orden del archivo (el de las cargas de cada coche)
+            conexion.execute(f"CREATE TABLE IF NOT EXISTS {tabla} ({columnas}, orden INTEGER NOT NULL)")
+            conexion.execute(f"CREATE INDEX IF NOT EXISTS {tabla}_orden ON {tabla} (orden)")
+            conexion.execute(f"CREATE INDEX IF NOT EXISTS {tabla}_coche ON {tabla} (coche, fecha)")
+            conexion.execute(f"CREATE INDEX IF NOT EXISTS {tabla}_fecha ON {tabla} (fecha)")
+        conexion.execute("CREATE TABLE IF NOT EXISTS versiones (archivo TEXT PRIMARY KEY, version TEXT)")
+
+# Filas listas para SQLite: tipos del esquema, fechas como texto ISO y vacíos como NULL
+def _registros(filas, filename):
+    columnas = [c for c in _columnas(filename) if c in filas.columns]
+    datos = aplicar(filas[columnas].copy(), filename)
+    for columna, tipo in ESQUEMAS[filename].items():
+        if columna in datos.columns and tipo == 'fecha':
+            datos[columna] = datos[columna].dt.strftime('%Y-%m-%d')
+    datos = datos[columnas].astype(object).where(datos[columnas].notna(), None)
+    return columnas, datos.itertuples(index=False, name=None)
+
+# Alta o corrección por ID; una corrección conserva el lugar de la fila
+def _insertar(conexion, filename, filas):
+    tabla, columna_id = _tabla(filename), COLUMNAS_ID[filename]
+    columnas, registros = _registros(filas, filename)
+    siguiente = conexion.execute(f"SELECT COALESCE(MAX(orden), 0) + 1 FROM {tabla}").fetchone()[0]
+    conexion.executemany(
+        f"INSERT INTO {tabla} ({', '.join(columnas)}, orden) VALUES ({', '.join('?' * len(columnas))}, ?) "
+        f"ON CONFLICT({columna_id}) DO UPDATE SET "
+        + ', '.join(f"{c} = excluded.{c}" for c in columnas if c != columna_id),
+        (registro + (siguiente + i,) for i, registro in enumerate(registros))
+    )
+
+def _aplicar(conexion, operacion):
+    filename = operacion['archivo']
+    tabla = _tabla(filename)
+    if operacion['tipo'] in ('agregar', 'corregir'):
+        _insertar(conexion, filename, pd.DataFrame(operacion['filas']))
+    else:
+        conexion.executemany(
+            f"DELETE FROM {tabla} WHERE {COLUMNAS_ID[filename]} = ?", ((i,) for i in operacion['ids'])
+        )
+
+def _cambio_local(filename):
+    _versiones[filename] = _versiones.get(filename, 0) + 1
+
+# Se llama desde cola_escritura al encolar, antes de que las operaciones lleguen a S3
+def _al_encolar(operaciones):
+    operaciones = [o for o in operaciones if o['archivo'] in ESQUEMAS]
+    if not operaciones:
+        return
+    with _lock, _conexion() as conexion:
+        for operacion in operaciones:
+            _aplicar(conexion, operacion)
+            _cambio_local(operacion['archivo'])
+            if operacion['archivo'] in _encolado_durante_sincronizacion:
+                _encolado_durante_sincronizacion[operacion['archivo']].append(operacion)
+
+def _version_guardada(filename):
+    fila = _conexion().execute("SELECT version FROM versiones WHERE archivo = ?", (filename,)).fetchone()
+    return fila[0] if fila else None
+
+# IDs que tocan unas operaciones (filas agregadas o corregidas e IDs borrados)
+def _ids_de(operaciones, filename):
+    columna_id = COLUMNAS_ID[filename]
+    ids = set()
+    for operacion in operaciones:
+        ids.update(operacion['ids'] if operacion['tipo'] == 'borrar' else (f[columna_id] for f in operacion['filas']))
+    return ids
+
+# Lleva la tabla a "data" escribiendo solo las filas que difieren: altas y
+# correcciones por ID y bajas de los IDs que ya no están. Los IDs de "excluidos"
+# no se tocan. Se compara columna por columna con los tipos del esquema, sin
+# recorrer las filas en Python. Devuelve si cambió algo.
+def _igualar(conexion, filename, data, excluidos):
+    tabla, columna_id = _tabla(filename), COLUMNAS_ID[filename]
+    columnas = [c for c in _columnas(filename) if c in data.columns]
+    nuevos = aplicar(data[columnas].copy(), filename).set_index(columna_id)
+    actuales = _leer_sql(filename, columnas).set_index(columna_id)
+    nuevos = nuevos[~nuevos.index.isin(excluidos)]
+    actuales = actuales[~actuales.index.isin(excluidos)]
+
+    comunes = nuevos.index.intersection(actuales.index)
+    distintos = pd.Series(False, index=comunes)
+    for columna in nuevos.columns:
+        a, b = nuevos[columna].reindex(comunes), actuales[columna].reindex(comunes)
+        if isinstance(a.dtype, pd.CategoricalDtype) or isinstance(b.dtype, pd.CategoricalDtype):
+            a, b = a.astype(object), b.astype(object)
+        distintos |= ~((a == b) | (a.isna() & b.isna()))
+
+    borrados = actuales.index.difference(nuevos.index)
+    cambiados = nuevos.index.difference(actuales.index).union(comunes[distintos.to_numpy()])
+    if len(borrados):
+        conexion.executemany(f"DELETE FROM {tabla} WHERE {columna_id} = ?", ((int(i),) for i in borrados))
+    if len(cambiados):
+        _insertar(conexion, filename, data[data[columna_id].isin(cambiados)])
+    return bool(len(borrados) or len(cambiados))
+
+# Trae un archivo desde S3 (con lo pendiente de la cola aplicado) si su versión en
+# S3 cambió, y aplica en la tabla solo lo que difiere. Lo que se encola mientras se
+# lee ya está en el espejo y no en lo leído: esos IDs quedan como están.
+def sincronizar(filename):
+    with _lock:
+        _encolado_durante_sincronizacion[filename] = []
+    try:
+        with medir(f"sincronizar {filename}", 'sync'):
+            data = cola_escritura.cargar_con_pendientes(filename)
+        # Lo encolado por este proceso ya está en el espejo: solo cuenta la versión de S3
+        version = data.attrs.get('version_s3')
+
+        # Si S3 falló la lectura vuelve vacía y sin versión: el espejo queda como está
+        if version is None or repr(version) == _version_guardada(filename):
+            return False
+
+        with _lock, _conexion() as conexion:
+            excluidos = _ids_de(_encolado_durante_sincronizacion[filename], filename)
+            cambio = _igualar(conexion, filename, quitar_repetidas(data, filename), excluidos)
+            conexion.execute("INSERT OR REPLACE INTO versiones (archivo, version) VALUES (?, ?)", (filename, repr(version)))
+            if cambio:
+                _cambio_local(filename)
+        return cambio
+    finally:
+        with _lock:
+            _encolado_durante_sincronizacion.pop(filename, None)
+
+def _sincronizar_siempre():
+    while True:
+        time.sleep(INTERVALO_SINCRONIZACION)
+        for filename in ARCHIVOS:
+            try:
+                sincronizar(filename)
+            except Exception:
+                logging.exception("No se pudo sincronizar %s con S3", filename)
+
+# Crea la base y arranca la sincronización (una vez por proceso). Si el espejo
+# está vacío, la primera sincronización se hace antes de devolver.
+def iniciar():
+    if not habilitado():
+        return
+    with _lock:
+        if _hilo['hilo'] is not None:
+            return
+        _crear_tablas()
+        cola_escritura.suscribir(_al_encolar)
+        _hilo['hilo'] = threading.Thread(target=_sincronizar_siempre, name='espejo-sqlite', daemon=True)
+        _hilo['hilo'].start()
+
+    for filename in ARCHIVOS:
+        if _version_guardada(filename) is None:
+            try:
+                sincronizar(filename)
+            except Exception:
+                logging.exception("No se pudo sincronizar %s con S3", filename)
+
+# Versión local de un archivo: cambia con cada escritura o sincronización. Leído
+# solo con algunos depósitos es otra versión (como en storage.filtrar).
+def version(filename, depositos=None):
+    with _lock:
+        version_actual = ('espejo', filename, _versiones.get(filename, 0))
+    return (version_actual, tuple(depositos)) if depositos is not None else version_actual
+
+def _leer_sql(filename, columnas, condiciones='', parametros=(), orden='orden', limite=None, desplazamiento=0):
+    columnas = [c for c in (columnas or _columnas(filename)) if c in ESQUEMAS[filename]]
+    consulta = f"SELECT {', '.join(columnas)} FROM {_tabla(filename)}"
+    if condiciones:
+        consulta += f" WHERE {condiciones}"
+    consulta += f" ORDER BY {orden}"
+    if limite is not None:
+        consulta += f" LIMIT {int(limite)} OFFSET {int(desplazamiento)}"
+    cursor = _conexion().execute(consulta, parametros)
+    return aplicar(pd.DataFrame.from_records(cursor.fetchall(), columns=columnas), filename)
+
+# Igual que cargar_con_pendientes, pero desde el espejo. El resultado completo
+# queda en memoria hasta que cambie la versión local.
+def cargar(filename, columnas=None, meses=None, depositos=None):
+    version_actual = version(filename)
+    clave = (filename, tuple(columnas) if columnas is not None else None)
+    with _lock:
+        en_cache = _cache.get(clave)
+    if en_cache is not None and en_cache[0] == version_actual:
+        data = en_cache[1]
+    else:
+        with medir(f"espejo {filename}", 'sql'):
+            data = _leer_sql(filename, columnas)
+        with _lock:
+            _cache[clave] = (version_actual, data)
+
+    data = data.copy()
+    data.attrs['version'] = version_actual
+    if meses is not None or depositos is not None:
+        data = filtrar(data, meses=meses, depositos=depositos)
+    elif columnas is not None:
+        data.attrs['parcial'] = True
+    return data
+
+def _filtros(coches=None, desde=None, hasta=None):
+    condiciones, parametros = [], []
+    if coches is not None:
+        condiciones.append(f"coche IN ({', '.join('?' * len(coches))})")
+        parametros += [int(c) for c in coches]
+    if desde is not None:
+        condiciones.append("fecha >= ?")
+        parametros.append(pd.Timestamp(desde).strftime('%Y-%m-%d'))
+    if hasta is not None:
+        condiciones.append("fecha <= ?")
+        parametros.append(pd.Timestamp(hasta).strftime('%Y-%m-%d'))
+    return ' AND '.join(condiciones), parametros
+
+# Consultas con índice para el historial: cantidad de filas y una página ordenada
+# por ID de mayor a menor
+def contar(filename, coches=None, desde=None, hasta=None):
+    condiciones, parametros = _filtros(coches, desde, hasta)
+    consulta = f"SELECT COUNT(*) FROM {_tabla(filename)}" + (f" WHERE {condiciones}" if condiciones else '')
+    return _conexion().execute(consulta, parametros).fetchone()[0]
+
+def pagina(filename, tamano, numero, coches=None, desde=None, hasta=None):
+    condiciones, parametros = _filtros(coches, desde, hasta)
+    return _leer_sql(
+        filename, None, condiciones, parametros,
+        orden=f"{COLUMNAS_ID[filename]} DESC", limite=tamano, desplazamiento=(numero - 1) * tamano
+    )
@@ -0,0 +1,133 @@
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from flota import deposito_de
+
+# Tipos de las columnas de cada archivo. Se aplican al parsear (dtype explícito en
+# read_csv, así no hay inferencia) y antes de escribir, para que lo guardado
+# tenga siempre el mismo formato. "fecha" es datetime64 y se guarda como YYYY-MM-DD;
+# la hora, que se repite mucho, queda como categoría.
+ESQUEMAS = {
+    'cargas_diesel.csv': {
+        'idCarga': 'int32',
+        'fecha': 'fecha',
+        'hora': 'category',
+        'coche': 'int16',
+        'litros': 'int16',
+        'litrosServi': 'int32',
+    },
+    'servicios_realizados.csv': {
+        'idServis': 'int32',
+        'fecha': 'fecha',
+        'hora': 'category',
+        'coche': 'int16',
+        'litrosTotales': 'int32',
+        'litrosUltimoServi': 'int32',
+        'fechaAnterior': 'fecha',
+    },
+}
+
+# Columnas que se calculan al leer y no se guardan
+COLUMNAS_DERIVADAS = ['deposito']
+
+FORMATO_FECHA = '%Y-%m-%d'
+
+# Convierte solo las columnas que no tienen ya el tipo del esquema. Las columnas
+# enteras con celdas vacías quedan como float (los enteros de numpy no admiten vacíos).
+# Un valor que no entra en el entero del esquema es un error: astype lo daría vuelta
+# (40000 como int16 es -25536) y se guardaría así.
+def tipar(data, filename):
+    esquema = ESQUEMAS.get(filename, {})
+    for columna, tipo in esquema.items():
+        if columna not in data.columns:
+            continue
+        actual = data[columna].dtype
+        if tipo == 'fecha':
+            if not pd.api.types.is_datetime64_dtype(actual):
+                data[columna] = pd.to_datetime(data[columna], format='ISO8601', errors='coerce')
+        elif tipo == 'category':
+            if not isinstance(actual, pd.CategoricalDtype):
+                data[columna] = data[columna].astype('category')
+        elif actual != tipo:
+            numeros = pd.to_numeric(data[columna], errors='coerce')
+            limites = np.iinfo(tipo)
+            fuera = (numeros < limites.min) | (numeros > limites.max)
+            if fuera.any():
+                raise ValueError(
+                    f"{columna} fuera de rango ({limites.min} a {limites.max}): {numeros[fuera].head(5).tolist()}"
+                )
+            data[columna] = numeros.astype(tipo) if numeros.notna().all() else numeros
+    return data
+
+# DataFrame sin filas con las columnas del esquema (o "columnas") ya tipadas
+def vacio(filename, columnas=None):
+    esquema = ESQUEMAS.get(filename, {})
+    tipos = {'fecha': 'datetime64[ns]'}
+    data = pd.DataFrame({c: pd.Series(dtype=tipos.get(t, t)) for c, t in esquema.items()})
+    data = aplicar(data, filename)
+    if columnas is not None:
+        data = data.reindex(columns=list(columnas))
+    return data
+
+def aplicar(data, filename):
+    data = tipar(data, filename)
+    if filename in ESQUEMAS and 'coche' in data.columns and 'deposito' not in data.columns:
+        data['deposito'] = deposito_de(data['coche'])
+    return data
+
+def leer_csv(origen, filename, **kwargs):
+    esquema = ESQUEMAS.get(filename)
+    if esquema is None:
+        return pd.read_csv(origen, **kwargs)
+
+    tipos = {c: t for c, t in esquema.items() if t != 'fecha'}
+    try:
+        data = pd.read_csv(origen, dtype=tipos, **kwargs)
+    except (ValueError, TypeError, OverflowError):
+        # Celdas vacías o texto en una columna entera: se lee sin tipos y se convierte después
+        origen.seek(0)
+        data = pd.read_csv(origen, **kwargs)
+    return aplicar(data, filename)
+
+# pd.concat vuelve texto las categorías que no coinciden entre partes (y es lento
+# con muchas partes); las columnas categóricas se arman aparte con la unión de categorías
+def concatenar(partes, filename):
+    partes = list(partes)
+    categoricas = [
+        c for c in partes[0].columns
+        if all(c in p.columns and isinstance(p[c].dtype, pd.CategoricalDtype) for p in partes)
+    ]
+    if len(partes) < 2 or not categoricas:
+        return aplicar(pd.concat(partes, ignore_index=True), filename)
+
+    data = pd.concat([p.drop(columns=categoricas) for p in partes], ignore_index=True)
+    for columna in categoricas:
+        data[columna] = union_categoricals([p[columna] for p in partes], ignore_order=True)
+    # reindex devuelve un DataFrame propio (seleccionar columnas con [] deja una
+    # copia marcada y aplicar avisaría SettingWithCopyWarning al agregar el depósito)
+    orden = list(partes[0].columns) + [c for c in data.columns if c not in partes[0].columns]
+    return aplicar(data.reindex(columns=orden), filename)
+
+# Columnas que se guardan en el archivo (sin las derivadas)
+def columnas_guardadas(data):
+    return [c for c in data.columns if c not in COLUMNAS_DERIVADAS]
+
+def para_guardar(data, filename):
+    derivadas = [c for c in COLUMNAS_DERIVADAS if c in data.columns]
+    return tipar(data.drop(columns=derivadas) if derivadas else data.copy(), filename)
+
+def a_csv(data, filename, header=True):
+    return para_guardar(data, filename).to_csv(index=False, header=header, date_format=FORMATO_FECHA)
+
+# Texto a guardar y el DataFrame tal como queda al volver a leerlo. Con esquema
+# no hace falta parsear el texto: lo guardado ya tiene los tipos de la lectura.
+def serializar(data, filename):
+    if filename not in ESQUEMAS:
+        cuerpo = data.to_csv(index=False)
+        return cuerpo, pd.read_csv(StringIO(cuerpo))
+    guardado = para_guardar(data, filename)
+    cuerpo = guardado.to_csv(index=False, date_format=FORMATO_FECHA)
+    return cuerpo, aplicar(guardado, filename)
@@ -0,0 +1,306 @@
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import alertas
+from flota import intervalo_servicio, intervalos_servicio, registro
+from metricas import medido
+
+COLUMNAS_ESTADO = [
+    'litrosServi', 'litros', 'litrosTotales', 'cargas',
+    'servicios', 'fechaUltimoServi', 'litrosUltimoServi',
+    'momentoUltimoServi', 'momentoUltimaCarga'
+]
+
+# Columnas del historial de cargas que hacen falta para armar el estado y derivar litrosServi
+COLUMNAS_CARGAS = ['idCarga', 'fecha', 'hora', 'coche', 'litros']
+
+# Estado por coche compartido por el proceso, uno por vista (los depósitos leídos,
+# None para toda la flota): se arma una vez por versión de los datos de esa vista y
+# después se actualiza fila por fila con cada carga, servicio o eliminación. Con una
+# sola tabla, dos sesiones que ven depósitos distintos la rearmarían una encima de
+# la otra. "versiones" guarda la versión de (cargas, servicios) de cada tabla.
+_estados = {}
+_estado_lock = threading.Lock()
+
+# litrosServi no se toma de lo guardado: de cada carga es el intervalo de servicio
+# del coche menos los litros cargados desde su último servicio anterior (la columna
+# del archivo queda solo como registro de lo que se vio al cargar). Registrar un
+# servicio es agregar una fila y no reescribe las cargas. Se calcula una vez por
+# versión de (cargas, servicios) de cada vista, como el estado.
+_derivados = {}
+
+def _vista(depositos):
+    return tuple(depositos) if depositos is not None else None
+
+# Fecha y hora de cada fila; sin fecha va al final (después de cualquier servicio).
+# La hora es categoría: se convierte una vez por valor distinto y no por fila.
+# Puede venir como HH:MM (la app) o HH:MM:SS (el CSV original y las importaciones).
+def _momentos(data):
+    horas = data['hora'].astype('category')
+    valores = pd.Series(horas.cat.categories.astype(str)).str.strip()
+    valores = valores.where(~valores.str.fullmatch(r'\d{1,2}:\d{2}'), valores + ':00')
+    por_valor = pd.to_timedelta(valores, errors='coerce').fillna(pd.Timedelta(0))
+    desplazamiento = np.append(por_valor.to_numpy(), np.timedelta64(0, 'ns'))[horas.cat.codes.to_numpy()]
+    momentos = data['fecha'].astype('datetime64[ns]') + desplazamiento
+    return momentos.fillna(pd.Timestamp.max).to_numpy()
+
+def _momento(fecha, hora):
+    return pd.Timestamp(_momentos(pd.DataFrame({'fecha': [pd.Timestamp(fecha)], 'hora': [hora]}))[0])
+
+# Devuelve (litrosServi de cada carga por idCarga, litros cargados por coche desde
+# su último servicio). Cada carga se asigna al último servicio de su coche anterior
+# a ella (merge_asof por coche; una carga en el mismo minuto que el servicio cuenta
+# como anterior) y los litros se acumulan por coche y servicio en el orden del archivo.
+@medido('derivar_litros_servi', 'calculo')
+def derivar_litros_servi(diesel_data, service_data):
+    cargas = diesel_data[diesel_data['coche'].notna()]
+    coches = cargas['coche'].astype('int64').to_numpy()
+    litros = cargas['litros'].fillna(0).to_numpy()
+    servicios = service_data[service_data['coche'].notna()] if not service_data.empty else service_data
+
+    if servicios.empty:
+        segmento = np.zeros(len(cargas), dtype='int64')
+        ultimos = pd.Series(dtype='int64')
+    else:
+        eventos = pd.DataFrame({
+            'momento': _momentos(servicios),
+            'coche': servicios['coche'].astype('int64').to_numpy(),
+            'segmento': servicios['idServis'].astype('int64').to_numpy(),
+        }).sort_values('momento', kind='stable')
+        izquierda = pd.DataFrame({'momento': _momentos(cargas), 'coche': coches, 'posicion': np.arange(len(cargas))})
+        unidas = pd.merge_asof(izquierda.sort_values('momento', kind='stable'), eventos, on='momento', by='coche', allow_exact_matches=False)
+        segmento = unidas.sort_values('posicion')['segmento'].fillna(0).astype('int64').to_numpy()
+        ultimos = eventos.groupby('coche')['segmento'].last()
+
+    acumulado = pd.Series(litros).groupby([coches, segmento], sort=False).cumsum().to_numpy()
+    litros_servi = pd.Series(intervalos_servicio(coches) - acumulado, index=cargas['idCarga'].to_numpy())
+    litros_servi = litros_servi[~litros_servi.index.duplicated(keep='last')]
+
+    en_el_ultimo = segmento == pd.Series(ultimos).reindex(coches).fillna(0).to_numpy()
+    desde_servicio = pd.Series(litros[en_el_ultimo]).groupby(coches[en_el_ultimo]).sum()
+    return litros_servi, desde_servicio
+
+def obtener_litros_servi(diesel_data, service_data, depositos=None):
+    versiones = (diesel_data.attrs.get('version'), service_data.attrs.get('version'))
+    vista = _vista(depositos)
+    with _estado_lock:
+        derivado = _derivados.get(vista)
+        if derivado is not None and None not in versiones and derivado['versiones'] == versiones:
+            return derivado['resultado']
+
+    resultado = derivar_litros_servi(diesel_data, service_data)
+    with _estado_lock:
+        _derivados[vista] = {'versiones': versiones, 'resultado': resultado}
+    return resultado
+
+def _ultimos_servicios(service_data):
+    # Con tipos: columnas object vacías harían que el fillna de construir_estado avise
+    if service_data.empty:
+        return pd.DataFrame({
+            'servicios': pd.Series(dtype='int64'),
+            'fechaUltimoServi': pd.Series(dtype=object),
+            'litrosUltimoServi': pd.Series(dtype='float64'),
+            'momentoUltimoServi': pd.Series(dtype='datetime64[ns]'),
+        }, index=pd.Index([], name='coche'))
+
+    # El último servicio es el más reciente por fecha y hora, como en derivar_litros_servi
+    ordenados = service_data.sort_values(by='idServis').assign(momento=lambda d: _momentos(d))
+    ultimos = ordenados.sort_values(by='momento', kind='stable').groupby('coche').agg(
+        servicios=('idServis', 'size'),
+        fechaUltimoServi=('fecha', 'last'),
+        litrosUltimoServi=('litrosTotales', 'last'),
+        momentoUltimoServi=('momento', 'last')
+    )
+    ultimos['fechaUltimoServi'] = pd.to_datetime(ultimos['fechaUltimoServi'], errors='coerce').dt.strftime('%Y-%m-%d')
+    return ultimos
+
+# Arma la tabla completa (una pasada de groupby sobre cada historial)
+@medido('construir_estado', 'calculo')
+def construir_estado(diesel_data, service_data, depositos=None):
+    if diesel_data.empty:
+        cargas = pd.DataFrame({
+            'litrosTotales': pd.Series(dtype='int64'), 'cargas': pd.Series(dtype='int64'),
+            'momentoUltimaCarga': pd.Series(dtype='datetime64[ns]'),
+        }, index=pd.Index([], name='coche'))
+        desde_servicio = pd.Series(dtype='int64')
+    else:
+        cargas = diesel_data.assign(momento=_momentos(diesel_data)).groupby('coche').agg(
+            litrosTotales=('litros', 'sum'),
+            cargas=('litros', 'size'),
+            momentoUltimaCarga=('momento', 'max')
+        )
+        desde_servicio = obtener_litros_servi(diesel_data, service_data, depositos)[1]
+
+    tabla = cargas.join(_ultimos_servicios(service_data), how='outer')
+    intervalos = intervalos_servicio(tabla.index)
+    tabla['litros'] = desde_servicio.reindex(tabla.index).fillna(0).astype(int)
+    tabla['litrosServi'] = intervalos - tabla['litros']
+    tabla['litrosTotales'] = tabla['litrosTotales'].fillna(0).astype(int)
+    tabla['cargas'] = tabla['cargas'].fillna(0).astype(int)
+    tabla['servicios'] = tabla['servicios'].fillna(0).astype(int)
+    tabla.index.name = 'coche'
+    return tabla[COLUMNAS_ESTADO]
+
+# "depositos" es la vista con la que se leyeron los datos (None, toda la flota)
+def obtener_estado(diesel_data, service_data, depositos=None):
+    versiones = (diesel_data.attrs.get('version'), service_data.attrs.get('version'))
+    vista = _vista(depositos)
+    with _estado_lock:
+        estado = _estados.get(vista)
+        if estado is not None and None not in versiones and estado['versiones'] == versiones:
+            return estado['tabla']
+
+    tabla = construir_estado(diesel_data, service_data, depositos)
+    with _estado_lock:
+        _estados[vista] = {'versiones': versiones, 'tabla': tabla}
+    alertas.reconstruir(tabla, _coches_de(depositos))
+    return tabla
+
+# Coches de la flota en los depósitos de una vista (None, toda la flota)
+def _coches_de(depositos):
+    if depositos is None:
+        return None
+    depositos_de_coches = registro()['deposito']
+    return depositos_de_coches.index[depositos_de_coches.isin(depositos)].tolist()
+
+# La tabla de la vista no corresponde a ninguna versión conocida: la próxima carga la reconstruye
+def desactualizado(depositos=None):
+    with _estado_lock:
+        estado = _estados.get(_vista(depositos))
+        return estado is None or None in estado['versiones']
+
+# Datos de un coche en O(1); None si no tiene registros
+def estado_de_coche(estado, coche):
+    if coche not in estado.index:
+        return None
+    return estado.loc[coche]
+
+def _fila_vacia(coche):
+    return {
+        'litrosServi': intervalo_servicio(coche), 'litros': 0, 'litrosTotales': 0, 'cargas': 0, 'servicios': 0,
+        'fechaUltimoServi': None, 'litrosUltimoServi': None, 'momentoUltimoServi': pd.NaT, 'momentoUltimaCarga': pd.NaT
+    }
+
+# "versiones" indica la nueva versión de cada historial tocado: {0: cargas, 1: servicios}.
+# Se actualiza solo la tabla de la vista que hizo la escritura; las de otras vistas
+# ven otra versión en su próxima lectura y se reconstruyen.
+def _actualizar(coche, cambios, versiones_nuevas, depositos=None):
+    # Un coche de otro depósito (por ejemplo, una corrección que lo cambió) no es de esta vista
+    if depositos is not None and registro()['deposito'].get(coche) not in depositos:
+        return
+    with _estado_lock:
+        estado = _estados.get(_vista(depositos))
+        if estado is None:
+            return
+        tabla = estado['tabla']
+
+        if coche in tabla.index:
+            for columna, valor in cambios(tabla.loc[coche]).items():
+                tabla.loc[coche, columna] = valor
+        else:
+            fila = _fila_vacia(coche)
+            fila.update(cambios(pd.Series(fila)))
+            # Agregar la fila con celdas vacías avisa un cambio futuro de pandas que
+            # no afecta acá: las columnas conservan sus tipos
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', FutureWarning)
+                tabla.loc[coche] = fila
+
+        # Si no sabemos a qué versión corresponde la escritura (o no se puede
+        # actualizar sin el historial) la versión queda en None y la próxima carga reconstruye
+        versiones = list(estado['versiones'])
+        for indice, version in versiones_nuevas.items():
+            versiones[indice] = version
+        estado['versiones'] = tuple(versiones)
+        litros_servi = tabla.loc[coche, 'litrosServi']
+
+    # El índice de alertas se mueve solo para este coche
+    alertas.actualizar(coche, litros_servi)
+
+# Una carga suma a los litros desde el servicio solo si es posterior al último
+# servicio del coche, con la misma regla que derivar_litros_servi: una carga con
+# fecha anterior (o en el mismo minuto) es del período del servicio anterior.
+def _cuenta(momento, fila):
+    return pd.isna(fila['momentoUltimoServi']) or momento > fila['momentoUltimoServi']
+
+def _ultima(momento, fila):
+    return momento if pd.isna(fila['momentoUltimaCarga']) else max(momento, fila['momentoUltimaCarga'])
+
+def _sumar_cargas(coche, fila, momentos, litros):
+    desde_servicio = fila['litros'] + sum(l for m, l in zip(momentos, litros) if _cuenta(m, fila))
+    return {
+        'litrosServi': intervalo_servicio(coche) - desde_servicio,
+        'litros': desde_servicio,
+        'litrosTotales': fila['litrosTotales'] + sum(litros),
+        'cargas': fila['cargas'] + len(litros),
+        'momentoUltimaCarga': _ultima(max(momentos), fila),
+    }
+
+def registrar_carga(coche, fecha, hora, litros, version, depositos=None):
+    momento = _momento(fecha, hora)
+    _actualizar(coche, lambda fila: _sumar_cargas(coche, fila, [momento], [litros]), {0: version}, depositos)
+
+# Un lote de cargas (importación) actualiza cada coche una sola vez
+def registrar_lote_de_cargas(lote, version, depositos=None):
+    momentos = pd.Series(_momentos(lote), index=lote.index)
+    for coche, filas in lote.groupby('coche'):
+        _actualizar(coche, lambda fila: _sumar_cargas(
+            coche, fila, momentos[filas.index].tolist(), filas['litros'].astype(int).tolist()
+        ), {0: version}, depositos)
+
+# Un servicio posterior a todas las cargas del coche deja sus litros en 0, y uno
+# anterior al último servicio no cambia los litros. Uno en el medio reparte cargas
+# que ya estaban entre dos servicios: sin el historial no se pueden recalcular, así
+# que la versión queda en None y el estado se reconstruye en la próxima carga.
+def registrar_servicio(coche, fecha, hora, litros_totales, version_servicios, depositos=None):
+    momento = _momento(fecha, hora)
+    version = {1: version_servicios}
+
+    def cambios(fila):
+        nuevos = {'servicios': fila['servicios'] + 1}
+        if not _cuenta(momento, fila) and momento != fila['momentoUltimoServi']:
+            return nuevos
+        nuevos.update({
+            'fechaUltimoServi': pd.Timestamp(fecha).strftime('%Y-%m-%d'),
+            'litrosUltimoServi': litros_totales,
+            'momentoUltimoServi': momento,
+        })
+        if pd.isna(fila['momentoUltimaCarga']) or momento >= fila['momentoUltimaCarga']:
+            nuevos.update({'litrosServi': intervalo_servicio(coche), 'litros': 0})
+        else:
+            version[1] = None
+        return nuevos
+
+    _actualizar(coche, cambios, version, depositos)
+
+# Litros desde el último servicio de un coche, derivados solo de sus propias filas
+def _litros_de_coche(coche, diesel_data, service_data):
+    filas = diesel_data[diesel_data['coche'] == coche]
+    servicios = service_data[service_data['coche'] == coche] if not service_data.empty else service_data
+    litros = int(derivar_litros_servi(filas, servicios)[1].get(coche, 0)) if not filas.empty else 0
+    return {'litrosServi': intervalo_servicio(coche) - litros, 'litros': litros}
+
+# Eliminaciones y correcciones: se recalcula solo el coche afectado a partir de sus
+# propias filas. Como litrosServi depende también de los servicios, borrar o
+# corregir un servicio rehace los litros del coche.
+def recalcular_cargas_de_coche(coche, diesel_data, service_data, version, depositos=None):
+    filas = diesel_data[diesel_data['coche'] == coche]
+    _actualizar(coche, lambda fila: {
+        **_litros_de_coche(coche, diesel_data, service_data),
+        'litrosTotales': filas['litros'].sum(),
+        'cargas': len(filas),
+        'momentoUltimaCarga': _momentos(filas).max() if not filas.empty else pd.NaT,
+    }, {0: version}, depositos)
+
+def recalcular_servicios_de_coche(coche, diesel_data, service_data, version, depositos=None):
+    ultimos = _ultimos_servicios(service_data[service_data['coche'] == coche])
+    _actualizar(coche, lambda fila: {
+        **_litros_de_coche(coche, diesel_data, service_data),
+        'servicios': ultimos['servicios'].iloc[0] if not ultimos.empty else 0,
+        'fechaUltimoServi': ultimos['fechaUltimoServi'].iloc[0] if not ultimos.empty else None,
+        'litrosUltimoServi': ultimos['litrosUltimoServi'].iloc[0] if not ultimos.empty else None,
+        'momentoUltimoServi': ultimos['momentoUltimoServi'].iloc[0] if not ultimos.empty else pd.NaT,
+    }, {1: version}, depositos)
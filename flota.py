@@ -0,0 +1,115 @@
+import threading
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from recursos import bucket, cliente_s3, opcion
+
+# Registro de la flota: depósito, capacidad de carga e intervalo de servicio de
+# cada coche. Se lee de S3 (archivo "flota_archivo", por defecto flota.csv, con
+# columnas coche, deposito, capacidad, intervaloServicio) una sola vez por proceso;
+# si no existe se usa FLOTA_POR_DEFECTO. Agregar coches o depósitos es editar ese
+# archivo (los cambios se toman al reiniciar la app). La capacidad es el máximo de
+# una sola carga; un coche sin capacidad en el registro no tiene máximo.
+
+# Litros entre servicios, para los coches que no lo indican
+LITROS_SERVICIO = 5000
+
+FLOTA_POR_DEFECTO = {
+    'Alderete': [101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114, 115, 116, 117, 118, 119, 120],
+    'Tigre': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 18, 52],
+}
+
+_flota = {}
+_lock = threading.Lock()
+
+def _leer_registro():
+    try:
+        obj = cliente_s3().get_object(Bucket=bucket(), Key=opcion('flota_archivo', 'flota.csv'))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return pd.DataFrame(
+            [(coche, deposito) for deposito, coches in FLOTA_POR_DEFECTO.items() for coche in coches],
+            columns=['coche', 'deposito']
+        )
+    data = pd.read_csv(obj['Body'])
+    data.columns = [str(c).strip() for c in data.columns]
+    return data
+
+def _numeros(data, columna, defecto):
+    if columna not in data.columns:
+        return pd.Series(defecto, index=data.index)
+    return pd.to_numeric(data[columna], errors='coerce').fillna(defecto)
+
+# Todo lo que se consulta seguido queda precalculado: el registro indexado por
+# coche, el conjunto de coches válidos y el código de depósito de cada número
+def _armar(data):
+    registro = pd.DataFrame({
+        'coche': pd.to_numeric(data['coche'], errors='coerce'),
+        'deposito': data['deposito'].where(data['deposito'].notna(), '').astype(str).str.strip(),
+        'capacidad': _numeros(data, 'capacidad', np.nan),
+        'intervaloServicio': _numeros(data, 'intervaloServicio', LITROS_SERVICIO).astype(int),
+    }).dropna(subset=['coche'])
+    registro = registro.astype({'coche': int}).drop_duplicates(subset='coche', keep='last')
+
+    # Los depósitos quedan en el orden en que aparecen en el registro
+    depositos = [d for d in registro['deposito'].unique() if d]
+    tipo = pd.CategoricalDtype(depositos)
+    registro['deposito'] = registro['deposito'].astype(tipo)
+    registro = registro.set_index('coche').sort_index()
+
+    codigos = np.full(int(registro.index.max()) + 1 if not registro.empty else 0, -1, dtype='int16')
+    codigos[registro.index.to_numpy()] = registro['deposito'].cat.codes.to_numpy()
+    return {
+        'registro': registro,
+        'coches': frozenset(registro.index.tolist()),
+        'depositos': depositos,
+        'tipo_deposito': tipo,
+        'codigos': codigos,
+    }
+
+def _cargada():
+    flota = _flota.get('flota')
+    if flota is None:
+        with _lock:
+            if 'flota' not in _flota:
+                _flota['flota'] = _armar(_leer_registro())
+            flota = _flota['flota']
+    return flota
+
+# Registro indexado por coche (deposito, capacidad, intervaloServicio)
+def registro():
+    return _cargada()['registro']
+
+def coches():
+    return registro().index.tolist()
+
+def es_coche_valido(coche):
+    return coche in _cargada()['coches']
+
+def depositos():
+    return list(_cargada()['depositos'])
+
+def intervalo_servicio(coche):
+    intervalos = registro()['intervaloServicio']
+    return int(intervalos[coche]) if coche in intervalos.index else LITROS_SERVICIO
+
+# Valores de muchos coches de una vez (los que no están en el registro toman los por defecto)
+def intervalos_servicio(coches):
+    return registro()['intervaloServicio'].reindex(coches).fillna(LITROS_SERVICIO).astype(int).to_numpy()
+
+# NaN para los coches sin capacidad registrada
+def capacidades(coches):
+    return registro()['capacidad'].reindex(coches).to_numpy(dtype='float64')
+
+# Depósito de cada coche como categoría (los coches sin depósito quedan vacíos)
+def deposito_de(coches):
+    flota = _cargada()
+    tabla = flota['codigos']
+    numeros = pd.to_numeric(coches, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    validos = (numeros >= 0) & (numeros < len(tabla)) & (numeros == np.floor(numeros))
+    codigos = np.full(len(numeros), -1, dtype='int16')
+    codigos[validos] = tabla[numeros[validos].astype('int64')]
+    return pd.Series(pd.Categorical.from_codes(codigos, dtype=flota['tipo_deposito']), index=coches.index, name='deposito')
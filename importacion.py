@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from flota import capacidades, intervalos_servicio, registro
+
+COLUMNAS_REQUERIDAS = ['coche', 'litros', 'fecha']
+
+COLUMNAS_CARGA = ['idCarga', 'fecha', 'hora', 'coche', 'litros', 'litrosServi']
+
+# Lee la exportación del surtidor (CSV o Excel) con los nombres de columna normalizados
+def leer_archivo(archivo):
+    if archivo.name.lower().endswith(('.xlsx', '.xls')):
+        data = pd.read_excel(archivo)
+    else:
+        data = pd.read_csv(archivo)
+    data.columns = [str(c).strip().lower() for c in data.columns]
+    return data
+
+# Fechas de cada fila por separado: primero ISO (AAAA-MM-DD) y las que no lo son
+# con el día primero (DD/MM/AAAA). Sin formato explícito pandas deduce uno solo a
+# partir del primer valor y rechaza las filas escritas de otra forma.
+def leer_fechas(valores):
+    fechas = pd.to_datetime(valores, errors='coerce', format='ISO8601')
+    resto = fechas.isna() & valores.notna()
+    if resto.any():
+        fechas[resto] = pd.to_datetime(valores[resto], errors='coerce', format='mixed', dayfirst=True)
+    return fechas
+
+# Valida todas las filas de una vez contra el registro de la flota (coche válido y
+# litros hasta la capacidad de cada coche, si la tiene). Devuelve (válidas, rechazadas); las
+# rechazadas conservan sus columnas originales más la fila del archivo y el motivo.
+def validar_cargas(data):
+    faltantes = [c for c in COLUMNAS_REQUERIDAS if c not in data.columns]
+    if faltantes:
+        raise ValueError(f"Faltan las columnas: {', '.join(faltantes)}")
+
+    coche = pd.to_numeric(data['coche'], errors='coerce')
+    litros = pd.to_numeric(data['litros'], errors='coerce')
+    fecha = leer_fechas(data['fecha'])
+    capacidad = capacidades(coche)
+
+    # El primer motivo que aplique es el que se informa
+    condiciones = [
+        coche.isna(),
+        ~coche.isin(registro().index),
+        litros.isna(),
+        litros % 1 != 0,
+        (litros <= 0) | (litros > capacidad),
+        fecha.isna(),
+    ]
+    motivos = [
+        'Número de coche inválido',
+        'El coche no pertenece a la flota',
+        'Litros inválidos',
+        'Los litros tienen que ser un número entero',
+        'Litros fuera de rango (1 a la capacidad del coche)',
+        'Fecha inválida',
+    ]
+    motivo = pd.Series(np.select(condiciones, motivos, default=''), index=data.index)
+    rechazo = motivo != ''
+
+    rechazadas = data[rechazo].assign(fila=data.index[rechazo] + 2, motivo=motivo[rechazo])
+
+    validas = pd.DataFrame({
+        'fecha': fecha[~rechazo].dt.strftime('%Y-%m-%d'),
+        'hora': data['hora'][~rechazo].astype(str).where(data['hora'].notna()) if 'hora' in data.columns else np.nan,
+        'coche': coche[~rechazo].astype(int),
+        'litros': litros[~rechazo].astype(int),
+    })
+    return validas, rechazadas
+
+# Ordena el lote, calcula el litrosServi de cada carga partiendo del valor actual
+# de cada coche (una suma acumulada por coche sobre todo el lote) y asigna los IDs.
+# Otras columnas de "validas" se conservan al final.
+def preparar_lote(validas, estado, ids):
+    lote = validas.sort_values(by=['fecha', 'hora'], kind='stable').reset_index(drop=True)
+
+    # Coches sin cargas previas arrancan desde su intervalo de servicio, igual que en el formulario
+    con_cargas = estado.loc[estado['cargas'] > 0, 'litrosServi']
+    actual = lote['coche'].map(con_cargas).fillna(pd.Series(intervalos_servicio(lote['coche']), index=lote.index))
+    lote['litrosServi'] = (actual - lote.groupby('coche')['litros'].cumsum()).astype(int)
+
+    lote['idCarga'] = ids
+    return lote[COLUMNAS_CARGA + [c for c in lote.columns if c not in COLUMNAS_CARGA]]
+
+# Igual que validar_cargas pero para servicios: coche de la flota y fecha (si no
+# viene, la de hoy). Devuelve (válidas, rechazadas).
+def validar_servicios(data):
+    if 'coche' not in data.columns:
+        raise ValueError("Falta la columna: coche")
+
+    coche = pd.to_numeric(data['coche'], errors='coerce')
+    if 'fecha' in data.columns:
+        fecha = leer_fechas(data['fecha']).where(data['fecha'].notna(), pd.Timestamp.today())
+    else:
+        fecha = pd.Series(pd.Timestamp.today(), index=data.index)
+
+    condiciones = [coche.isna(), ~coche.isin(registro().index), fecha.isna()]
+    motivos = ['Número de coche inválido', 'El coche no pertenece a la flota', 'Fecha inválida']
+    motivo = pd.Series(np.select(condiciones, motivos, default=''), index=data.index)
+    rechazo = motivo != ''
+
+    rechazadas = data[rechazo].assign(fila=data.index[rechazo] + 2, motivo=motivo[rechazo])
+    validas = pd.DataFrame({
+        'fecha': fecha[~rechazo].dt.strftime('%Y-%m-%d'),
+        'hora': data['hora'][~rechazo].astype(str).where(data['hora'].notna()) if 'hora' in data.columns else np.nan,
+        'coche': coche[~rechazo].astype(int),
+    })
+    return validas, rechazadas
+
+# Arma cada servicio como el formulario: litros totales del coche, y fecha y litros
+# del servicio anterior (el anterior de un servicio del mismo lote es el previo del lote)
+def preparar_servicios(validas, estado, ids):
+    lote = validas.sort_values(by=['fecha', 'hora'], kind='stable').reset_index(drop=True)
+    lote['idServis'] = ids
+
+    actual = estado.reindex(lote['coche'].unique())
+    litros_totales = actual['litrosTotales'].fillna(0).astype(int)
+    anteriores = {
+        coche: (fila['fechaUltimoServi'] if pd.notna(fila['fechaUltimoServi']) else None,
+                fila['litrosUltimoServi'] if fila['servicios'] > 0 and pd.notna(fila['litrosUltimoServi']) else 0)
+        for coche, fila in actual.iterrows()
+    }
+
+    fechas_anteriores, litros_anteriores = [], []
+    for coche, fecha in zip(lote['coche'], lote['fecha']):
+        fecha_anterior, litros_anterior = anteriores[coche]
+        fechas_anteriores.append(fecha_anterior)
+        litros_anteriores.append(litros_anterior)
+        anteriores[coche] = (fecha, litros_totales[coche])
+
+    lote['litrosTotales'] = lote['coche'].map(litros_totales).to_numpy()
+    lote['litrosUltimoServi'] = litros_anteriores
+    lote['fechaAnterior'] = fechas_anteriores
+    columnas = ['idServis', 'fecha', 'hora', 'coche', 'litrosTotales', 'litrosUltimoServi', 'fechaAnterior']
+    return lote[columnas + [c for c in lote.columns if c not in columnas]]
@@ -1,18 +1,9 @@
 import streamlit as st
-import boto3
-import pandas as pd
-from config import cargar_configuracion
-from app import main as app
-
-# Cargar configuración
-aws_access_key, aws_secret_key, region_name, bucket_name, valid_user, valid_password = cargar_configuracion()
+from recursos import configuracion
 
 # Establecer el modo wide como predeterminado
 st.set_page_config(layout="wide")
 
-# Conecta a S3
-s3 = boto3.client('s3', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key, region_name=region_name)
-
 # Definir las variables para el estado de inicio de sesión
 logged_in = st.session_state.get("logged_in", False)
 user_nombre_apellido = st.session_state.get("user_nombre_apellido", "")
@@ -25,6 +16,7 @@ def login(username, password):
         username = username.strip().title()
 
         # Verificar si el nombre de usuario y contraseña coinciden con los valores cargados de la configuración
+        _, _, _, _, valid_user, valid_password = configuracion()
         if username == valid_user and password == valid_password:
             st.session_state.logged_in = True
             st.session_state.user_rol = "admin"  # Puedes personalizar el rol según sea necesario
@@ -50,6 +42,8 @@ def main():
     # st.image("img/logo-six-gym-fondo-amarillo.png", use_column_width= "always")
 
     if logged_in:
+        # La app (pandas, boto3, storage) se importa recién después del login
+        from app import main as app, mostrar_panel_metricas
         app()
         # st.sidebar.title("Menú")
 
@@ -64,6 +58,9 @@ def main():
 
         st.write(f"Usuario: {user_nombre_apellido}")
 
+        if user_rol == "admin":
+            mostrar_panel_metricas()
+
     else:
         with st.form(key="login_form"):
             username = st.text_input("Nombre de Usuario:")
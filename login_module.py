@@ -1,11 +1,11 @@
 # login_module.py
 
 import streamlit as st
-from config import cargar_configuracion
+from recursos import configuracion
 
 def login(username, password):
     # Cargar configuración
-    _, _, _, _, valid_user, valid_password = cargar_configuracion()
+    _, _, _, _, valid_user, valid_password = configuracion()
 
     # Verifica si el usuario y la contraseña son correctos
     if username == valid_user and password == valid_password:
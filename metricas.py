@@ -0,0 +1,179 @@
+import functools
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+
+from recursos import opcion
+
+# Mediciones de tiempo y tamaño de las llamadas a S3 y de cada sección de la página.
+# Cada rerun de Streamlit corre en su propio hilo, así que las mediciones del rerun
+# actual se guardan por hilo; además se acumulan las últimas de cada operación para
+# todo el proceso (todas las sesiones) y así calcular percentiles.
+
+# Cantidad de mediciones que se guardan por operación para los percentiles
+VENTANA = 1000
+
+# Si está configurado, las mediciones de cada rerun se agregan a este archivo JSON lines
+ARCHIVO_JSONL = opcion('metricas_jsonl')
+
+_historico = defaultdict(lambda: deque(maxlen=VENTANA))
+_historico_lock = threading.Lock()
+_archivo_lock = threading.Lock()
+_local = threading.local()
+
+def _guardar_en_archivo(registros):
+    if not ARCHIVO_JSONL or not registros:
+        return
+    with _archivo_lock, open(ARCHIVO_JSONL, 'a', encoding='utf-8') as f:
+        f.writelines(json.dumps(r, ensure_ascii=False) + '\n' for r in registros)
+
+def iniciar_rerun():
+    # Las mediciones del rerun anterior de esta sesión ya están completas
+    _guardar_en_archivo(getattr(_local, 'registros', None))
+    _local.registros = []
+    _local.inicio = time.perf_counter()
+
+def registros_del_rerun():
+    return list(getattr(_local, 'registros', []))
+
+def duracion_del_rerun():
+    inicio = getattr(_local, 'inicio', None)
+    return time.perf_counter() - inicio if inicio is not None else 0
+
+def registrar(nombre, tipo, segundos, bytes_transferidos=0):
+    registro = {
+        'momento': datetime.now().isoformat(timespec='milliseconds'),
+        'nombre': nombre,
+        'tipo': tipo,
+        'ms': round(segundos * 1000, 3),
+        'bytes': bytes_transferidos,
+        'hilo': threading.current_thread().name,
+    }
+    registros = getattr(_local, 'registros', None)
+    if registros is not None:
+        registros.append(registro)
+    with _historico_lock:
+        _historico[(tipo, nombre)].append(registro)
+
+# Uso: "with medir('parse cargas_diesel.csv', 'parse'):" o como decorador con medido()
+@contextmanager
+def medir(nombre, tipo='seccion'):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar(nombre, tipo, time.perf_counter() - inicio)
+
+def medido(nombre, tipo='seccion'):
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with medir(nombre, tipo):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+# Percentiles de las últimas mediciones de cada operación
+def resumen():
+    with _historico_lock:
+        copia = {clave: list(registros) for clave, registros in _historico.items()}
+
+    filas = []
+    for (tipo, nombre), registros in sorted(copia.items()):
+        tiempos = np.array([r['ms'] for r in registros])
+        filas.append({
+            'tipo': tipo,
+            'nombre': nombre,
+            'cantidad': len(registros),
+            'p50 ms': round(float(np.percentile(tiempos, 50)), 1),
+            'p90 ms': round(float(np.percentile(tiempos, 90)), 1),
+            'p99 ms': round(float(np.percentile(tiempos, 99)), 1),
+            'bytes': int(sum(r['bytes'] for r in registros)),
+        })
+    return filas
+
+def exportar_jsonl():
+    with _historico_lock:
+        registros = sorted((r for rs in _historico.values() for r in rs), key=lambda r: r['momento'])
+    return ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in registros)
+
+# Los deltas y las partes Parquet tienen claves únicas; se agrupan por archivo
+def _agrupar_clave(clave):
+    if clave is None:
+        return ''
+    if '.deltas/' in clave:
+        return clave.split('.deltas/', 1)[0] + '.deltas/*'
+    if clave.startswith('parquet/'):
+        return '/'.join(clave.split('/')[:2]) + '/*'
+    return clave
+
+# Cliente de S3 que mide cada llamada. En get_object el cuerpo se descarga dentro
+# de la medición para que el tiempo de red no quede mezclado con el de parseo.
+class ClienteMedido:
+    def __init__(self, cliente):
+        self._cliente = cliente
+
+    def __getattr__(self, nombre):
+        return getattr(self._cliente, nombre)
+
+    def _llamar(self, operacion, clave, funcion, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            respuesta = funcion(**kwargs)
+        except Exception:
+            registrar(f"{operacion} {clave}", 's3', time.perf_counter() - inicio)
+            raise
+        return respuesta, inicio
+
+    def get_object(self, **kwargs):
+        respuesta, inicio = self._llamar('GET', _agrupar_clave(kwargs.get('Key')), self._cliente.get_object, **kwargs)
+        contenido = respuesta['Body'].read()
+        respuesta['Body'] = BytesIO(contenido)
+        registrar(f"GET {_agrupar_clave(kwargs.get('Key'))}", 's3', time.perf_counter() - inicio, len(contenido))
+        return respuesta
+
+    def put_object(self, **kwargs):
+        respuesta, inicio = self._llamar('PUT', _agrupar_clave(kwargs.get('Key')), self._cliente.put_object, **kwargs)
+        cuerpo = kwargs.get('Body', b'')
+        registrar(f"PUT {_agrupar_clave(kwargs.get('Key'))}", 's3', time.perf_counter() - inicio, len(cuerpo))
+        return respuesta
+
+    def upload_part(self, **kwargs):
+        respuesta, inicio = self._llamar('PUT', _agrupar_clave(kwargs.get('Key')), self._cliente.upload_part, **kwargs)
+        registrar(f"PUT {_agrupar_clave(kwargs.get('Key'))} (parte)", 's3', time.perf_counter() - inicio, len(kwargs.get('Body', b'')))
+        return respuesta
+
+    def head_object(self, **kwargs):
+        respuesta, inicio = self._llamar('HEAD', _agrupar_clave(kwargs.get('Key')), self._cliente.head_object, **kwargs)
+        registrar(f"HEAD {_agrupar_clave(kwargs.get('Key'))}", 's3', time.perf_counter() - inicio)
+        return respuesta
+
+    def delete_objects(self, **kwargs):
+        respuesta, inicio = self._llamar('DELETE', 'objetos', self._cliente.delete_objects, **kwargs)
+        registrar("DELETE objetos", 's3', time.perf_counter() - inicio)
+        return respuesta
+
+    def get_paginator(self, operacion):
+        return _PaginadorMedido(self._cliente.get_paginator(operacion), operacion)
+
+class _PaginadorMedido:
+    def __init__(self, paginador, operacion):
+        self._paginador = paginador
+        self._operacion = operacion
+
+    def paginate(self, **kwargs):
+        paginas = iter(self._paginador.paginate(**kwargs))
+        while True:
+            inicio = time.perf_counter()
+            try:
+                pagina = next(paginas)
+            except StopIteration:
+                return
+            registrar(f"LIST {kwargs.get('Prefix', '')}", 's3', time.perf_counter() - inicio)
+            yield pagina
@@ -0,0 +1,90 @@
+import threading
+
+import config
+
+# Recursos compartidos por todo el proceso (todas las sesiones y reruns de
+# Streamlit): la configuración leída una sola vez y un único cliente de S3.
+# Se crean la primera vez que se piden, así la pantalla de login no importa
+# boto3 ni pandas ni abre conexiones.
+
+# Conexiones que el cliente mantiene abiertas (lecturas en paralelo de deltas,
+# partes Parquet y los dos archivos de la cola de escritura)
+MAX_CONEXIONES = 32
+
+_recursos = {}
+_lock = threading.RLock()
+
+def configuracion():
+    valor = _recursos.get('configuracion')
+    if valor is None:
+        with _lock:
+            if 'configuracion' not in _recursos:
+                _recursos['configuracion'] = config.cargar_configuracion()
+            valor = _recursos['configuracion']
+    return valor
+
+def opcion(nombre, defecto=None):
+    opciones = _recursos.setdefault('opciones', {})
+    if nombre not in opciones:
+        leer = _recursos.get('leer_opcion', config.cargar_opcion)
+        opciones[nombre] = leer(nombre)
+    valor = opciones[nombre]
+    return defecto if valor is None else valor
+
+# Reemplaza una opción de los secrets en este proceso (antes de que se lea)
+def fijar_opcion(nombre, valor):
+    with _lock:
+        _recursos.setdefault('opciones', {})[nombre] = valor
+
+def bucket():
+    return configuracion()[3]
+
+def _crear_cliente_s3():
+    # Con "s3_local_dir" se usa una carpeta local en lugar de S3 (ver s3_local.py)
+    s3_local_dir = opcion('s3_local_dir')
+    if s3_local_dir:
+        from s3_local import S3Local
+        cliente = S3Local(s3_local_dir)
+    else:
+        import boto3
+        from botocore.config import Config
+
+        aws_access_key, aws_secret_key, region_name, _, _, _ = configuracion()
+        cliente = boto3.client(
+            's3',
+            aws_access_key_id=aws_access_key,
+            aws_secret_access_key=aws_secret_key,
+            region_name=region_name,
+            config=Config(
+                max_pool_connections=opcion('s3_max_conexiones', MAX_CONEXIONES),
+                retries={'max_attempts': 5, 'mode': 'adaptive'},
+                connect_timeout=5,
+                read_timeout=30,
+                tcp_keepalive=True,
+            )
+        )
+
+    # Todas las llamadas a S3 quedan medidas (tiempo y bytes) para el panel de rendimiento
+    from metricas import ClienteMedido
+    return ClienteMedido(cliente)
+
+# Los clientes de boto3 se pueden usar desde varios hilos a la vez
+def cliente_s3():
+    cliente = _recursos.get('s3')
+    if cliente is None:
+        with _lock:
+            if 's3' not in _recursos:
+                _recursos['s3'] = _crear_cliente_s3()
+            cliente = _recursos['s3']
+    return cliente
+
+# Para benchmarks y pruebas: reemplaza la configuración (tupla como la de
+# cargar_configuracion) y las opciones antes de que se usen; las opciones que
+# no estén en el diccionario quedan sin valor en lugar de leerse de los secrets
+def inyectar(configuracion=None, opciones=None):
+    with _lock:
+        _recursos.clear()
+        if configuracion is not None:
+            _recursos['configuracion'] = configuracion
+        if opciones is not None:
+            _recursos['leer_opcion'] = dict(opciones).get
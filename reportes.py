@@ -0,0 +1,279 @@
+import io
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+import storage
+from esquema import aplicar
+from recursos import bucket, cliente_s3
+from storage import COLUMNAS_ID, ConflictoDeEscritura, es_conflicto, esperar_reintento
+
+# Reportes mensuales y anuales de combustible y servicios por coche y depósito.
+# El historial se recorre de a bloques sin cargarlo entero: la base CSV se lee con
+# GETs por rango y read_csv por partes, en Parquet se lee un mes a la vez y con
+# fragmentos por depósito un fragmento a la vez. De cada bloque solo quedan las
+# sumas por mes y coche, así que la memoria depende de la cantidad de meses y
+# coches y no de la cantidad de cargas. El reporte se escribe a medida que se
+# generan sus filas (CSV o Excel) y se puede subir a S3 con una subida multipart.
+#
+# Los deltas y lápidas de cada archivo son chicos (la compactación los mantiene
+# acotados): se leen completos y las filas de la base que corrigen o borran se
+# descartan al recorrerla. Lo que todavía está en la cola de escritura no se incluye.
+
+# Bytes de cada GET por rango sobre la base CSV
+TAMANO_RANGO = 8 * 1024 * 1024
+
+# Filas por bloque de read_csv
+FILAS_POR_BLOQUE = 50_000
+
+# Tamaño de cada parte de la subida multipart (S3 pide al menos 5 MB, salvo la última)
+TAMANO_PARTE = 8 * 1024 * 1024
+
+# Depósito de los coches que no están en el registro de la flota
+SIN_DEPOSITO = 'Sin depósito'
+
+COLUMNAS = ['periodo', 'deposito', 'coche', 'cargas', 'litros', 'servicios', 'litrosPorServicio']
+
+# Lee un objeto como archivo con GETs por rango. Todos los rangos piden el mismo
+# ETag: si el objeto se reescribe en el medio se lanza ConflictoDeEscritura.
+class _LectorPorRangos(io.RawIOBase):
+    def __init__(self, key):
+        self.key = key
+        self.posicion = 0
+        self.etag = None
+        self.total = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, destino):
+        if self.total is not None and self.posicion >= self.total:
+            return 0
+        fin = self.posicion + min(len(destino), TAMANO_RANGO) - 1
+        condicion = {'IfMatch': self.etag} if self.etag is not None else {}
+        try:
+            obj = cliente_s3().get_object(Bucket=bucket(), Key=self.key, Range=f"bytes={self.posicion}-{fin}", **condicion)
+        except ClientError as e:
+            codigo = e.response['Error']['Code']
+            if codigo == 'InvalidRange':
+                self.total = self.posicion
+                return 0
+            if es_conflicto(e):
+                raise ConflictoDeEscritura(self.key) from e
+            raise
+        contenido = obj['Body'].read()
+        self.etag = obj['ETag']
+        self.total = int(obj['ContentRange'].rsplit('/', 1)[1]) if 'ContentRange' in obj else len(contenido)
+        destino[:len(contenido)] = contenido
+        self.posicion += len(contenido)
+        return len(contenido)
+
+# Un delta o una parte que desaparece entre el listado y la lectura es de una
+# compactación en curso: se trata como conflicto y el reporte vuelve a empezar
+@contextmanager
+def _borrados_como_conflicto(key):
+    try:
+        yield
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        raise ConflictoDeEscritura(key) from e
+
+def _bloques_base(key, filename, columnas, descartar):
+    try:
+        cliente_s3().head_object(Bucket=bucket(), Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return
+        raise
+
+    columna_id = COLUMNAS_ID[filename]
+    lector = io.BufferedReader(_LectorPorRangos(key), buffer_size=TAMANO_RANGO)
+    for bloque in pd.read_csv(lector, usecols=lambda c: c.strip() in columnas, chunksize=FILAS_POR_BLOQUE):
+        bloque.columns = [c.strip() for c in bloque.columns]
+        if descartar:
+            bloque = bloque[~bloque[columna_id].isin(descartar)]
+        yield aplicar(bloque, filename)
+
+# Base + deltas de un archivo CSV (o de un fragmento): primero los deltas ya
+# combinados (con correcciones y lápidas aplicadas), después la base por bloques
+# sin las filas que los deltas corrigen o borran
+def _bloques_csv(key, filename, columnas):
+    columna_id = COLUMNAS_ID[filename]
+    with _borrados_como_conflicto(key):
+        partes, lapidas = storage._leer_deltas(storage._listar_deltas(key))
+    descartar = set()
+    for lapida in lapidas:
+        descartar.update(lapida[columna_id].tolist())
+    if partes:
+        deltas = storage._combinar(key, None, partes, lapidas)
+        descartar.update(deltas[columna_id].tolist())
+        yield deltas[[c for c in deltas.columns if c in columnas or c == 'deposito']]
+    yield from _bloques_base(key, filename, columnas, descartar)
+
+# Un mes a la vez, sin pasar por la caché (cada partición se usa una sola vez)
+def _bloques_parquet(filename, columnas):
+    import storage_parquet
+    for _, partes in sorted(storage_parquet._listar_particiones(filename).items()):
+        with _borrados_como_conflicto(filename):
+            leidas = [
+                pd.read_parquet(io.BytesIO(cliente_s3().get_object(Bucket=bucket(), Key=k)['Body'].read()), columns=columnas)
+                for k, _ in partes
+            ]
+        yield storage_parquet._combinar(filename, leidas)
+
+# Bloques con "columnas" de todo el historial de "filename", según el backend
+def bloques(filename, columnas):
+    columnas = list(dict.fromkeys([COLUMNAS_ID[filename]] + list(columnas)))
+    if storage.BACKEND == 'parquet':
+        yield from _bloques_parquet(filename, columnas)
+    elif storage.BACKEND == 'depositos':
+        import storage_depositos
+        for fragmento in storage_depositos._fragmentos():
+            yield from _bloques_csv(storage_depositos._clave(filename, fragmento), filename, columnas)
+    else:
+        yield from _bloques_csv(filename, filename, columnas)
+
+# Suma por mes, depósito y coche de cada bloque, acumulada sobre todos los bloques
+def _acumular(bloques_del_historial, valores):
+    acumulado = None
+    for bloque in bloques_del_historial:
+        bloque = bloque.dropna(subset=['fecha', 'coche'])
+        if bloque.empty:
+            continue
+        # to_period es mucho más rápido que strftime sobre cada fila
+        claves = [
+            bloque['fecha'].dt.to_period('M').rename('mes'),
+            bloque['deposito'].astype(object).where(lambda d: d.notna() & (d != ''), SIN_DEPOSITO),
+            'coche',
+        ]
+        parcial = bloque.groupby(claves, observed=True).agg(**valores)
+        acumulado = parcial if acumulado is None else acumulado.add(parcial, fill_value=0)
+    if acumulado is None:
+        vacio = pd.MultiIndex.from_arrays([pd.PeriodIndex([], freq='M'), [], []], names=['mes', 'deposito', 'coche'])
+        return pd.DataFrame(columns=list(valores), index=vacio)
+    return acumulado
+
+def _resumen_mensual(filename_cargas, filename_servicios):
+    cargas = _acumular(
+        bloques(filename_cargas, ['fecha', 'coche', 'litros']),
+        {'cargas': ('litros', 'size'), 'litros': ('litros', 'sum')}
+    )
+    servicios = _acumular(bloques(filename_servicios, ['fecha', 'coche']), {'servicios': ('coche', 'size')})
+    return cargas.join(servicios, how='outer').fillna(0).astype(int)
+
+def _resumen(periodo, intentos=storage.MAX_INTENTOS):
+    # Si la base se reescribe mientras se recorre (por ejemplo una compactación) se vuelve a empezar
+    for intento in range(intentos):
+        try:
+            mensual = _resumen_mensual('cargas_diesel.csv', 'servicios_realizados.csv')
+            break
+        except ConflictoDeEscritura:
+            esperar_reintento(intento)
+    else:
+        raise ConflictoDeEscritura('cargas_diesel.csv')
+
+    if periodo == 'mensual':
+        return mensual.rename_axis(['periodo', 'deposito', 'coche'])
+    anios = mensual.index.get_level_values('mes').asfreq('Y')
+    return mensual.groupby(
+        [anios.rename('periodo'), mensual.index.get_level_values('deposito'), mensual.index.get_level_values('coche')]
+    ).sum()
+
+# Filas del reporte de a un período: cada coche y, al final de cada depósito, su total
+def filas(periodo='mensual'):
+    resumen = _resumen(periodo).sort_index()
+    for (nombre, deposito), grupo in resumen.groupby(level=['periodo', 'deposito'], sort=True):
+        for (_, _, coche), fila in grupo.iterrows():
+            yield _fila(nombre, deposito, coche, fila)
+        yield _fila(nombre, deposito, 'Total', grupo.sum())
+
+def _fila(periodo, deposito, coche, valores):
+    servicios = int(valores['servicios'])
+    litros = int(valores['litros'])
+    return (str(periodo), deposito, coche, int(valores['cargas']), litros, servicios,
+            round(litros / servicios) if servicios else None)
+
+# CSV por partes: cada parte son los bytes de varias filas
+def partes_csv(filas_del_reporte, filas_por_parte=10_000):
+    pendientes = [COLUMNAS]
+    for fila in filas_del_reporte:
+        pendientes.append(fila)
+        if len(pendientes) >= filas_por_parte:
+            yield _a_bytes(pendientes)
+            pendientes = []
+    if pendientes:
+        yield _a_bytes(pendientes)
+
+def _a_bytes(filas_csv):
+    texto = io.StringIO()
+    pd.DataFrame(filas_csv).to_csv(texto, index=False, header=False)
+    return texto.getvalue().encode('utf-8')
+
+# Excel en modo solo escritura: openpyxl va pasando las filas a un archivo temporal
+# en lugar de armar la hoja en memoria
+def escribir_xlsx(filas_del_reporte, destino, titulo='Reporte'):
+    from openpyxl import Workbook
+
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet(titulo)
+    hoja.append(COLUMNAS)
+    for fila in filas_del_reporte:
+        hoja.append(list(fila))
+    libro.save(destino)
+
+def partes_xlsx(filas_del_reporte, titulo='Reporte', tamano=TAMANO_PARTE):
+    with tempfile.TemporaryFile() as archivo:
+        escribir_xlsx(filas_del_reporte, archivo, titulo)
+        archivo.seek(0)
+        while True:
+            parte = archivo.read(tamano)
+            if not parte:
+                return
+            yield parte
+
+# Sube las partes a S3 juntándolas hasta TAMANO_PARTE; si algo falla la subida se cancela
+def subir_a_s3(partes, key):
+    s3 = cliente_s3()
+    subida = s3.create_multipart_upload(Bucket=bucket(), Key=key)
+    subidas, pendiente = [], bytearray()
+
+    def subir(contenido):
+        respuesta = s3.upload_part(
+            Bucket=bucket(), Key=key, UploadId=subida['UploadId'], PartNumber=len(subidas) + 1, Body=bytes(contenido)
+        )
+        subidas.append({'PartNumber': len(subidas) + 1, 'ETag': respuesta['ETag']})
+
+    try:
+        for parte in partes:
+            pendiente += parte
+            if len(pendiente) >= TAMANO_PARTE:
+                subir(pendiente)
+                pendiente = bytearray()
+        if pendiente or not subidas:
+            subir(pendiente)
+        s3.complete_multipart_upload(
+            Bucket=bucket(), Key=key, UploadId=subida['UploadId'], MultipartUpload={'Parts': subidas}
+        )
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket(), Key=key, UploadId=subida['UploadId'])
+        raise
+    return key
+
+def partes(periodo='mensual', formato='csv'):
+    if formato == 'xlsx':
+        return partes_xlsx(filas(periodo), titulo=periodo.capitalize())
+    return partes_csv(filas(periodo))
+
+def clave_en_s3(periodo, formato):
+    return f"reportes/{periodo}-{datetime.now():%Y%m%d-%H%M%S}.{formato}"
+
+if __name__ == "__main__":
+    import sys
+
+    periodo = sys.argv[1] if len(sys.argv) > 1 else 'mensual'
+    formato = sys.argv[2] if len(sys.argv) > 2 else 'csv'
+    print(subir_a_s3(partes(periodo, formato), clave_en_s3(periodo, formato)))
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from io import BytesIO
+
+from botocore.exceptions import ClientError
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se protege entre hilos del mismo proceso
+    fcntl = None
+
+# Reemplazo local de S3 sobre el sistema de archivos, para desarrollo, pruebas y
+# benchmarks. Implementa las operaciones del cliente de boto3 que usa la app
+# (incluidas las escrituras condicionales If-Match / If-None-Match y los GET por
+# rango) y devuelve los mismos errores (ClientError con el mismo código).
+#
+# Cada objeto vive en <raiz>/<bucket>/<clave>, su ETag en <raiz>/.etags/<bucket>/<clave>
+# y su metadata (si tiene) en <raiz>/.meta/<bucket>/<clave>. Las partes de una subida
+# multipart quedan en <raiz>/.multipart/<upload_id>/ hasta completarla.
+
+def _error(codigo, status, operacion, mensaje=''):
+    return ClientError(
+        {'Error': {'Code': codigo, 'Message': mensaje}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+        operacion
+    )
+
+class _Paginador:
+    def __init__(self, cliente):
+        self.cliente = cliente
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            if token is not None:
+                kwargs['ContinuationToken'] = token
+            pagina = self.cliente.list_objects_v2(**kwargs)
+            yield pagina
+            if not pagina.get('IsTruncated'):
+                return
+            token = pagina['NextContinuationToken']
+
+class S3Local:
+    def __init__(self, raiz):
+        self.raiz = os.path.abspath(raiz)
+        os.makedirs(self.raiz, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _ruta(self, bucket, key):
+        return os.path.join(self.raiz, bucket, *key.split('/'))
+
+    def _ruta_etag(self, bucket, key):
+        return os.path.join(self.raiz, '.etags', bucket, *key.split('/'))
+
+    def _ruta_meta(self, bucket, key):
+        return os.path.join(self.raiz, '.meta', bucket, *key.split('/'))
+
+    def _metadata(self, bucket, key):
+        try:
+            with open(self._ruta_meta(bucket, key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    # Bloqueo entre hilos y, si se puede, entre procesos que comparten la carpeta
+    class _Bloqueo:
+        def __init__(self, s3):
+            self.s3 = s3
+
+        def __enter__(self):
+            self.s3._lock.acquire()
+            if fcntl is not None:
+                self.archivo = open(os.path.join(self.s3.raiz, '.lock'), 'a')
+                fcntl.flock(self.archivo, fcntl.LOCK_EX)
+            return self
+
+        def __exit__(self, *exc):
+            if fcntl is not None:
+                fcntl.flock(self.archivo, fcntl.LOCK_UN)
+                self.archivo.close()
+            self.s3._lock.release()
+
+    def _etag(self, bucket, key):
+        try:
+            with open(self._ruta_etag(bucket, key)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _escribir_atomico(self, ruta, contenido):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        fd, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+
+    def _verificar_condiciones(self, etag, operacion, IfMatch=None, IfNoneMatch=None, lectura=False):
+        if IfMatch is not None and (etag is None or IfMatch not in ('*', etag)):
+            if etag is None and not lectura:
+                raise _error('NoSuchKey', 404, operacion)
+            raise _error('PreconditionFailed', 412, operacion)
+        if IfNoneMatch is not None and etag is not None and IfNoneMatch in ('*', etag):
+            if lectura:
+                raise _error('304', 304, operacion, 'Not Modified')
+            raise _error('PreconditionFailed', 412, operacion)
+
+    def head_object(self, Bucket, Key, IfMatch=None, IfNoneMatch=None):
+        etag = self._etag(Bucket, Key)
+        if etag is None:
+            raise _error('404', 404, 'HeadObject', 'Not Found')
+        self._verificar_condiciones(etag, 'HeadObject', IfMatch, IfNoneMatch, lectura=True)
+        return {
+            'ETag': etag, 'ContentLength': os.path.getsize(self._ruta(Bucket, Key)),
+            'Metadata': self._metadata(Bucket, Key)
+        }
+
+    def get_object(self, Bucket, Key, IfMatch=None, IfNoneMatch=None, Range=None):
+        with self._Bloqueo(self):
+            etag = self._etag(Bucket, Key)
+            if etag is None:
+                raise _error('NoSuchKey', 404, 'GetObject', 'The specified key does not exist.')
+            self._verificar_condiciones(etag, 'GetObject', IfMatch, IfNoneMatch, lectura=True)
+            # Con Range se lee solo ese tramo del archivo, como en S3
+            with open(self._ruta(Bucket, Key), 'rb') as f:
+                total = os.fstat(f.fileno()).st_size
+                if Range is None:
+                    contenido = f.read()
+                else:
+                    inicio, _, fin = Range.replace('bytes=', '').partition('-')
+                    inicio = int(inicio)
+                    fin = min(int(fin), total - 1) if fin else total - 1
+                    if inicio >= total:
+                        raise _error('InvalidRange', 416, 'GetObject')
+                    f.seek(inicio)
+                    contenido = f.read(fin - inicio + 1)
+            metadata = self._metadata(Bucket, Key)
+
+        respuesta = {'ETag': etag, 'Metadata': metadata}
+        if Range is not None:
+            respuesta['ContentRange'] = f"bytes {inicio}-{fin}/{total}"
+        respuesta['ContentLength'] = len(contenido)
+        respuesta['Body'] = BytesIO(contenido)
+        return respuesta
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, Metadata=None, **kwargs):
+        contenido = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        etag = f'"{hashlib.md5(contenido).hexdigest()}"'
+        with self._Bloqueo(self):
+            self._verificar_condiciones(self._etag(Bucket, Key), 'PutObject', IfMatch, IfNoneMatch)
+            self._escribir_atomico(self._ruta(Bucket, Key), contenido)
+            self._escribir_atomico(self._ruta_etag(Bucket, Key), etag.encode('utf-8'))
+            self._escribir_atomico(self._ruta_meta(Bucket, Key), json.dumps(Metadata or {}).encode('utf-8'))
+        return {'ETag': etag}
+
+    # Subidas multipart: cada parte se guarda aparte y al completar se unen en orden
+    def _ruta_multipart(self, upload_id, numero=None):
+        ruta = os.path.join(self.raiz, '.multipart', upload_id)
+        return ruta if numero is None else os.path.join(ruta, f"{int(numero):05d}")
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._ruta_multipart(upload_id))
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        if not os.path.isdir(self._ruta_multipart(UploadId)):
+            raise _error('NoSuchUpload', 404, 'UploadPart')
+        contenido = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        self._escribir_atomico(self._ruta_multipart(UploadId, PartNumber), contenido)
+        return {'ETag': f'"{hashlib.md5(contenido).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        if not os.path.isdir(self._ruta_multipart(UploadId)):
+            raise _error('NoSuchUpload', 404, 'CompleteMultipartUpload')
+        partes, resumenes = [], []
+        for parte in MultipartUpload['Parts']:
+            with open(self._ruta_multipart(UploadId, parte['PartNumber']), 'rb') as f:
+                contenido = f.read()
+            if f'"{hashlib.md5(contenido).hexdigest()}"' != parte['ETag']:
+                raise _error('InvalidPart', 400, 'CompleteMultipartUpload')
+            partes.append(contenido)
+            resumenes.append(hashlib.md5(contenido).digest())
+
+        # Como S3: el ETag es el MD5 de los MD5 de las partes más la cantidad de partes
+        etag = f'"{hashlib.md5(b"".join(resumenes)).hexdigest()}-{len(partes)}"'
+        with self._Bloqueo(self):
+            self._escribir_atomico(self._ruta(Bucket, Key), b''.join(partes))
+            self._escribir_atomico(self._ruta_etag(Bucket, Key), etag.encode('utf-8'))
+            self._escribir_atomico(self._ruta_meta(Bucket, Key), b'{}')
+        shutil.rmtree(self._ruta_multipart(UploadId), ignore_errors=True)
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        shutil.rmtree(self._ruta_multipart(UploadId), ignore_errors=True)
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        with self._Bloqueo(self):
+            for ruta in (self._ruta(Bucket, Key), self._ruta_etag(Bucket, Key), self._ruta_meta(Bucket, Key)):
+                try:
+                    os.remove(ruta)
+                except FileNotFoundError:
+                    pass
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        for objeto in Delete['Objects']:
+            self.delete_object(Bucket=Bucket, Key=objeto['Key'])
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000):
+        base = os.path.join(self.raiz, Bucket)
+        claves = []
+        for carpeta, _, archivos in os.walk(base):
+            for archivo in archivos:
+                if archivo.startswith('.tmp-'):
+                    continue
+                key = os.path.relpath(os.path.join(carpeta, archivo), base).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    claves.append(key)
+        claves.sort()
+
+        if ContinuationToken is not None:
+            claves = [k for k in claves if k > ContinuationToken]
+        pagina = claves[:MaxKeys]
+
+        respuesta = {
+            'KeyCount': len(pagina),
+            'IsTruncated': len(claves) > MaxKeys,
+            'Contents': [
+                {'Key': k, 'ETag': self._etag(Bucket, k), 'Size': os.path.getsize(self._ruta(Bucket, k))}
+                for k in pagina
+            ],
+        }
+        if respuesta['IsTruncated']:
+            respuesta['NextContinuationToken'] = pagina[-1]
+        if not pagina:
+            del respuesta['Contents']
+        return respuesta
+
+    def get_paginator(self, operacion):
+        if operacion != 'list_objects_v2':
+            raise NotImplementedError(operacion)
+        return _Paginador(self)
@@ -0,0 +1,600 @@
+import random
+import threading
+import time
+import uuid
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from botocore.exceptions import ClientError
+
+from esquema import a_csv, columnas_guardadas, concatenar, leer_csv, serializar
+from flota import deposito_de
+from metricas import medir
+from recursos import bucket, cliente_s3, opcion
+
+# Formato de almacenamiento: "csv" (base + deltas), "parquet" (particionado por mes,
+# ver storage_parquet.py) o "depositos" (CSV fragmentado por depósito, ver storage_depositos.py)
+BACKEND = opcion('storage_backend', 'csv')
+
+# Columna identificadora de cada archivo, usada para descartar filas repetidas
+# cuando una compactación y una lectura se cruzan
+COLUMNAS_ID = {
+    'cargas_diesel.csv': 'idCarga',
+    'servicios_realizados.csv': 'idServis',
+}
+
+# Cantidad de deltas a partir de la cual se dispara la compactación en segundo plano
+UMBRAL_COMPACTACION = 50
+
+_compactando = set()
+_compactando_lock = threading.Lock()
+
+# Reintentos de una escritura condicional que perdió contra otra
+MAX_INTENTOS = 8
+
+# Cantidad de IDs que cada proceso reserva de una vez; las sesiones del proceso
+# los toman de memoria sin ir a S3. Con el espejo SQLite conviene un bloque más
+# grande ("ids_por_bloque"), así se puede seguir registrando si S3 no responde.
+TAMANO_BLOQUE_IDS = int(opcion('ids_por_bloque', 10))
+
+_bloques_ids = {}
+_bloques_ids_lock = threading.Lock()
+
+# Índice de IDs (posición de cada ID en el DataFrame) de la última versión de cada archivo
+_indices_ids = {}
+
+# Otra escritura modificó el objeto entre que lo leímos y lo quisimos escribir
+class ConflictoDeEscritura(Exception):
+    pass
+
+def es_conflicto(error):
+    codigo = error.response['Error']['Code']
+    return codigo in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+
+def esperar_reintento(intento):
+    time.sleep(random.uniform(0, 0.05 * 2 ** intento))
+
+# Caché compartida por todo el proceso (todas las sesiones y reruns de Streamlit).
+# _cache guarda cada objeto parseado por (bucket, clave) junto a su ETag, y
+# _cache_combinado el resultado de base + deltas según la firma de ETags que lo formó.
+_cache = {}
+_cache_combinado = {}
+_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0, 'incrementales': 0}
+
+# Para cada objeto leído o escrito se recuerda su ETag, su generación, su largo y
+# sus últimos bytes. La generación (metadata "generacion") cambia con cada
+# reescritura completa y se conserva cuando el objeto solo crece al final (la
+# compactación agrega los deltas a continuación de la base). Así, si la
+# generación es la misma, alcanza con pedir con un GET por rango lo que se agregó.
+LARGO_COLA = 256
+_colas = {}
+
+def _contar(evento):
+    with _cache_lock:
+        _cache_stats[evento] += 1
+
+def cache_stats():
+    with _cache_lock:
+        return dict(_cache_stats)
+
+def _guardar_en_cache(key, etag, data):
+    with _cache_lock:
+        _cache[(bucket(), key)] = (etag, data)
+
+def _invalidar_cache(claves):
+    with _cache_lock:
+        for key in claves:
+            _cache.pop((bucket(), key), None)
+            _colas.pop((bucket(), key), None)
+
+def _recordar_cola(key, etag, generacion, contenido):
+    with _cache_lock:
+        _colas[(bucket(), key)] = (etag, generacion, len(contenido), contenido[-LARGO_COLA:])
+
+# Cada archivo se guarda como un objeto base más una serie de deltas pequeños
+# (solo las filas nuevas) bajo el prefijo "<archivo>.deltas/". Las claves de los
+# deltas empiezan con un timestamp, así que el orden lexicográfico es el de escritura.
+# Un delta con filas cuyo ID ya existe las corrige, y las lápidas (deltas terminados
+# en ".borrados.csv", con solo la columna ID) marcan filas borradas. Las dos cosas se
+# aplican al leer y desaparecen en la próxima compactación.
+SUFIJO_LAPIDA = '.borrados.csv'
+
+def _prefijo_deltas(filename):
+    return f"{filename}.deltas/"
+
+def _es_lapida(key):
+    return key.endswith(SUFIJO_LAPIDA)
+
+# Archivo al que pertenece una clave (la base o uno de sus deltas, también dentro
+# de un fragmento por depósito)
+def _archivo_de(key):
+    return key.split('.deltas/', 1)[0].rsplit('/', 1)[-1]
+
+# Devuelve [(clave, etag)] de los deltas ordenados por clave
+def _listar_deltas(filename):
+    deltas = []
+    paginator = cliente_s3().get_paginator('list_objects_v2')
+    for pagina in paginator.paginate(Bucket=bucket(), Prefix=_prefijo_deltas(filename)):
+        deltas.extend((item['Key'], item['ETag']) for item in pagina.get('Contents', []))
+    return sorted(deltas)
+
+# Lee un CSV usando la caché. Si se conoce el ETag actual (los deltas lo traen del
+# listado y nunca cambian) no hace falta ir a S3; si no, se revalida con If-None-Match
+# y solo se descarga y parsea cuando el objeto cambió. Devuelve (etag, DataFrame).
+def _leer_csv(key, etag=None):
+    with _cache_lock:
+        en_cache = _cache.get((bucket(), key))
+
+    if en_cache is not None and etag is not None and en_cache[0] == etag:
+        _contar('hits')
+        return en_cache
+
+    with _cache_lock:
+        cola = _colas.get((bucket(), key))
+    if en_cache is not None and cola is not None and cola[0] == en_cache[0]:
+        resultado = _leer_agregado(key, en_cache, cola)
+        if resultado is not None:
+            return resultado
+
+    try:
+        if en_cache is not None:
+            obj = cliente_s3().get_object(Bucket=bucket(), Key=key, IfNoneMatch=en_cache[0])
+        else:
+            obj = cliente_s3().get_object(Bucket=bucket(), Key=key)
+    except ClientError as e:
+        if en_cache is not None and e.response['Error']['Code'] in ('304', 'NotModified'):
+            _contar('hits')
+            return en_cache
+        raise
+
+    _contar('misses')
+    contenido = obj['Body'].read()
+    with medir(f"parse {_archivo_de(key)}", 'parse'):
+        resultado = (obj['ETag'], leer_csv(BytesIO(contenido), _archivo_de(key)))
+    with _cache_lock:
+        _cache[(bucket(), key)] = resultado
+    _recordar_cola(key, obj['ETag'], obj.get('Metadata', {}).get('generacion'), contenido)
+    return resultado
+
+# Pide solo desde los últimos bytes conocidos hasta el final. Si el objeto no
+# cambió devuelve lo que está en caché; si solo creció, parsea únicamente las filas
+# nuevas. Devuelve None cuando fue reescrito y hay que leerlo completo.
+def _leer_agregado(key, en_cache, cola):
+    etag, generacion, largo, final = cola
+    if generacion is None:
+        return None
+    try:
+        obj = cliente_s3().get_object(Bucket=bucket(), Key=key, IfNoneMatch=etag, Range=f"bytes={largo - len(final)}-")
+    except ClientError as e:
+        codigo = e.response['Error']['Code']
+        if codigo in ('304', 'NotModified'):
+            _contar('hits')
+            return en_cache
+        if codigo == 'InvalidRange':
+            return None
+        raise
+
+    contenido = obj['Body'].read()
+    if (
+        obj.get('Metadata', {}).get('generacion') != generacion
+        or 'ContentRange' not in obj
+        or not contenido.startswith(final)
+    ):
+        return None
+
+    _contar('incrementales')
+    nuevo = contenido[len(final):]
+    columnas = columnas_guardadas(en_cache[1])
+    with medir(f"parse {key} (agregado)", 'parse'):
+        filas = leer_csv(BytesIO(nuevo), _archivo_de(key), header=None, names=columnas) if nuevo.strip() else None
+    data = concatenar([en_cache[1], filas], _archivo_de(key)) if filas is not None else en_cache[1]
+
+    resultado = (obj['ETag'], data)
+    total = int(obj['ContentRange'].rsplit('/', 1)[1])
+    with _cache_lock:
+        _cache[(bucket(), key)] = resultado
+        _colas[(bucket(), key)] = (obj['ETag'], generacion, total, contenido[-LARGO_COLA:])
+    return resultado
+
+def _leer_base(filename):
+    try:
+        return _leer_csv(filename)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        _invalidar_cache([filename])
+        return None, None
+
+# Deja una fila por ID: la última versión, en la posición de la primera. Así una
+# corrección no mueve la fila al final (el orden del archivo es el de las cargas).
+def quitar_repetidas(data, filename):
+    columna_id = COLUMNAS_ID.get(filename)
+    if columna_id not in data.columns or not data[columna_id].duplicated().any():
+        return data
+    ultimas = data[~data[columna_id].duplicated(keep='last')]
+    ids, primeras = np.unique(data[columna_id].to_numpy(), return_index=True)
+    posiciones = primeras[np.searchsorted(ids, ultimas[columna_id].to_numpy())]
+    return ultimas.iloc[np.argsort(posiciones, kind='stable')].reset_index(drop=True)
+
+def _combinar(filename, base, deltas, lapidas=()):
+    partes = [df for df in [base] + deltas if df is not None]
+    if not partes:
+        raise FileNotFoundError(filename)
+    archivo = _archivo_de(filename)
+    data = concatenar(partes, archivo) if len(partes) > 1 else partes[0].copy()
+
+    # Correcciones, o un delta ya incorporado a la base que todavía no se borró
+    if deltas:
+        data = quitar_repetidas(data, archivo)
+
+    columna_id = COLUMNAS_ID.get(archivo)
+    borrados = [l[columna_id] for l in lapidas if columna_id in l.columns]
+    if borrados and columna_id in data.columns:
+        data = data[~data[columna_id].isin(pd.concat(borrados))].reset_index(drop=True)
+    return data
+
+# Separa los deltas listados en filas y lápidas, leyendo cada uno con la caché.
+# Los deltas se listan siempre antes de leer la base: uno que desaparece entre el
+# listado y la lectura lo borró una compactación, que antes ya lo pasó a la base.
+def _leer_deltas(deltas):
+    partes, lapidas = [], []
+    for k, etag in deltas:
+        try:
+            leido = _leer_csv(k, etag)[1]
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            continue
+        (lapidas if _es_lapida(k) else partes).append(leido)
+    return partes, lapidas
+
+def _borrar_objetos(claves):
+    # delete_objects acepta hasta 1000 claves por llamada
+    for i in range(0, len(claves), 1000):
+        cliente_s3().delete_objects(
+            Bucket=bucket(),
+            Delete={'Objects': [{'Key': k} for k in claves[i:i + 1000]], 'Quiet': True}
+        )
+    _invalidar_cache(claves)
+
+def _poner_objeto(key, cuerpo, generacion, **condicion):
+    try:
+        respuesta = cliente_s3().put_object(
+            Bucket=bucket(), Key=key, Body=cuerpo, Metadata={'generacion': generacion}, **condicion
+        )
+    except ClientError as e:
+        if es_conflicto(e) or (condicion and e.response['Error']['Code'] == 'NoSuchKey'):
+            raise ConflictoDeEscritura(key) from e
+        raise
+    return respuesta['ETag']
+
+# "condicion" son los parámetros IfMatch / IfNoneMatch de la escritura condicional.
+# Es una reescritura completa, así que el objeto empieza una generación nueva.
+def _escribir_csv(data, key, **condicion):
+    cuerpo, leido = serializar(data, _archivo_de(key))
+    generacion = uuid.uuid4().hex
+    etag = _poner_objeto(key, cuerpo, generacion, **condicion)
+
+    # Lo que acabamos de escribir queda en caché (con los tipos de la lectura) para no volver a descargarlo
+    _guardar_en_cache(key, etag, leido)
+    _recordar_cola(key, etag, generacion, cuerpo.encode('utf-8'))
+    return etag
+
+def _combinar_con_cache(filename, base_etag, base, deltas):
+    firma = (base_etag, tuple(deltas))
+    with _cache_lock:
+        en_cache = _cache_combinado.get((bucket(), filename))
+    if en_cache is not None and en_cache[0] == firma:
+        return en_cache[1].copy()
+
+    data = _combinar(filename, base, *_leer_deltas(deltas))
+    with _cache_lock:
+        _cache_combinado[(bucket(), filename)] = (firma, data)
+    return data.copy()
+
+def _version_cargada(filename):
+    with _cache_lock:
+        en_cache = _cache_combinado.get((bucket(), filename))
+    return en_cache[0] if en_cache is not None else None
+
+# Mes ('YYYY-MM') de cada fila según su columna fecha
+def meses_de(data):
+    return pd.to_datetime(data['fecha'], format='ISO8601', errors='coerce').dt.strftime('%Y-%m').fillna('sin-fecha')
+
+# Filtra por meses, depósitos y columnas. El resultado queda marcado como parcial
+# para que no se use para reescribir el archivo completo.
+def filtrar(data, columnas=None, meses=None, depositos=None):
+    if meses is not None:
+        data = data[meses_de(data).isin(meses)]
+    if depositos is not None:
+        deposito = data['deposito'] if 'deposito' in data.columns else deposito_de(data['coche'])
+        data = data[deposito.isin(depositos)]
+        # Los datos de algunos depósitos son otra versión que los de toda la flota
+        if 'version' in data.attrs:
+            data.attrs['version'] = (data.attrs['version'], tuple(depositos))
+    if columnas is not None:
+        data = data[[c for c in columnas if c in data.columns]]
+    if meses is not None or columnas is not None or depositos is not None:
+        data.attrs['parcial'] = True
+    return data
+
+def _cargar_csv(filename, columnas=None, meses=None, depositos=None):
+    # Primero los deltas y después la base: si una compactación se cruza, la base
+    # leída ya tiene los deltas que falten y quitar_repetidas descarta los que sigan
+    deltas = _listar_deltas(filename)
+    base_etag, base = _leer_base(filename)
+    data = _combinar_con_cache(filename, base_etag, base, deltas)
+
+    # Firma de ETags que identifica esta versión de los datos
+    data.attrs['version'] = (base_etag, tuple(deltas))
+
+    # Recordar qué deltas contiene este DataFrame para poder borrarlos al reescribir
+    claves_deltas = [k for k, _ in deltas]
+    data.attrs['deltas'] = tuple(claves_deltas)
+
+    if len(claves_deltas) >= UMBRAL_COMPACTACION:
+        compact_csv_in_background(filename)
+
+    # En CSV hay que leer todo el archivo igual; el filtro solo reduce lo que se devuelve
+    return filtrar(data, columnas, meses, depositos)
+
+def _backend():
+    if BACKEND == 'parquet':
+        import storage_parquet
+        return storage_parquet
+    if BACKEND == 'depositos':
+        import storage_depositos
+        return storage_depositos
+    return None
+
+# Como load_csv_from_s3 pero los errores se propagan
+def _cargar(filename, columnas=None, meses=None, depositos=None):
+    backend = _backend()
+    if backend is not None:
+        return backend.cargar(filename, columnas, meses, depositos)
+    return _cargar_csv(filename, columnas, meses, depositos)
+
+# Funciones para cargar y actualizar datos desde y en S3.
+# "columnas", "meses" (lista de 'YYYY-MM') y "depositos" permiten leer solo lo necesario.
+def load_csv_from_s3(filename, columnas=None, meses=None, depositos=None):
+    try:
+        return _cargar(filename, columnas, meses, depositos)
+    except Exception as e:
+        st.error(f"Error al cargar {filename}: {e}")
+        return pd.DataFrame()
+
+def append_csv_to_s3(new_rows, filename):
+    backend = _backend()
+    if backend is not None:
+        return backend.agregar(new_rows, filename)
+    return _agregar_csv(new_rows, filename)
+
+def update_csv_in_s3(data, filename):
+    backend = _backend()
+    if backend is not None:
+        return backend.reescribir(data, filename)
+    return _reescribir_csv(data, filename)
+
+# Borra filas por ID sin reescribir el archivo (en CSV se escribe una lápida)
+def delete_rows_in_s3(filename, ids):
+    backend = _backend()
+    if backend is not None:
+        return backend.reemplazar(filename, ids, None)
+    return _borrar_csv(filename, ids)
+
+# Reemplaza filas existentes por ID (en CSV se escriben en un delta, como las nuevas)
+def correct_rows_in_s3(rows, filename):
+    backend = _backend()
+    if backend is not None:
+        return backend.reemplazar(filename, [], rows)
+    return _agregar_csv(rows, filename)
+
+def compact_csv_in_s3(filename):
+    backend = _backend()
+    if backend is not None:
+        return backend.compactar(filename)
+    return _compactar_csv(filename)
+
+# Lee, aplica "mutacion" (DataFrame -> DataFrame) y escribe solo si nadie escribió
+# en el medio. Si hubo conflicto se vuelve a leer y se reaplica la mutación sobre
+# los datos nuevos, así no se pierden las escrituras de otros operadores.
+def mutate_csv_in_s3(filename, mutacion):
+    backend = _backend()
+    if backend is not None:
+        return backend.mutar(filename, mutacion)
+
+    for intento in range(MAX_INTENTOS):
+        data = _cargar_csv(filename)
+        nueva = mutacion(data)
+        nueva.attrs.update({k: data.attrs[k] for k in ('version', 'deltas')})
+        try:
+            return _reescribir_csv(nueva, filename)
+        except ConflictoDeEscritura:
+            esperar_reintento(intento)
+    raise ConflictoDeEscritura(filename)
+
+# Filas con esos IDs, buscadas con un índice que se arma una vez por versión de los
+# datos (solo para DataFrames completos: con filtros las posiciones no coinciden)
+def filas_por_id(data, filename, ids):
+    columna_id = COLUMNAS_ID[filename]
+    version = data.attrs.get('version')
+    cacheable = version is not None and not data.attrs.get('parcial')
+
+    with _cache_lock:
+        en_cache = _indices_ids.get((bucket(), filename))
+    if cacheable and en_cache is not None and en_cache[0] == (version, len(data)):
+        indice = en_cache[1]
+    else:
+        indice = pd.Index(data[columna_id])
+        if cacheable and indice.is_unique:
+            with _cache_lock:
+                _indices_ids[(bucket(), filename)] = ((version, len(data)), indice)
+
+    if not indice.is_unique:
+        return data[data[columna_id].isin(ids)]
+    posiciones = indice.get_indexer(pd.Index(ids).astype(indice.dtype, copy=False))
+    return data.iloc[np.sort(posiciones[posiciones >= 0])]
+
+# Contador de IDs por archivo en "contadores/<archivo>.id": se incrementa con una
+# escritura condicional, así dos operadores nunca reciben el mismo ID
+def _clave_contador(filename):
+    return f"contadores/{filename}.id"
+
+# Sin pasar por load_csv_from_s3, que ante un error devuelve un DataFrame vacío:
+# el contador arrancaría en 0 y repetiría IDs. Solo un archivo inexistente es 0.
+def _maximo_id(filename):
+    columna_id = COLUMNAS_ID[filename]
+    try:
+        data = _cargar(filename, columnas=[columna_id])
+    except FileNotFoundError:
+        return 0
+    return int(data[columna_id].max()) if not data.empty and data[columna_id].notna().any() else 0
+
+def _reservar_en_s3(filename, cantidad):
+    key = _clave_contador(filename)
+    for intento in range(MAX_INTENTOS):
+        try:
+            obj = cliente_s3().get_object(Bucket=bucket(), Key=key)
+            ultimo, condicion = int(obj['Body'].read()), {'IfMatch': obj['ETag']}
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            # Primera vez: el contador arranca en el mayor ID existente
+            ultimo, condicion = _maximo_id(filename), {'IfNoneMatch': '*'}
+
+        try:
+            cliente_s3().put_object(Bucket=bucket(), Key=key, Body=str(ultimo + cantidad), **condicion)
+            return ultimo + 1
+        except ClientError as e:
+            if not es_conflicto(e):
+                raise
+            esperar_reintento(intento)
+    raise ConflictoDeEscritura(key)
+
+# Devuelve una lista con "cantidad" IDs nuevos y únicos para el archivo
+def reservar_ids(filename, cantidad=1):
+    with _bloques_ids_lock:
+        siguiente, limite = _bloques_ids.get(filename, (0, 0))
+        if limite - siguiente >= cantidad:
+            _bloques_ids[filename] = (siguiente + cantidad, limite)
+            return list(range(siguiente, siguiente + cantidad))
+
+        # Se pide a S3 lo que falta más un bloque para las próximas
+        reservados = cantidad + TAMANO_BLOQUE_IDS
+        inicio = _reservar_en_s3(filename, reservados)
+        _bloques_ids[filename] = (inicio + cantidad, inicio + reservados)
+        return list(range(inicio, inicio + cantidad))
+
+# Agrega filas nuevas escribiendo solo un delta: el costo no depende del tamaño del historial.
+# Devuelve la versión esperada de los datos después de la escritura.
+def _agregar_csv(new_rows, filename, sufijo='.csv'):
+    key = f"{_prefijo_deltas(filename)}{time.time_ns():020d}-{uuid.uuid4().hex}{sufijo}"
+    etag = _escribir_csv(new_rows, key)
+
+    version = _version_cargada(filename)
+    if version is None:
+        return None
+    base_etag, deltas = version
+    return (base_etag, tuple(sorted(deltas + ((key, etag),))))
+
+def _borrar_csv(filename, ids):
+    columna_id = COLUMNAS_ID[_archivo_de(filename)]
+    return _agregar_csv(pd.DataFrame({columna_id: list(ids)}), filename, sufijo=SUFIJO_LAPIDA)
+
+# Reescribe el archivo completo. Se borran solo los deltas que ya estaban incluidos
+# en "data" al cargarlo, y la base se escribe solo si no cambió desde entonces
+# (If-Match); si cambió se lanza ConflictoDeEscritura.
+def _reescribir_csv(data, filename):
+    if data.attrs.get('parcial'):
+        raise ValueError(f"No se puede reescribir {filename} con datos filtrados")
+
+    claves_deltas = data.attrs.get('deltas')
+    if claves_deltas is None:
+        claves_deltas = [k for k, _ in _listar_deltas(filename)]
+
+    condicion = {}
+    if 'version' in data.attrs:
+        base_etag = data.attrs['version'][0]
+        condicion = {'IfMatch': base_etag} if base_etag is not None else {'IfNoneMatch': '*'}
+
+    etag = _escribir_csv(data, filename, **condicion)
+    _borrar_objetos(list(claves_deltas))
+    return (etag, ())
+
+# Incorpora los deltas a la base. Solo se borran los deltas que se leyeron, así
+# que las cargas registradas mientras se compacta quedan para la próxima vez.
+def _compactar_csv(filename):
+    deltas = _listar_deltas(filename)
+    if not deltas:
+        return
+
+    base_etag, base = _leer_base(filename)
+    partes, lapidas = _leer_deltas(deltas)
+    if not partes and not lapidas:
+        # Otra compactación ya los incorporó
+        return
+    if base is None and not partes:
+        # Solo lápidas de filas que no existen: no hay nada que reescribir
+        _borrar_objetos([k for k, _ in deltas])
+        return
+    try:
+        if lapidas or not _compactar_agregando(filename, base_etag, base, partes):
+            data = _combinar(filename, base, partes, lapidas)
+            _escribir_csv(data, filename, **({'IfMatch': base_etag} if base_etag else {'IfNoneMatch': '*'}))
+    except ConflictoDeEscritura:
+        # Otro proceso reescribió o compactó primero; estos deltas quedan para la próxima
+        return
+    _borrar_objetos([k for k, _ in deltas])
+
+# Si los deltas son solo filas nuevas con las mismas columnas que la base, la base
+# nueva es la anterior byte a byte más esas filas al final: conserva la generación
+# y los demás procesos leen solo lo agregado. Devuelve False si no se puede.
+def _compactar_agregando(filename, base_etag, base, partes):
+    if base is None:
+        return False
+    archivo = _archivo_de(filename)
+    nuevas = concatenar(partes, archivo)
+    if columnas_guardadas(nuevas) != columnas_guardadas(base):
+        return False
+    columna_id = COLUMNAS_ID.get(archivo)
+    if columna_id in base.columns and (
+        nuevas[columna_id].duplicated().any() or nuevas[columna_id].isin(base[columna_id]).any()
+    ):
+        return False
+
+    try:
+        obj = cliente_s3().get_object(Bucket=bucket(), Key=filename, IfMatch=base_etag)
+    except ClientError as e:
+        if es_conflicto(e):
+            raise ConflictoDeEscritura(filename) from e
+        raise
+    anterior = obj['Body'].read()
+    generacion = obj.get('Metadata', {}).get('generacion') or uuid.uuid4().hex
+    if anterior and not anterior.endswith(b'\n'):
+        anterior += b'\n'
+
+    agregado = a_csv(nuevas, archivo, header=False).encode('utf-8')
+    cuerpo = anterior + agregado
+    etag = _poner_objeto(filename, cuerpo, generacion, IfMatch=base_etag)
+
+    _guardar_en_cache(filename, etag, concatenar([base, nuevas], archivo))
+    _recordar_cola(filename, etag, generacion, cuerpo)
+    return True
+
+def compact_csv_in_background(filename):
+    with _compactando_lock:
+        if filename in _compactando:
+            return
+        _compactando.add(filename)
+
+    def tarea():
+        try:
+            compact_csv_in_s3(filename)
+        finally:
+            with _compactando_lock:
+                _compactando.discard(filename)
+
+    threading.Thread(target=tarea, daemon=True).start()
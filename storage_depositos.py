@@ -0,0 +1,240 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import storage
+from esquema import ESQUEMAS, aplicar, columnas_guardadas, concatenar
+from flota import deposito_de, registro
+from recursos import MAX_CONEXIONES, bucket, cliente_s3, opcion
+from storage import COLUMNAS_ID, ConflictoDeEscritura, esperar_reintento, filtrar, quitar_repetidas
+
+# Almacenamiento CSV fragmentado por depósito (storage_backend = "depositos"):
+#   depositos/<deposito>/<archivo>              (base + deltas, igual que el CSV único)
+#   depositos/<deposito>/<desde>-<hasta>/<archivo>  (con "coches_por_fragmento")
+# Todas las filas de un coche quedan en el mismo fragmento, así que cada coche
+# conserva el orden de sus cargas. Los fragmentos se leen en paralelo y se puede
+# pedir solo los de algunos depósitos; las escrituras tocan solo los fragmentos de
+# los coches involucrados. Si se cambia el registro de la flota (un coche que pasa
+# a otro depósito), hay que volver a correr este módulo para redistribuir las filas.
+
+PREFIJO = 'depositos/'
+
+# Fragmento para los coches que no están en el registro de la flota
+SIN_DEPOSITO = 'sin-deposito'
+
+# Con un número, cada depósito se divide además en rangos de coches de ese tamaño
+COCHES_POR_FRAGMENTO = int(opcion('coches_por_fragmento', 0))
+
+# Lecturas de fragmentos en paralelo, compartidas por todas las sesiones del proceso
+_pool = ThreadPoolExecutor(max_workers=MAX_CONEXIONES // 2, thread_name_prefix='fragmentos')
+
+def _clave(filename, fragmento):
+    return f"{PREFIJO}{fragmento}/{filename}"
+
+# Fragmento de cada coche (Series de texto alineada con "coches")
+def fragmento_de(coches):
+    depositos = deposito_de(coches).astype(object).where(lambda d: d.notna() & (d != ''), SIN_DEPOSITO)
+    if not COCHES_POR_FRAGMENTO:
+        return depositos.astype(str)
+    desde = pd.to_numeric(coches, errors='coerce').fillna(0).astype(int) // COCHES_POR_FRAGMENTO * COCHES_POR_FRAGMENTO
+    rangos = depositos.astype(str) + '/' + desde.astype(str) + '-' + (desde + COCHES_POR_FRAGMENTO - 1).astype(str)
+    return rangos.where(depositos != SIN_DEPOSITO, SIN_DEPOSITO)
+
+# Fragmentos de los coches del registro de esos depósitos (todos si es None)
+def _fragmentos(depositos=None):
+    flota = registro()
+    if depositos is not None:
+        flota = flota[flota['deposito'].isin(depositos)]
+    fragmentos = fragmento_de(flota.index.to_series()).unique().tolist()
+    if depositos is None and SIN_DEPOSITO not in fragmentos:
+        fragmentos.append(SIN_DEPOSITO)
+    return sorted(fragmentos)
+
+def _listar(filename, fragmento):
+    key = _clave(filename, fragmento)
+    # Los deltas antes que la base, como en storage._cargar_csv
+    deltas = storage._listar_deltas(key)
+    base_etag, base = storage._leer_base(key)
+    return key, base_etag, base, deltas
+
+def _combinar_fragmento(listado):
+    key, base_etag, base, deltas = listado
+    if base is None and not deltas:
+        return None
+    return storage._combinar_con_cache(key, base_etag, base, deltas)
+
+# Lee los fragmentos pedidos (en paralelo) y los une. La unión queda en caché
+# mientras ningún fragmento cambie. Un fragmento que todavía no existe está vacío.
+def _cargar_fragmentos(filename, fragmentos):
+    listados = list(_pool.map(lambda f: _listar(filename, f), fragmentos))
+    firma = tuple((key, base_etag, tuple(deltas)) for key, base_etag, _, deltas in listados)
+    clave_cache = (bucket(), PREFIJO, filename, tuple(fragmentos))
+    with storage._cache_lock:
+        en_cache = storage._cache_combinado.get(clave_cache)
+
+    if en_cache is not None and en_cache[0] == firma:
+        data = en_cache[1].copy()
+    else:
+        partes = [p for p in _pool.map(_combinar_fragmento, listados) if p is not None]
+        if not partes:
+            raise FileNotFoundError(filename)
+        data = concatenar(partes, filename) if len(partes) > 1 else partes[0]
+        with storage._cache_lock:
+            storage._cache_combinado[clave_cache] = (firma, data)
+        data = data.copy()
+
+    if any(len(deltas) >= storage.UMBRAL_COMPACTACION for _, _, _, deltas in listados):
+        storage.compact_csv_in_background(filename)
+
+    data.attrs['version'] = firma
+    data.attrs['fragmentos'] = {
+        fragmento: {'version': (base_etag, tuple(deltas)), 'deltas': tuple(k for k, _ in deltas)}
+        for fragmento, (_, base_etag, _, deltas) in zip(fragmentos, listados)
+    }
+    return data
+
+# "depositos" (lista de nombres) limita la lectura a los fragmentos de esos depósitos
+def cargar(filename, columnas=None, meses=None, depositos=None):
+    data = _cargar_fragmentos(filename, _fragmentos(depositos))
+    return filtrar(data, columnas, meses)
+
+# Cada grupo de filas nuevas va como delta a su fragmento
+def agregar(new_rows, filename):
+    grupos = list(new_rows.groupby(fragmento_de(new_rows['coche']).to_numpy(), sort=False))
+    if len(grupos) == 1:
+        storage._agregar_csv(grupos[0][1], _clave(filename, grupos[0][0]))
+    else:
+        list(_pool.map(lambda g: storage._agregar_csv(g[1], _clave(filename, g[0])), grupos))
+    return None
+
+# Reescribe por separado cada fragmento leído en "data" (con su propia escritura
+# condicional); los que no cambiaron no se escriben. Las filas que ahora son de un
+# fragmento que no se leyó se le agregan como delta.
+def _reescribir_fragmentos(data, filename):
+    leidos = data.attrs['fragmentos']
+    destinos = fragmento_de(data['coche']).to_numpy()
+    for fragmento in sorted(set(leidos) | set(destinos)):
+        filas = data[destinos == fragmento]
+        key = _clave(filename, fragmento)
+        if fragmento not in leidos:
+            storage._agregar_csv(filas, key)
+            continue
+
+        # La versión leída del fragmento es la firma de su unión en caché
+        with storage._cache_lock:
+            anterior = storage._cache_combinado.get((bucket(), key))
+        if anterior is not None and anterior[0] == leidos[fragmento]['version'] and _iguales(anterior[1], filas):
+            continue
+        if filas.empty and leidos[fragmento]['version'] == (None, ()):
+            continue
+
+        filas = filas.reset_index(drop=True)
+        filas.attrs = dict(leidos[fragmento])
+        storage._reescribir_csv(filas, key)
+
+def _iguales(anterior, nueva):
+    columnas = columnas_guardadas(anterior)
+    if columnas != columnas_guardadas(nueva) or len(anterior) != len(nueva):
+        return False
+    for columna in columnas:
+        a, b = anterior[columna].reset_index(drop=True), nueva[columna].reset_index(drop=True)
+        if a.dtype != b.dtype:
+            a, b = a.astype(object), b.astype(object)
+        if not a.equals(b):
+            return False
+    return True
+
+def reescribir(data, filename):
+    if data.attrs.get('parcial') or 'fragmentos' not in data.attrs:
+        raise ValueError(f"No se puede reescribir {filename} con datos filtrados")
+    _reescribir_fragmentos(data, filename)
+    return None
+
+# Como en el CSV único: si otro proceso escribió en un fragmento en el medio se
+# vuelve a leer y se reaplica la mutación (reaplicarla sobre fragmentos que ya se
+# escribieron no cambia nada)
+def mutar(filename, mutacion):
+    for intento in range(storage.MAX_INTENTOS):
+        data = _cargar_fragmentos(filename, _fragmentos())
+        nueva = mutacion(data)
+        nueva.attrs['fragmentos'] = data.attrs['fragmentos']
+        try:
+            _reescribir_fragmentos(nueva, filename)
+            return None
+        except ConflictoDeEscritura:
+            esperar_reintento(intento)
+    raise ConflictoDeEscritura(filename)
+
+# Borra las filas con "ids" y reemplaza por ID las de "filas". Se busca en qué
+# fragmento está cada ID: las lápidas y correcciones van solo a esos fragmentos, y
+# una corrección que cambia el coche de depósito deja además una lápida en el anterior.
+def reemplazar(filename, ids, filas):
+    columna_id = COLUMNAS_ID[filename]
+    buscados = list(ids) + (filas[columna_id].tolist() if filas is not None else [])
+    data = _cargar_fragmentos(filename, _fragmentos())
+    ubicadas = data.loc[data[columna_id].isin(buscados), [columna_id, 'coche']]
+    actual = pd.Series(fragmento_de(ubicadas['coche']).to_numpy(), index=ubicadas[columna_id].to_numpy())
+    actual = actual[~actual.index.duplicated(keep='last')]
+
+    lapidas = {}
+    for i in ids:
+        if i in actual.index:
+            lapidas.setdefault(actual[i], []).append(i)
+
+    if filas is not None:
+        filas = aplicar(filas.copy(), filename)
+        destinos = fragmento_de(filas['coche'])
+        for i, destino in zip(filas[columna_id], destinos):
+            if i in actual.index and actual[i] != destino:
+                lapidas.setdefault(actual[i], []).append(i)
+        for destino, grupo in filas.groupby(destinos.to_numpy(), sort=False):
+            storage._agregar_csv(grupo, _clave(filename, destino))
+
+    for fragmento, borrados in lapidas.items():
+        storage._borrar_csv(_clave(filename, fragmento), borrados)
+    return None
+
+def compactar(filename):
+    for fragmento in _fragmentos():
+        storage._compactar_csv(_clave(filename, fragmento))
+
+def _fragmentos_existentes(filename):
+    existentes = set()
+    paginator = cliente_s3().get_paginator('list_objects_v2')
+    for pagina in paginator.paginate(Bucket=bucket(), Prefix=PREFIJO):
+        for item in pagina.get('Contents', []):
+            key = item['Key'].split('.deltas/', 1)[0]
+            if key.endswith(f"/{filename}"):
+                existentes.add(key[len(PREFIJO):-len(filename) - 1])
+    return sorted(existentes)
+
+# Distribuye en fragmentos el CSV único (si todavía existe) y lo que ya estuviera
+# fragmentado, según el registro de la flota actual. Los fragmentos que quedan sin
+# coches se borran; el CSV único no se toca.
+def migrar_desde_csv(filename):
+    existentes = _fragmentos_existentes(filename)
+    partes = []
+    try:
+        partes.append(storage._cargar_csv(filename))
+    except FileNotFoundError:
+        pass
+    if existentes:
+        partes.append(_cargar_fragmentos(filename, existentes))
+    if not partes:
+        return 0
+
+    data = quitar_repetidas(concatenar(partes, filename), filename) if len(partes) > 1 else partes[0]
+    destinos = fragmento_de(data['coche']).to_numpy()
+    for fragmento in sorted(set(destinos)):
+        filas = data[destinos == fragmento].reset_index(drop=True)
+        filas.attrs = {}
+        storage._reescribir_csv(filas, _clave(filename, fragmento))
+
+    for fragmento in set(existentes) - set(destinos):
+        key = _clave(filename, fragmento)
+        storage._borrar_objetos([key] + [k for k, _ in storage._listar_deltas(key)])
+    return len(data)
+
+if __name__ == "__main__":
+    for archivo in ESQUEMAS:
+        print(f"{archivo}: {migrar_desde_csv(archivo)} filas distribuidas por depósito")
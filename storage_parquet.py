@@ -0,0 +1,286 @@
+import time
+import uuid
+from contextlib import contextmanager
+from io import BytesIO
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+import storage
+from esquema import aplicar, concatenar, para_guardar, vacio
+from metricas import medir
+from recursos import bucket, cliente_s3
+from storage import COLUMNAS_ID, ConflictoDeEscritura, es_conflicto, esperar_reintento, filtrar, meses_de, quitar_repetidas
+
+# Almacenamiento en Parquet particionado por mes:
+#   parquet/<dataset>/mes=YYYY-MM/<timestamp>-<uuid>.parquet
+# Cada escritura agrega archivos nuevos en las particiones que toca; los archivos
+# nunca se modifican, así que su ETag del listado alcanza para usar la caché.
+
+# Cantidad de archivos en una partición a partir de la cual conviene compactarla
+UMBRAL_COMPACTACION = 20
+
+# Segundos que dura el bloqueo de reescritura si el proceso que lo tomó se cae
+DURACION_BLOQUEO = 60
+
+# Última versión (todas las partes con su ETag) leída de cada dataset
+_versiones = {}
+
+def _dataset(filename):
+    return filename.rsplit('.', 1)[0]
+
+def _prefijo(filename):
+    return f"parquet/{_dataset(filename)}/"
+
+def _mes_de_clave(key):
+    return key.split('/mes=', 1)[1].split('/', 1)[0]
+
+# Devuelve {mes: [(clave, etag)]} con las partes de cada partición
+def _listar_particiones(filename):
+    particiones = {}
+    paginator = cliente_s3().get_paginator('list_objects_v2')
+    for pagina in paginator.paginate(Bucket=bucket(), Prefix=_prefijo(filename)):
+        for item in pagina.get('Contents', []):
+            particiones.setdefault(_mes_de_clave(item['Key']), []).append((item['Key'], item['ETag']))
+    return {mes: sorted(partes) for mes, partes in particiones.items()}
+
+# Cada parte se guarda en caché según las columnas con que se leyó: Parquet solo
+# decodifica las columnas pedidas
+def _leer_parte(key, etag, columnas):
+    clave_cache = (bucket(), key, tuple(columnas) if columnas is not None else None)
+    with storage._cache_lock:
+        en_cache = storage._cache.get(clave_cache)
+    if en_cache is not None and en_cache[0] == etag:
+        storage._contar('hits')
+        return en_cache[1]
+
+    storage._contar('misses')
+    obj = cliente_s3().get_object(Bucket=bucket(), Key=key)
+    with medir(f"parse {'/'.join(key.split('/')[:2])}", 'parse'):
+        data = pd.read_parquet(BytesIO(obj['Body'].read()), columns=list(columnas) if columnas is not None else None)
+    with storage._cache_lock:
+        storage._cache[clave_cache] = (obj['ETag'], data)
+    return data
+
+def _borrar_partes(claves):
+    storage._borrar_objetos(claves)
+    borradas = set(claves)
+    with storage._cache_lock:
+        for clave_cache in [c for c in storage._cache if len(c) == 3 and c[1] in borradas]:
+            del storage._cache[clave_cache]
+
+# Las columnas del esquema ya vienen tipadas; las demás columnas de texto pueden
+# traer objetos date o números mezclados y se guardan como texto igual que en el CSV.
+# Las categorías también se guardan como texto: leer cientos de partes con
+# diccionarios distintos y unirlos es más lento que categorizar una vez al combinar.
+def _normalizar(data):
+    data = data.reset_index(drop=True)
+    for columna in data.columns:
+        if isinstance(data[columna].dtype, pd.CategoricalDtype):
+            data[columna] = data[columna].astype(object)
+        elif data[columna].dtype == object:
+            data[columna] = data[columna].where(data[columna].isna(), data[columna].astype(str))
+    return data
+
+def _escribir_parte(data, filename, mes):
+    key = f"{_prefijo(filename)}mes={mes}/{time.time_ns():020d}-{uuid.uuid4().hex}.parquet"
+    buffer = BytesIO()
+    data.to_parquet(buffer, index=False)
+    respuesta = cliente_s3().put_object(Bucket=bucket(), Key=key, Body=buffer.getvalue())
+    with storage._cache_lock:
+        storage._cache[(bucket(), key, None)] = (respuesta['ETag'], data)
+    return key, respuesta['ETag']
+
+def _escribir_por_mes(data, filename):
+    data = _normalizar(para_guardar(data, filename))
+    if data.empty:
+        return []
+    return [
+        _escribir_parte(grupo.reset_index(drop=True), filename, mes)
+        for mes, grupo in data.groupby(meses_de(data), sort=True)
+    ]
+
+def _combinar(filename, partes):
+    if not partes:
+        return vacio(filename)
+    data = concatenar(partes, filename) if len(partes) > 1 else aplicar(partes[0].copy(), filename)
+    columna_id = COLUMNAS_ID.get(filename)
+    if len(partes) > 1 and columna_id in data.columns:
+        data = data.drop_duplicates(subset=columna_id, keep='last').reset_index(drop=True)
+    return data
+
+# Lee solo las particiones de "meses" (todas si es None) y solo las columnas pedidas.
+# Los depósitos no son particiones: "depositos" solo filtra las filas leídas.
+def cargar(filename, columnas=None, meses=None, depositos=None):
+    particiones = _listar_particiones(filename)
+    if not particiones:
+        raise FileNotFoundError(filename)
+
+    elegidas = sorted(m for m in particiones if meses is None or m in meses)
+    partes = [p for mes in elegidas for p in particiones[mes]]
+
+    # Para descartar duplicados hace falta la columna id aunque no se haya pedido
+    columnas_leidas = columnas
+    columna_id = COLUMNAS_ID.get(filename)
+    if columnas is not None and columna_id not in columnas:
+        columnas_leidas = list(columnas) + [columna_id]
+    if depositos is not None and columnas_leidas is not None and 'coche' not in columnas_leidas:
+        columnas_leidas = list(columnas_leidas) + ['coche']
+
+    clave_combinado = (
+        bucket(), _prefijo(filename),
+        tuple(columnas_leidas) if columnas_leidas is not None else None, tuple(elegidas)
+    )
+    firma = tuple(partes)
+    with storage._cache_lock:
+        en_cache = storage._cache_combinado.get(clave_combinado)
+    if en_cache is not None and en_cache[0] == firma:
+        data = en_cache[1].copy()
+    else:
+        data = _combinar(filename, [_leer_parte(k, etag, columnas_leidas) for k, etag in partes])
+        with storage._cache_lock:
+            storage._cache_combinado[clave_combinado] = (firma, data)
+        data = data.copy()
+
+    if depositos is not None:
+        data = filtrar(data, depositos=depositos)
+    if columnas is not None:
+        data = data[[c for c in columnas if c in data.columns]]
+
+    version = tuple(p for mes in sorted(particiones) for p in particiones[mes])
+    with storage._cache_lock:
+        _versiones[filename] = version
+
+    if any(len(p) >= UMBRAL_COMPACTACION for p in particiones.values()):
+        storage.compact_csv_in_background(filename)
+
+    data.attrs['version'] = version
+    data.attrs['partes'] = tuple(k for k, _ in partes)
+    if meses is not None or columnas is not None or depositos is not None:
+        data.attrs['parcial'] = True
+    if meses is not None:
+        data.attrs['meses'] = tuple(elegidas)
+    if depositos is not None:
+        data.attrs['depositos'] = tuple(depositos)
+        data.attrs['version'] = (version, tuple(depositos))
+    return data
+
+def agregar(new_rows, filename):
+    nuevas = _escribir_por_mes(new_rows, filename)
+
+    # La versión esperada es la última leída más las partes nuevas
+    with storage._cache_lock:
+        version = _versiones.get(filename)
+    if version is None:
+        return None
+    return tuple(sorted(version + tuple(nuevas), key=lambda p: (_mes_de_clave(p[0]), p[0])))
+
+# Las partes nuevas nunca pisan a otras, así que agregar no necesita coordinación.
+# Reescribir sí (dos reescrituras simultáneas borrarían las partes de la otra), así
+# que se hace con un bloqueo por dataset tomado con una escritura condicional:
+# If-None-Match crea el bloqueo solo si no existe, e If-Match permite quedarse con
+# uno vencido sin pisar a otro proceso que lo haya tomado al mismo tiempo.
+def _clave_bloqueo(filename):
+    return f"bloqueos/parquet/{_dataset(filename)}"
+
+def _tomar_bloqueo(filename):
+    key = _clave_bloqueo(filename)
+    for intento in range(storage.MAX_INTENTOS * 4):
+        vence = str(time.time() + DURACION_BLOQUEO)
+        try:
+            cliente_s3().put_object(Bucket=bucket(), Key=key, Body=vence, IfNoneMatch='*')
+            return
+        except ClientError as e:
+            if not es_conflicto(e):
+                raise
+
+        try:
+            obj = cliente_s3().get_object(Bucket=bucket(), Key=key)
+            if float(obj['Body'].read()) < time.time():
+                cliente_s3().put_object(Bucket=bucket(), Key=key, Body=vence, IfMatch=obj['ETag'])
+                return
+        except ClientError as e:
+            if not es_conflicto(e) and e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+        esperar_reintento(min(intento, 5))
+    raise ConflictoDeEscritura(key)
+
+@contextmanager
+def _bloqueo(filename):
+    _tomar_bloqueo(filename)
+    try:
+        yield
+    finally:
+        cliente_s3().delete_object(Bucket=bucket(), Key=_clave_bloqueo(filename))
+
+def _reescribir_partes(data, filename, partes_viejas):
+    _escribir_por_mes(data, filename)
+    _borrar_partes(partes_viejas)
+
+# Reescribe las particiones de las que salió "data": si se cargó solo un período,
+# solo se tocan esos meses. No se puede usar con datos proyectados a algunas columnas.
+# Si otra reescritura ya reemplazó alguna de esas partes se lanza ConflictoDeEscritura.
+def reescribir(data, filename):
+    if (data.attrs.get('parcial') and 'meses' not in data.attrs) or 'depositos' in data.attrs:
+        raise ValueError(f"No se puede reescribir {filename} con columnas filtradas")
+
+    with _bloqueo(filename):
+        actuales = {k for partes in _listar_particiones(filename).values() for k, _ in partes}
+        partes_viejas = list(data.attrs.get('partes', actuales))
+        if not set(partes_viejas) <= actuales:
+            raise ConflictoDeEscritura(filename)
+        _reescribir_partes(data, filename, partes_viejas)
+    return None
+
+# Con el bloqueo tomado se lee lo último y se aplica la mutación, así que no hay
+# conflicto posible con otras reescrituras; las partes agregadas mientras tanto se conservan
+def mutar(filename, mutacion):
+    with _bloqueo(filename):
+        data = cargar(filename)
+        _reescribir_partes(mutacion(data), filename, list(data.attrs['partes']))
+    return None
+
+# Borra las filas con "ids" y reemplaza por ID las de "filas" (correcciones),
+# reescribiendo solo los meses donde estaban esas filas o adonde se mueven
+def reemplazar(filename, ids, filas):
+    columna_id = COLUMNAS_ID[filename]
+    if filas is not None:
+        filas = aplicar(filas.copy(), filename)
+    with _bloqueo(filename):
+        data = cargar(filename)
+        tocadas = data[columna_id].isin(ids)
+        meses_data = meses_de(data)
+        if filas is not None:
+            tocadas |= data[columna_id].isin(filas[columna_id])
+        meses = set(meses_data[tocadas]) | (set(meses_de(filas)) if filas is not None else set())
+
+        en_meses = data[meses_data.isin(meses)]
+        if filas is not None:
+            en_meses = quitar_repetidas(concatenar([en_meses, filas], filename), filename)
+        en_meses = en_meses[~en_meses[columna_id].isin(ids)]
+
+        particiones = _listar_particiones(filename)
+        _reescribir_partes(en_meses, filename, [k for mes in meses for k, _ in particiones.get(mes, [])])
+    return None
+
+# Une en un solo archivo las particiones que acumularon muchas partes
+def compactar(filename):
+    with _bloqueo(filename):
+        for mes, partes in _listar_particiones(filename).items():
+            if len(partes) < UMBRAL_COMPACTACION:
+                continue
+            data = _combinar(filename, [_leer_parte(k, etag, None) for k, etag in partes])
+            _escribir_parte(_normalizar(data), filename, mes)
+            _borrar_partes([k for k, _ in partes])
+
+# Migración única desde los CSV actuales (base + deltas) a Parquet particionado
+def migrar_desde_csv(filename):
+    data = storage._cargar_csv(filename)
+    existentes = [k for partes in _listar_particiones(filename).values() for k, _ in partes]
+    _escribir_por_mes(data, filename)
+    _borrar_partes(existentes)
+    return len(data)
+
+if __name__ == "__main__":
+    for archivo in ['cargas_diesel.csv', 'servicios_realizados.csv']:
+        print(f"{archivo}: {migrar_desde_csv(archivo)} filas migradas a Parquet")
@@ -0,0 +1,39 @@
+import pandas as pd
+
+def _estado(litros_por_coche):
+    return pd.DataFrame({'litrosServi': list(litros_por_coche.values())}, index=list(litros_por_coche))
+
+def test_el_estado_de_un_deposito_no_saca_a_los_demas(entorno):
+    import alertas
+
+    alertas.reconstruir(_estado({5: 80, 7: 4000}), coches=[5, 7, 8])
+    alertas.reconstruir(_estado({101: 300, 102: 4000}), coches=[101, 102])
+    assert alertas.vencidos() == [(80, 5), (300, 101)]
+    assert alertas.vencidos(coches={5, 7}) == [(80, 5)]
+
+    # Al rearmar Tigre se reemplazan solo sus coches: el 5 ya no está en la tabla
+    alertas.reconstruir(_estado({7: 450}), coches=[5, 7, 8])
+    assert alertas.vencidos() == [(300, 101), (450, 7)]
+    assert [(e['coche'], e['nivelAnterior'], e['nivel']) for e in alertas.eventos_recientes()] == [(7, 'verde', 'amarillo')]
+
+    # La tabla de toda la flota reemplaza todo el índice
+    alertas.reconstruir(_estado({7: 450}))
+    assert alertas.vencidos() == [(450, 7)]
+
+def test_las_vistas_de_deposito_cubren_toda_la_flota(entorno):
+    import alertas
+    from estado_coches import obtener_estado
+
+    cargas = pd.DataFrame({
+        'idCarga': [1, 2], 'fecha': pd.to_datetime(['2026-10-01'] * 2), 'hora': ['10:00'] * 2,
+        'coche': [5, 101], 'litros': [4900, 4700],
+    })
+    servicios = pd.DataFrame(columns=['idServis', 'fecha', 'hora', 'coche', 'litrosTotales'])
+    for deposito, coche in [('Tigre', 5), ('Alderete', 101)]:
+        de_la_vista = cargas[cargas['coche'] == coche].copy()
+        de_la_vista.attrs['version'] = deposito
+        servicios.attrs['version'] = deposito
+        obtener_estado(de_la_vista, servicios, depositos=[deposito])
+
+    assert alertas.vencidos(coches={5}) == [(100, 5)]
+    assert alertas.vencidos(coches={101}) == [(300, 101)]
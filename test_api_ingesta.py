@@ -0,0 +1,150 @@
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import recursos
+from conftest import BUCKET
+
+CARGAS = 'cargas_diesel.csv'
+
+@pytest.fixture
+def api(entorno, monkeypatch):
+    import api_ingesta
+    import cola_escritura
+
+    # Estado y cola vacíos; cada prueba espera a que la cola se vacíe
+    monkeypatch.setattr(cola_escritura, 'JOURNAL', str(entorno / 'api_ingesta.jsonl'))
+    monkeypatch.setattr(cola_escritura, 'VENTANA_LOTE', 0)
+    monkeypatch.setattr(cola_escritura, '_pendientes', [])
+    monkeypatch.setattr(cola_escritura, '_suscriptores', [])
+    monkeypatch.setattr(api_ingesta, '_estado', {'tabla': None, 'leido': 0})
+    recursos.cliente_s3().put_object(
+        Bucket=BUCKET, Key=CARGAS, Body="idCarga,fecha,hora,coche,litros,litrosServi\n1,2026-10-01,10:00,5,100,4900\n"
+    )
+
+    http_servidor = api_ingesta.servidor('127.0.0.1', 0)
+    hilo = threading.Thread(target=http_servidor.serve_forever, daemon=True)
+    hilo.start()
+    yield api_ingesta, http_servidor.server_address[1]
+    http_servidor.shutdown()
+    http_servidor.server_close()
+    assert cola_escritura.vaciar(10)
+
+# Pedido con el cuerpo y los encabezados tal cual (sin que http.client calcule el largo)
+def _pedir(puerto, ruta, cuerpo, encabezados=None):
+    conexion = http.client.HTTPConnection('127.0.0.1', puerto, timeout=10)
+    try:
+        conexion.putrequest('POST', ruta)
+        encabezados = {'Content-Length': str(len(cuerpo)), **(encabezados or {})}
+        for nombre, valor in encabezados.items():
+            conexion.putheader(nombre, valor)
+        conexion.endheaders(cuerpo)
+        respuesta = conexion.getresponse()
+        return respuesta.status, json.loads(respuesta.read())
+    finally:
+        conexion.close()
+
+def _carga(coche=5, litros=50):
+    return {'coche': coche, 'litros': litros, 'fecha': '2026-10-02', 'hora': '09:00'}
+
+def _json(datos):
+    return json.dumps(datos).encode('utf-8')
+
+def test_los_pedidos_que_llegan_juntos_van_en_un_lote(api, monkeypatch):
+    api_ingesta, puerto = api
+    import cola_escritura
+    import storage
+
+    # Una ventana larga para que los pedidos concurrentes caigan en el mismo lote
+    monkeypatch.setattr(api_ingesta, 'VENTANA_LOTE', 0.5)
+    cuerpos = [
+        [_carga(5), {'coche': 'x', 'litros': 10, 'fecha': '2026-10-02'}, _carga(7)],
+        [{'coche': 5, 'litros': -5, 'fecha': '2026-10-02'}, _carga(8)],
+        [_carga(9)],
+    ]
+    respuestas = [None] * len(cuerpos)
+
+    def pedir(i):
+        respuestas[i] = _pedir(puerto, '/cargas', _json(cuerpos[i]))
+
+    hilos = [threading.Thread(target=pedir, args=(i,)) for i in range(len(cuerpos))]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert [codigo for codigo, _ in respuestas] == [202, 202, 202]
+    # Una sola operación en la cola para todo el lote
+    assert len({respuesta['operacion'] for _, respuesta in respuestas}) == 1
+    assert [respuesta['aceptadas'] for _, respuesta in respuestas] == [2, 1, 1]
+    ids = [i for _, respuesta in respuestas for i in respuesta['ids']]
+    assert len(set(ids)) == 4 and min(ids) > 1
+
+    # Los índices de las filas rechazadas son los de cada pedido, no los del lote
+    assert [r['fila'] for r in respuestas[0][1]['rechazadas']] == [1]
+    assert [r['fila'] for r in respuestas[1][1]['rechazadas']] == [0]
+    assert respuestas[2][1]['rechazadas'] == []
+
+    assert cola_escritura.vaciar(10)
+    assert sorted(storage.load_csv_from_s3(CARGAS)['idCarga'].tolist()) == sorted([1] + ids)
+
+def test_sin_filas_validas_responde_422(api):
+    _, puerto = api
+    codigo, respuesta = _pedir(puerto, '/cargas', _json([{'coche': 999, 'litros': 10, 'fecha': '2026-10-02'}]))
+    assert codigo == 422
+    assert respuesta['aceptadas'] == 0 and respuesta['rechazadas'][0]['fila'] == 0
+
+@pytest.mark.parametrize('cuerpo', [
+    b'\xff\xfe{"coche": 5}',                                   # no es UTF-8
+    b'{"coche": 5, "litros": ',                                # JSON inválido
+    _json([{'coche': 5, 'litros': [10], 'fecha': '2026-10-02'}]),   # valor anidado
+    _json([]),                                                 # sin filas
+])
+def test_cuerpo_invalido_responde_400(api, cuerpo):
+    _, puerto = api
+    codigo, respuesta = _pedir(puerto, '/cargas', cuerpo)
+    assert codigo == 400 and respuesta['error']
+
+@pytest.mark.parametrize('largo', ['abc', '-1'])
+def test_content_length_invalido_responde_400(api, largo):
+    _, puerto = api
+    codigo, respuesta = _pedir(puerto, '/cargas', b'', {'Content-Length': largo})
+    assert codigo == 400 and respuesta['error'] == 'Content-Length inválido'
+
+def test_cuerpo_demasiado_grande_responde_413(api, monkeypatch):
+    api_ingesta, puerto = api
+    monkeypatch.setattr(api_ingesta, 'MAXIMO_BYTES', 16)
+    codigo, _ = _pedir(puerto, '/cargas', _json([_carga()]))
+    assert codigo == 413
+
+def test_con_token_los_pedidos_sin_autorizacion_responden_401(api, monkeypatch):
+    api_ingesta, puerto = api
+    monkeypatch.setattr(api_ingesta, 'TOKEN', 'secreto')
+
+    assert _pedir(puerto, '/cargas', _json([_carga()]))[0] == 401
+    assert _pedir(puerto, '/cargas', _json([_carga()]), {'Authorization': 'Bearer otro'})[0] == 401
+    assert _pedir(puerto, '/cargas', _json([_carga()]), {'Authorization': 'Bearer secreto'})[0] == 202
+
+# La app y la API corren en procesos distintos: cada una con su journal
+@pytest.mark.parametrize('opciones, journal', [
+    ({}, 'api_ingesta.jsonl'),
+    ({'cola_escritura_journal': 'app.jsonl', 'api_journal': 'api.jsonl'}, 'api.jsonl'),
+])
+def test_la_api_no_comparte_el_journal_de_la_app(entorno, opciones, journal):
+    codigo = (
+        "import recursos\n"
+        f"recursos.inyectar(configuracion=('', '', 'us-east-1', {BUCKET!r}, 'pruebas', 'pruebas'), "
+        f"opciones={{'s3_local_dir': 's3', **{opciones!r}}})\n"
+        "import api_ingesta, cola_escritura\n"
+        "print(cola_escritura.JOURNAL)\n"
+    )
+    salida = subprocess.run(
+        [sys.executable, '-c', codigo], cwd=entorno, capture_output=True, text=True, check=True,
+        env={**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+    )
+    assert salida.stdout.strip() == journal
@@ -0,0 +1,105 @@
+import json
+import logging
+
+import pandas as pd
+import pytest
+
+import recursos
+from conftest import BUCKET
+
+CARGAS = 'cargas_diesel.csv'
+
+@pytest.fixture
+def cola(entorno, monkeypatch):
+    import cola_escritura
+
+    # Una cola vacía con su propio journal. El hilo de escritura es el del proceso:
+    # cada prueba espera a que se vacíe, así no quedan operaciones para la siguiente.
+    monkeypatch.setattr(cola_escritura, 'JOURNAL', str(entorno / 'cola_escritura.jsonl'))
+    monkeypatch.setattr(cola_escritura, 'VENTANA_LOTE', 0)
+    monkeypatch.setattr(cola_escritura, '_pendientes', [])
+    monkeypatch.setattr(cola_escritura, '_suscriptores', [])
+    recursos.cliente_s3().put_object(
+        Bucket=BUCKET, Key=CARGAS,
+        Body="idCarga,fecha,hora,coche,litros,litrosServi\n1,2026-10-01,10:00,5,100,4900\n2,2026-10-01,11:00,7,200,4800\n"
+    )
+    return cola_escritura
+
+def _filas(*ids, litros=50):
+    return pd.DataFrame([
+        {'idCarga': i, 'fecha': '2026-10-02', 'hora': '09:00', 'coche': 5, 'litros': litros, 'litrosServi': 4850}
+        for i in ids
+    ])
+
+def _operacion(id_operacion, operacion):
+    operacion['id'] = id_operacion
+    return {'operacion': operacion}
+
+def _escribir_journal(cola, registros, final=''):
+    with open(cola.JOURNAL, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(r) + '\n' for r in registros)
+        f.write(final)
+
+def _ids_guardados():
+    import storage
+    return storage.load_csv_from_s3(CARGAS)['idCarga'].tolist()
+
+def test_al_arrancar_se_reencola_lo_que_no_se_confirmo(cola):
+    _escribir_journal(cola, [
+        _operacion('a', cola.agregar(CARGAS, _filas(3))),
+        _operacion('b', cola.agregar(CARGAS, _filas(4))),
+        {'confirmada': 'a'},
+    ])
+
+    cola._recuperar()
+
+    assert cola.vaciar(10)
+    # La confirmada ya estaba en S3 (en la prueba no está, así se ve que no se reescribe)
+    assert _ids_guardados() == [1, 2, 4]
+
+def test_la_ultima_linea_cortada_se_ignora(cola):
+    cortada = json.dumps(_operacion('c', cola.agregar(CARGAS, _filas(5))))[:40]
+    _escribir_journal(cola, [_operacion('b', cola.agregar(CARGAS, _filas(4)))], final=cortada)
+
+    cola._recuperar()
+
+    assert cola.vaciar(10)
+    assert _ids_guardados() == [1, 2, 4]
+
+def test_se_descartan_las_operaciones_de_un_tipo_que_ya_no_se_usa(cola, caplog):
+    _escribir_journal(cola, [
+        _operacion('vieja', {'archivo': CARGAS, 'tipo': 'asignar', 'coche': 5, 'litros': 4000}),
+        _operacion('b', cola.borrar(CARGAS, [2])),
+    ])
+
+    with caplog.at_level(logging.WARNING):
+        cola._recuperar()
+
+    assert 'Se descartan 1 operaciones' in caplog.text
+    assert cola.vaciar(10)
+    assert _ids_guardados() == [1]
+
+def test_las_operaciones_seguidas_del_mismo_tipo_van_en_una_escritura(cola, monkeypatch):
+    escrituras = []
+    for nombre in ('append_csv_to_s3', 'correct_rows_in_s3', 'delete_rows_in_s3'):
+        def contar(*args, _nombre=nombre, _original=getattr(cola, nombre)):
+            escrituras.append(_nombre)
+            return _original(*args)
+        monkeypatch.setattr(cola, nombre, contar)
+
+    cola.encolar([
+        cola.agregar(CARGAS, _filas(3)),
+        cola.agregar(CARGAS, _filas(4)),
+        cola.corregir(CARGAS, _filas(2, litros=99)),
+        cola.corregir(CARGAS, _filas(4, litros=99)),
+        cola.borrar(CARGAS, [1]),
+        cola.agregar(CARGAS, _filas(5)),
+    ])
+    assert cola.vaciar(10)
+
+    # Se respeta el orden entre tramos de distinto tipo
+    assert escrituras == ['append_csv_to_s3', 'correct_rows_in_s3', 'delete_rows_in_s3', 'append_csv_to_s3']
+    import storage
+    data = storage.load_csv_from_s3(CARGAS)
+    # Las correcciones quedan en el lugar de la fila que corrigen
+    assert data[['idCarga', 'litros']].values.tolist() == [[2, 99], [3, 50], [4, 99], [5, 50]]
@@ -0,0 +1,74 @@
+import threading
+
+import pandas as pd
+import pytest
+
+import recursos
+from conftest import BUCKET
+
+CARGAS = 'cargas_diesel.csv'
+
+@pytest.fixture
+def espejo(entorno, monkeypatch):
+    import cola_escritura
+    import espejo_sqlite
+
+    # Un espejo nuevo suscripto a la cola solo durante la prueba
+    monkeypatch.setattr(espejo_sqlite, 'RUTA', str(entorno / 'espejo.sqlite'))
+    monkeypatch.setattr(espejo_sqlite, '_local', threading.local())
+    monkeypatch.setattr(espejo_sqlite, '_versiones', {})
+    monkeypatch.setattr(cola_escritura, '_suscriptores', [espejo_sqlite._al_encolar])
+    monkeypatch.setattr(cola_escritura, 'JOURNAL', str(entorno / 'cola_escritura.jsonl'))
+    monkeypatch.setattr(cola_escritura, 'VENTANA_LOTE', 0)
+    recursos.cliente_s3().put_object(
+        Bucket=BUCKET, Key=CARGAS,
+        Body="idCarga,fecha,hora,coche,litros,litrosServi\n1,2026-10-01,10:00,5,100,4900\n2,2026-10-01,11:00,7,200,4800\n"
+    )
+    espejo_sqlite._crear_tablas()
+    assert espejo_sqlite.sincronizar(CARGAS)
+    return espejo_sqlite
+
+def _filas(espejo):
+    return espejo.cargar(CARGAS)[['idCarga', 'coche', 'litros']].values.tolist()
+
+def _sentencias(espejo):
+    sentencias = []
+    espejo._conexion().set_trace_callback(sentencias.append)
+    return sentencias
+
+def test_las_escrituras_propias_no_rearman_la_tabla(espejo):
+    import cola_escritura
+
+    cola_escritura.encolar([
+        cola_escritura.agregar(CARGAS, pd.DataFrame([{
+            'idCarga': 3, 'fecha': '2026-10-02', 'hora': '09:00', 'coche': 5, 'litros': 50, 'litrosServi': 4850
+        }])),
+        cola_escritura.borrar(CARGAS, [2]),
+    ])
+    version = espejo.version(CARGAS)
+    assert _filas(espejo) == [[1, 5, 100], [3, 5, 50]]
+
+    # Lo pendiente no cambia la versión de S3: no hay nada que sincronizar
+    sentencias = _sentencias(espejo)
+    assert not espejo.sincronizar(CARGAS)
+
+    # Ya guardado en S3 la versión cambió, pero la tabla ya tenía esas filas
+    assert cola_escritura.vaciar(10)
+    assert not espejo.sincronizar(CARGAS)
+    assert not any(s.startswith(('DELETE', 'INSERT INTO cargas_diesel')) for s in sentencias)
+    assert espejo.version(CARGAS) == version
+
+def test_trae_solo_lo_que_escribio_otro_proceso(espejo):
+    import storage
+
+    storage.append_csv_to_s3(pd.DataFrame([{
+        'idCarga': 3, 'fecha': '2026-10-02', 'hora': '09:00', 'coche': 7, 'litros': 30, 'litrosServi': 4770
+    }]), CARGAS)
+    storage.delete_rows_in_s3(CARGAS, [1])
+
+    sentencias = _sentencias(espejo)
+    assert espejo.sincronizar(CARGAS)
+    assert _filas(espejo) == [[2, 7, 200], [3, 7, 30]]
+
+    # Una baja y un alta, sin vaciar la tabla
+    assert not any(s.startswith('DELETE FROM cargas_diesel') and 'WHERE' not in s for s in sentencias)
@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+CARGAS = 'cargas_diesel.csv'
+
+@pytest.mark.parametrize('columna, valor', [
+    ('coche', 40000),            # int16
+    ('litros', -40000),          # int16
+    ('litrosServi', 2 ** 31),    # int32
+    ('idCarga', 2 ** 40),        # int32
+])
+def test_un_valor_fuera_del_entero_es_un_error(entorno, columna, valor):
+    from esquema import tipar
+
+    data = pd.DataFrame({'idCarga': [1, 2], 'coche': [5, 5], 'litros': [10, 10], 'litrosServi': [100, 100]})
+    data[columna] = [data[columna].iloc[0], valor]
+    # astype lo daría vuelta (40000 como int16 es -25536) y se guardaría así
+    with pytest.raises(ValueError, match=columna):
+        tipar(data, CARGAS)
+
+def test_los_limites_del_entero_entran(entorno):
+    from esquema import tipar
+
+    data = tipar(pd.DataFrame({'coche': [-32768, 32767], 'litrosServi': [-2 ** 31, 2 ** 31 - 1]}), CARGAS)
+    assert data['coche'].dtype == 'int16' and data['litrosServi'].dtype == 'int32'
+    assert data['coche'].tolist() == [-32768, 32767]
+
+def test_concatenar_une_las_categorias_de_cada_parte(entorno):
+    from esquema import aplicar, concatenar
+
+    partes = [
+        aplicar(pd.DataFrame({'idCarga': [1, 2], 'hora': ['10:00', '11:00'], 'coche': [5, 5]}), CARGAS),
+        aplicar(pd.DataFrame({'idCarga': [3], 'hora': ['12:30'], 'coche': [7]}), CARGAS),
+    ]
+    # Categorías distintas: pd.concat volvería texto la columna
+    assert list(partes[0]['hora'].cat.categories) != list(partes[1]['hora'].cat.categories)
+
+    data = concatenar(partes, CARGAS)
+
+    assert isinstance(data['hora'].dtype, pd.CategoricalDtype)
+    assert set(data['hora'].cat.categories) == {'10:00', '11:00', '12:30'}
+    assert data['hora'].tolist() == ['10:00', '11:00', '12:30']
+    assert data['idCarga'].tolist() == [1, 2, 3] and data['coche'].tolist() == [5, 5, 7]
+    assert list(data.columns) == list(partes[0].columns)
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+# La hora se guarda como HH:MM desde la app y como HH:MM:SS en el CSV original y
+# en las importaciones: las dos tienen que ubicar la carga en el mismo momento
+
+@pytest.mark.parametrize('hora_carga, hora_servicio', [
+    ('08:30', '07:00'), ('08:30:00', '07:00'), ('08:30', '07:00:00'), ('08:30:00', '07:00:00'),
+])
+def test_carga_del_mismo_dia_posterior_al_servicio(entorno, hora_carga, hora_servicio):
+    from estado_coches import derivar_litros_servi
+
+    cargas = pd.DataFrame({
+        'idCarga': [1, 2],
+        'fecha': pd.to_datetime(['2026-10-01', '2026-10-01']),
+        'hora': ['06:00:00', hora_carga],
+        'coche': [5, 5],
+        'litros': [300, 200],
+    })
+    servicios = pd.DataFrame({
+        'idServis': [1], 'fecha': pd.to_datetime(['2026-10-01']), 'hora': [hora_servicio],
+        'coche': [5], 'litrosTotales': [300],
+    })
+
+    litros_servi, desde_servicio = derivar_litros_servi(cargas, servicios)
+    assert litros_servi.to_dict() == {1: 4700, 2: 4800}
+    assert desde_servicio.to_dict() == {5: 200}
+
+def test_horas_con_y_sin_segundos_dan_el_mismo_momento(entorno):
+    from estado_coches import _momentos
+
+    data = pd.DataFrame({'fecha': pd.to_datetime(['2026-10-01'] * 3), 'hora': ['08:30', '08:30:00', '8:30']})
+    assert len(set(_momentos(data))) == 1
+
+def _historial(coches, version):
+    cargas = pd.DataFrame({
+        'idCarga': range(1, len(coches) + 1), 'fecha': pd.to_datetime(['2026-10-01'] * len(coches)),
+        'hora': ['10:00'] * len(coches), 'coche': coches, 'litros': [100] * len(coches),
+    })
+    servicios = pd.DataFrame(columns=['idServis', 'fecha', 'hora', 'coche', 'litrosTotales'])
+    cargas.attrs['version'] = ('cargas', version)
+    servicios.attrs['version'] = ('servicios', version)
+    return cargas, servicios
+
+def test_cada_vista_tiene_su_estado(entorno):
+    from estado_coches import obtener_estado, registrar_carga
+
+    tigre = obtener_estado(*_historial([5, 5], 'tigre'), depositos=['Tigre'])
+    alderete = obtener_estado(*_historial([101], 'alderete'), depositos=['Alderete'])
+    assert tigre.index.tolist() == [5] and alderete.index.tolist() == [101]
+
+    # Volver a una vista no la rearma
+    assert obtener_estado(*_historial([5, 5], 'tigre'), depositos=['Tigre']) is tigre
+
+    # Una carga actualiza solo la tabla de la vista que la hizo, y no entra en una
+    # vista de otro depósito
+    registrar_carga(101, '2026-10-02', '10:00', 50, ('cargas', 'nueva'), depositos=['Alderete'])
+    registrar_carga(101, '2026-10-02', '10:00', 50, ('cargas', 'nueva'), depositos=['Tigre'])
+    assert alderete.loc[101, 'litrosTotales'] == 150
+    assert tigre.index.tolist() == [5]
+    assert tigre.loc[5, 'litrosTotales'] == 200
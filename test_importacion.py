@@ -0,0 +1,25 @@
+import pandas as pd
+
+import recursos
+from conftest import BUCKET
+
+def _flota(texto):
+    recursos.cliente_s3().put_object(Bucket=BUCKET, Key='flota.csv', Body=texto)
+
+def test_litros_hasta_la_capacidad_de_cada_coche(entorno):
+    _flota("coche,deposito,capacidad\n5,Tigre,300\n7,Tigre,\n")
+    from importacion import validar_cargas
+
+    data = pd.DataFrame({'coche': [5, 5, 7], 'litros': [300, 301, 4000], 'fecha': ['2026-10-01'] * 3})
+    validas, rechazadas = validar_cargas(data)
+
+    # El 7 no tiene capacidad en el registro: no hay máximo
+    assert validas[['coche', 'litros']].values.tolist() == [[5, 300], [7, 4000]]
+    assert rechazadas['fila'].tolist() == [3]
+    assert rechazadas['motivo'].tolist() == ['Litros fuera de rango (1 a la capacidad del coche)']
+
+def test_sin_registro_de_la_flota_no_hay_maximo(entorno):
+    from importacion import validar_cargas
+
+    validas, rechazadas = validar_cargas(pd.DataFrame({'coche': [5], 'litros': [4500], 'fecha': ['2026-10-01']}))
+    assert len(validas) == 1 and rechazadas.empty
@@ -0,0 +1,244 @@
+import threading
+
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError
+
+import recursos
+from conftest import BUCKET
+
+# Escrituras condicionales contra S3Local: un escritor concurrente se simula
+# escribiendo el mismo objeto justo antes de que lo haga la función probada.
+
+CARGAS = 'cargas_diesel.csv'
+
+@pytest.fixture
+def storage(entorno):
+    import storage
+    return storage
+
+def _s3():
+    # El cliente sin la capa de métricas, para poder interceptar sus operaciones
+    return recursos.cliente_s3()._cliente
+
+def _contador(storage):
+    return int(_s3().get_object(Bucket=BUCKET, Key=storage._clave_contador(CARGAS))['Body'].read())
+
+def _base(storage, ids):
+    filas = ''.join(f"{i},2026-10-01,10:00,5,10,{5000 - 10 * i}\n" for i in ids)
+    _s3().put_object(Bucket=BUCKET, Key=CARGAS, Body="idCarga,fecha,hora,coche,litros,litrosServi\n" + filas)
+
+# Antes de la primera escritura sobre "key" otro escritor deja "cuerpo" en esa clave
+def _interceptar_put(monkeypatch, key, cuerpo):
+    s3 = _s3()
+    original = s3.put_object
+    llamadas = []
+
+    def put_object(**kwargs):
+        if kwargs['Key'] == key:
+            llamadas.append(kwargs)
+            if len(llamadas) == 1:
+                original(Bucket=BUCKET, Key=key, Body=cuerpo)
+        return original(**kwargs)
+
+    monkeypatch.setattr(s3, 'put_object', put_object)
+    return llamadas
+
+def test_reservar_ids_reintenta_si_otro_proceso_actualiza_el_contador(storage, monkeypatch):
+    key = storage._clave_contador(CARGAS)
+    _s3().put_object(Bucket=BUCKET, Key=key, Body='10')
+
+    # Otro proceso reserva del 11 al 15 entre nuestra lectura y nuestra escritura (If-Match)
+    llamadas = _interceptar_put(monkeypatch, key, '15')
+    inicio = storage._reservar_en_s3(CARGAS, 5)
+
+    assert len(llamadas) == 2
+    assert 'IfMatch' in llamadas[0]
+    assert inicio == 16
+    assert _contador(storage) == 20
+
+def test_reservar_ids_reintenta_si_otro_proceso_crea_el_contador(storage, monkeypatch):
+    key = storage._clave_contador(CARGAS)
+    _base(storage, [1, 2, 7])
+
+    # Los dos procesos ven que no hay contador; el otro lo crea primero (If-None-Match)
+    llamadas = _interceptar_put(monkeypatch, key, '20')
+    inicio = storage._reservar_en_s3(CARGAS, 3)
+
+    assert len(llamadas) == 2
+    assert llamadas[0]['IfNoneMatch'] == '*'
+    assert inicio == 21
+    assert _contador(storage) == 23
+
+def test_reservas_concurrentes_no_repiten_ids(storage):
+    _base(storage, [1, 2, 3])
+    rangos = []
+    lock = threading.Lock()
+
+    # Cada hilo hace de un proceso distinto: va directo a S3 sin el bloque en memoria
+    def reservar():
+        for _ in range(10):
+            inicio = storage._reservar_en_s3(CARGAS, 4)
+            with lock:
+                rangos.append(range(inicio, inicio + 4))
+
+    hilos = [threading.Thread(target=reservar) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    ids = [i for rango in rangos for i in rango]
+    assert len(ids) == len(set(ids)) == 8 * 10 * 4
+    assert min(ids) == 4
+    assert _contador(storage) == max(ids)
+
+def test_un_error_de_lectura_no_reinicia_el_contador(storage, monkeypatch):
+    _base(storage, [1, 2, 3])
+    s3 = _s3()
+    original = s3.get_object
+
+    def get_object(**kwargs):
+        if kwargs['Key'] == CARGAS:
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': ''}}, 'GetObject')
+        return original(**kwargs)
+
+    monkeypatch.setattr(s3, 'get_object', get_object)
+    with pytest.raises(ClientError):
+        storage.reservar_ids(CARGAS)
+    monkeypatch.undo()
+
+    # El contador no se creó con 0: al reintentar arranca en el mayor ID existente
+    assert storage.reservar_ids(CARGAS) == [4]
+
+def test_mutacion_reintenta_sobre_lo_que_escribio_otro_proceso(storage, monkeypatch):
+    _base(storage, [1, 2])
+
+    # El otro proceso agrega la carga 3 reescribiendo la base
+    otro = (
+        "idCarga,fecha,hora,coche,litros,litrosServi\n"
+        "1,2026-10-01,10:00,5,10,4990\n2,2026-10-01,10:00,5,10,4980\n3,2026-10-02,10:00,5,10,4970\n"
+    )
+    llamadas = _interceptar_put(monkeypatch, CARGAS, otro)
+    storage.mutate_csv_in_s3(CARGAS, lambda data: data[data['idCarga'] != 1])
+
+    assert len(llamadas) == 2
+    data = storage._cargar(CARGAS)
+    assert data['idCarga'].tolist() == [2, 3]
+
+# Base + deltas + lápidas (append-only) y compactación
+
+def _fila(id_carga, litros=10):
+    return pd.DataFrame([{
+        'idCarga': id_carga, 'fecha': '2026-10-02', 'hora': '10:00', 'coche': 5, 'litros': litros, 'litrosServi': 4990
+    }])
+
+def _cuerpo(key=CARGAS):
+    return _s3().get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+def _generacion():
+    return _s3().head_object(Bucket=BUCKET, Key=CARGAS)['Metadata'].get('generacion')
+
+def _leer_sin_cache(storage):
+    for estado in (storage._cache, storage._cache_combinado, storage._colas):
+        estado.clear()
+    return storage._cargar(CARGAS)
+
+def test_la_lectura_combina_la_base_con_altas_y_correcciones(storage):
+    _base(storage, [1, 2])
+    storage.append_csv_to_s3(_fila(3), CARGAS)
+    storage.correct_rows_in_s3(_fila(1, litros=99), CARGAS)
+
+    data = storage._cargar(CARGAS)
+    # La corrección queda en el lugar de la fila que corrige
+    assert data['idCarga'].tolist() == [1, 2, 3]
+    assert data['litros'].tolist() == [99, 10, 10]
+    assert len(data.attrs['deltas']) == 2
+
+def test_las_lapidas_borran_filas_de_la_base_y_de_los_deltas(storage):
+    _base(storage, [1, 2])
+    storage.append_csv_to_s3(_fila(3), CARGAS)
+    storage.delete_rows_in_s3(CARGAS, [2, 3])
+
+    assert storage._cargar(CARGAS)['idCarga'].tolist() == [1]
+    assert _leer_sin_cache(storage)['idCarga'].tolist() == [1]
+
+def test_compactar_solo_altas_agrega_los_bytes_al_final_de_la_base(storage):
+    storage.update_csv_in_s3(pd.concat([_fila(1), _fila(2)]), CARGAS)
+    antes, generacion = _cuerpo(), _generacion()
+    storage.append_csv_to_s3(_fila(3), CARGAS)
+    storage.append_csv_to_s3(_fila(4), CARGAS)
+
+    storage.compact_csv_in_s3(CARGAS)
+
+    assert storage._listar_deltas(CARGAS) == []
+    despues = _cuerpo()
+    assert despues.startswith(antes) and despues.count(b'\n') == antes.count(b'\n') + 2
+    assert _generacion() == generacion
+    assert _leer_sin_cache(storage)['idCarga'].tolist() == [1, 2, 3, 4]
+
+def test_compactar_con_lapidas_reescribe_la_base(storage):
+    storage.update_csv_in_s3(pd.concat([_fila(1), _fila(2), _fila(3)]), CARGAS)
+    generacion = _generacion()
+    storage.delete_rows_in_s3(CARGAS, [2])
+    storage.append_csv_to_s3(_fila(4), CARGAS)
+
+    storage.compact_csv_in_s3(CARGAS)
+
+    assert storage._listar_deltas(CARGAS) == []
+    assert _generacion() != generacion
+    assert _leer_sin_cache(storage)['idCarga'].tolist() == [1, 3, 4]
+
+def test_solo_lapidas_sin_base(storage):
+    storage.delete_rows_in_s3(CARGAS, [1])
+
+    with pytest.raises(FileNotFoundError):
+        storage._cargar(CARGAS)
+    assert storage.load_csv_from_s3(CARGAS).empty
+
+    # No hay filas a las que aplicarlas: la compactación las descarta
+    storage.compact_csv_in_s3(CARGAS)
+    assert storage._listar_deltas(CARGAS) == []
+
+# Lectura por rango de lo que otro proceso agregó al final de la base
+
+def _agregar_al_final(storage, ids, generacion):
+    # Como la compactación de otro proceso: los bytes nuevos van después de los que ya estaban
+    filas = ''.join(f"{i},2026-10-02,10:00,5,10,4990\n" for i in ids)
+    _s3().put_object(Bucket=BUCKET, Key=CARGAS, Body=_cuerpo() + filas.encode('utf-8'), Metadata={'generacion': generacion})
+
+def test_la_lectura_por_rango_trae_solo_lo_agregado(storage):
+    storage.update_csv_in_s3(pd.concat([_fila(1), _fila(2)]), CARGAS)
+    storage._cargar(CARGAS)
+    _agregar_al_final(storage, [3, 4], _generacion())
+
+    antes = storage.cache_stats()
+    data = storage._cargar(CARGAS)
+    despues = storage.cache_stats()
+
+    assert despues['incrementales'] == antes['incrementales'] + 1
+    assert despues['misses'] == antes['misses']
+    pd.testing.assert_frame_equal(data, _leer_sin_cache(storage))
+    assert data['idCarga'].tolist() == [1, 2, 3, 4]
+
+@pytest.mark.parametrize('cambio', ['generacion', 'contenido'])
+def test_la_lectura_por_rango_vuelve_a_la_completa_si_el_objeto_se_reescribio(storage, cambio):
+    storage.update_csv_in_s3(pd.concat([_fila(1), _fila(2)]), CARGAS)
+    storage._cargar(CARGAS)
+    if cambio == 'generacion':
+        # Mismo prefijo pero con otra generación: no se puede confiar en el rango
+        _agregar_al_final(storage, [3], 'otra')
+    else:
+        # Misma generación pero los bytes conocidos cambiaron (otro ETag y otro contenido)
+        generacion = _generacion()
+        _base(storage, [7, 8, 9])
+        _s3().put_object(Bucket=BUCKET, Key=CARGAS, Body=_cuerpo(), Metadata={'generacion': generacion})
+
+    antes = storage.cache_stats()
+    data = storage._cargar(CARGAS)
+    despues = storage.cache_stats()
+
+    assert despues['incrementales'] == antes['incrementales']
+    assert despues['misses'] == antes['misses'] + 1
+    pd.testing.assert_frame_equal(data, _leer_sin_cache(storage))
+    assert data['idCarga'].tolist() == ([1, 2, 3] if cambio == 'generacion' else [7, 8, 9])